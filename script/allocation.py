@@ -2,15 +2,21 @@
 
 # modules
 import sys
+import logging
 
-from copy import deepcopy
-
+import numpy as np
 import pcraster as pcr
 
 try:
-    from .basic_functions import pcr_return_val_div_zero, sum_list, pcr_get_statistics
+    from .basic_functions import pcr_return_val_div_zero, np_return_val_div_zero, \
+                                 sum_list, copy_dicts
+    from .zonal_aggregation import get_zone_index, get_clone_shape, \
+                                   pcr_to_array, array_to_pcr, local_index
 except:
-    from basic_functions import pcr_return_val_div_zero, sum_list, pcr_get_statistics
+    from basic_functions import pcr_return_val_div_zero, np_return_val_div_zero, \
+                                sum_list, copy_dicts
+    from zonal_aggregation import get_zone_index, get_clone_shape, \
+                                  pcr_to_array, array_to_pcr, local_index
 
 # global variables
 
@@ -20,6 +26,32 @@ very_small_number = 1.0e-12
 # type of None, compatible with python 2.6
 NoneType = type(None)
 
+# kernels of the allocation: the allocation with PCRaster fields (default) or
+# the vectorized numpy kernel, which is set by the allocation_kernel of the
+# water management in the configuration; the results of the kernels can be
+# compared with the compare mode of allocation_benchmark.py
+allocation_kernels = ['pcraster', 'numpy']
+use_numpy_kernel = False
+
+# allocation modes: the iterative allocation or the closed-form proportional
+# allocation, which only applies to the zonal allocation without using local
+# resources first and without reallocating any surplus
+allocation_modes = ['iterative', 'proportional']
+
+# flag whether the fall back of the proportional allocation to the iterative
+# allocation for sources with different zones has been logged
+proportional_fallback_logged = False
+
+# diagnostics flag: if True, the diagnostics of the allocation are filled and
+# returned as a message string; if False, the message strings are empty
+diagnostics_flag = False
+
+# missing value for the statistics in the diagnostics
+diagnostics_missing_value = -999.9
+
+# set the logger
+logger = logging.getLogger(__name__)
+
 
 ########
 # TODO #
@@ -50,6 +82,200 @@ if len(critical_improvements) > 0:
 # functions #
 #############
 
+def set_diagnostics_flag(flag):
+
+    '''
+set_diagnostics_flag: enables (True) or disables (False) the diagnostics of the \
+allocation.
+
+'''
+
+    # set the flag
+    global diagnostics_flag
+    diagnostics_flag = bool(flag)
+    logger.info('diagnostics of the allocation are %s' % \
+                ('enabled' if diagnostics_flag else 'disabled'))
+
+    # returns None
+    return None
+
+def set_allocation_kernel(kernel):
+
+    '''
+set_allocation_kernel: sets the kernel of the allocation, which is one of the \
+allocation kernels: pcraster or numpy.
+
+'''
+
+    # check the kernel
+    if not kernel in allocation_kernels:
+        message_str = 'allocation kernel %s is not one of %s' % \
+                      (kernel, str.join(', ', allocation_kernels))
+        logger.error(message_str)
+        sys.exit('error: %s' % message_str)
+
+    # set the flag
+    global use_numpy_kernel
+    use_numpy_kernel = kernel == 'numpy'
+    logger.info('allocation is computed with the %s kernel' % kernel)
+
+    # returns None
+    return None
+
+###################
+# class definition #
+###################
+
+class allocation_diagnostics(object):
+
+    '''
+allocation_diagnostics: structured diagnostics of the allocation that hold the \
+messages, the number of cells with unmet demand and remaining availability per \
+iteration and the statistics of the demand, allocation and withdrawal. The \
+diagnostics are only filled if enabled by the diagnostics flag at the time of \
+creation and are only formatted into a message string on request.
+
+    Attributes:
+    ===========
+    enabled:                boolean that is True if the diagnostics are filled;
+    entries:                list of the entries in the order of addition, being
+                            a message string, a list with the number of cells
+                            with unmet demand per iteration or a dictionary
+                            with the statistics.
+
+'''
+
+    def __init__(self, title = ''):
+
+        # init object
+        object.__init__(self)
+
+        # set the flag and the entries
+        self.enabled = diagnostics_flag
+        self.entries = []
+        self.add_message(title)
+
+        # returns None
+        return None
+
+    def add_message(self, *message_strs):
+
+        '''
+add_message: adds one or more lines to the diagnostics.
+
+'''
+
+        # add the message strings
+        if self.enabled:
+            self.entries.extend(message_strs)
+
+        # returns None
+        return None
+
+    def add_iterations(self, number_cells_unmet_demand):
+
+        '''
+add_iterations: adds the number of cells with unmet demand and remaining \
+availability per iteration to the diagnostics.
+
+'''
+
+        # add the iterations
+        if self.enabled:
+            self.entries.append(list(number_cells_unmet_demand))
+
+        # returns None
+        return None
+
+    def add_statistics(self, names, fields, name_format = '%20s'):
+
+        '''
+add_statistics: adds the count, average, minimum and maximum of the fields to \
+the diagnostics; the fields are stacked so that the statistics of all fields \
+are obtained in a single pass over the values.
+
+    Input:
+    ======
+    names:                  list of the names of the fields;
+    fields:                 list of the fields as scalar PCRaster fields or as
+                            flat arrays with missing values set to NaN;
+    name_format:            format of the name in the message string.
+
+'''
+
+        # return if not enabled
+        if not self.enabled:
+            return None
+
+        # stack the values and get the statistics
+        values = np.stack([field if isinstance(field, np.ndarray) else \
+                           pcr_to_array(field) for field in fields])
+        valid_mask = ~np.isnan(values)
+        counts     = np.count_nonzero(valid_mask, axis = 1)
+        defined    = counts > 0
+
+        statistics = { \
+                      'names'      : names, \
+                      'name_format': name_format, \
+                      'count'      : counts, \
+                      'average'    : np.where(defined, \
+                                              np.where(valid_mask, values, 0).sum(axis = 1) / \
+                                              np.maximum(1, counts), \
+                                              diagnostics_missing_value), \
+                      'min'        : np.where(defined, \
+                                              np.where(valid_mask, values, np.inf).min(axis = 1), \
+                                              diagnostics_missing_value), \
+                      'max'        : np.where(defined, \
+                                              np.where(valid_mask, values, -np.inf).max(axis = 1), \
+                                              diagnostics_missing_value), \
+                      }
+        self.entries.append(statistics)
+
+        # returns None
+        return None
+
+    def format(self):
+
+        '''
+format: returns the diagnostics as a message string; the string is empty if \
+the diagnostics are not enabled.
+
+'''
+
+        # initialize the lines
+        lines = []
+
+        # add the entries
+        for entry in self.entries:
+
+            if isinstance(entry, str):
+                lines.append(entry)
+
+            elif isinstance(entry, list):
+                for iter_allocation, number_cells in enumerate(entry):
+                    lines.extend(['allocation iteration %d' % (iter_allocation + 1), \
+                                  'cells with unmet demand: %6d / %6d in total' % \
+                                  (number_cells, number_cells)])
+
+            else:
+                line_format = '%s - count: %%6d - avg.: %%10g - min: %%10g - max: %%10g' % \
+                              entry['name_format']
+                for ix, name in enumerate(entry['names']):
+                    lines.append(line_format % \
+                                 (name, entry['count'][ix], entry['average'][ix], \
+                                  entry['min'][ix], entry['max'][ix]))
+
+        # return the message string
+        return str.join('\n', lines)
+
+    def __str__(self):
+
+        # return the message string
+        return self.format()
+
+#== end of allocation_diagnostics class =======================================
+
+
 # get the key
 def get_key(str_list):
     
@@ -70,8 +296,9 @@ def get_key(str_list):
     return key
 
 # the following are functions that are based the present allocation in
-# PCR-GLOBWB and use aggregated values over zones using the PCRaster area...
-# functions.
+# PCR-GLOBWB and use aggregated values over zones; these were originally
+# computed with the PCRaster area... functions and are now obtained from the
+# zone indices in the zonal_aggregation module.
 
 def get_zonal_total(local_values, zones):
         
@@ -92,8 +319,12 @@ the total of the provided zones.
 
 '''
 
-    # compute the totals
-    return pcr.areatotal(local_values, zones)
+    # compute the totals over the indexed zones
+    zones = get_zone_index(zones)
+    totals = zones.get_total(pcr_to_array(local_values))
+    
+    # return the totals
+    return array_to_pcr(totals, zones.shape)
     
 def get_zonal_fraction(local_values, zones):
         
@@ -114,14 +345,64 @@ the total of the provided zones.
 
 '''
 
-    # compute the totals
-    totals = get_zonal_total(local_values, zones)
-    
-    fractional_values = pcr_return_val_div_zero(local_values, totals, \
-                                                very_small_number)
+    # compute the fractional values over the indexed zones
+    zones = get_zone_index(zones)
+    fractional_values = zones.get_fraction(pcr_to_array(local_values))
 
     # return the fractional values
-    return fractional_values
+    return array_to_pcr(fractional_values, zones.shape)
+
+def get_zonal_minimum(local_values, zones):
+        
+    '''
+get_zonal_minimum: function that computes the minimum value over the provided \
+zones.
+
+    Input:
+    ======
+    local values:            local cell values as a scalar PCRaster field;
+    zones:                   zones over which the minima are computed as 
+                             a nominal PCRaster field.
+    
+    Output:
+    =======
+    minima:                  minima over the zones per cell as a scalar
+                             PCRaster field.
+
+'''
+
+    # compute the minima over the indexed zones
+    zones = get_zone_index(zones)
+    minima = zones.get_minimum(pcr_to_array(local_values))
+
+    # return the minima
+    return array_to_pcr(minima, zones.shape)
+
+def get_zonal_maximum(local_values, zones):
+        
+    '''
+get_zonal_maximum: function that computes the maximum value over the provided \
+zones.
+
+    Input:
+    ======
+    local values:            local cell values as a scalar PCRaster field;
+    zones:                   zones over which the maxima are computed as 
+                             a nominal PCRaster field.
+    
+    Output:
+    =======
+    maxima:                  maxima over the zones per cell as a scalar
+                             PCRaster field.
+
+'''
+
+    # compute the maxima over the indexed zones
+    zones = get_zone_index(zones)
+    maxima = zones.get_maximum(pcr_to_array(local_values))
+
+    # return the maxima
+    return array_to_pcr(maxima, zones.shape)
 
 def obtain_allocation_ratio( \
                             demand, \
@@ -199,52 +480,27 @@ def obtain_allocation_ratio( \
     return zonal_availability, \
            zonal_potential_allocation, allocation_ratio
 
-def allocate_demand_to_availability( \
-                                    demand, \
-                                    availability, \
-                                    zones, \
-                                    source_names, \
-                                   ):
+def allocate_demand_to_availability_pcr( \
+                                        demand, \
+                                        availability, \
+                                        zones, \
+                                        source_names, \
+                                       ):
     
     '''
-    
-    Input:
-    ======
-    demand:                 demand per cell as a scalar PCRaster field;
-    availability:           availability per cell per source, same
-                            unit as the total demand and organized as a dict-
-                            ionary with the source names as keys and scalar
-                            PCRaster fields as values; availability can be spec-
-                            ified for any or all cells within a zone;
-    zones:                  zones over which the demand and availability are
-                            totaled; organized as a dictionary with the source 
-                            names as keys and nominal PCRaster fields as values;
-    source_names:           list of names of the available sources. 
-    
-    Output:
-    =======
-    
-    withdrawal:             withdrawal per cell subdivided over the sour-
-                            ces on the basis of the availability, organized as
-                            a dictionary with the sources as keys and as values
-                            scalar PCRaster fields;
-    allocated_demand:       allocation of the demand subdivided over the sour-
-                            ces on the basis of the availability, organized as
-                            a dictionary with the sources as keys and as values
-                            scalar PCRaster fields;
-    met_demand:             the demand that is met and the sum of the allocat-
-                            ion per source;
-    unmet_demand:           the demand that cannot be met;
-    message_str:            a message string that provides an overview of the
-                            allocation process.
-    
+allocate_demand_to_availability_pcr: iterative allocation of the demand to \
+the availability using PCRaster fields; see allocate_demand_to_availability \
+for the input and output; instead of the message string, the number of cells \
+with unmet demand and remaining availability per iteration is returned.
+
 '''
     # set test verbose for testing
     test_verbose = False
     test_at_iter = False
 
-    # create a deep copy of availability
-    availability = deepcopy(availability)
+    # copy the dictionary of the availability, which is updated; the fields
+    # themselves are not modified
+    availability = copy_dicts(availability)
 
     # set the unmet demand
     # the iteration of the supplyallocation and
@@ -255,13 +511,13 @@ def allocate_demand_to_availability( \
     exit_condition  = False
 
     # initialize the output
-    message_str      = ''
     withdrawal       = dict((source_name, \
                              pcr.ifthen(demand >= 0, pcr.scalar(0))) \
                              for source_name in source_names)
     allocated_demand = dict((source_name, \
                              pcr.ifthen(demand >= 0, pcr.scalar(0))) \
                              for source_name in source_names)
+    number_cells_per_iteration = []
 
     min_number_cells_unmet_demand = pcr.cellvalue(pcr.maptotal( \
                                                   pcr.scalar(pcr.defined(met_demand))), 1)[0]
@@ -269,10 +525,6 @@ def allocate_demand_to_availability( \
     # iterate untill all demand is allocated or the availability is exhausted
     while not exit_condition:
 
-        message_str = str.join('\n', \
-                                (message_str, \
-                                 'allocation iteration %d' % iter_allocation))
-
         # obtain the allocation ratio that is used to the derive the allocation
         # per source
         zonal_availability, \
@@ -319,22 +571,19 @@ def allocate_demand_to_availability( \
         met_demand   = sum_list(list(allocated_demand.values()))
         unmet_demand = pcr.max(0, demand - met_demand)
 
-        # get final info and assess the exit condition
-        mask = unmet_demand > 0
-        number_cells_unmet_demand = pcr.cellvalue(pcr.maptotal(pcr.scalar(mask)), 1)[0]
-        mask = mask & (pcr.max(0, sum_list(list(availability.values())) - \
-                                                sum_list(list(withdrawal.values()))) > 0)
-        number_cells_unmet_demand = pcr.cellvalue(pcr.maptotal(pcr.scalar(mask)), 1)[0]
+        # get final info and assess the exit condition: the cells with unmet
+        # demand and remaining availability are obtained once as an array and
+        # counted, which replaces the map totals and maximum per iteration
+        mask = (unmet_demand > 0) & \
+               (pcr.max(0, sum_list(list(availability.values())) - \
+                           sum_list(list(withdrawal.values()))) > 0)
+        number_cells_unmet_demand = np.count_nonzero(pcr.pcr2numpy(mask, 0) == 1)
         
-        # update the message string
-        message_str = str.join('\n', \
-                               (message_str, \
-                                'cells with unmet demand: %6d / %6d in total' % \
-                                (number_cells_unmet_demand, \
-                                 number_cells_unmet_demand)))
+        # add the number of cells to the iterations
+        number_cells_per_iteration.append(number_cells_unmet_demand)
 
         # set the condition
-        exit_condition  = pcr.cellvalue(pcr.mapmaximum(pcr.scalar(mask)), 1)[0] == 0
+        exit_condition  = number_cells_unmet_demand == 0
         exit_condition  = exit_condition or \
                           (number_cells_unmet_demand == min_number_cells_unmet_demand)
         iter_allocation = iter_allocation + 1
@@ -342,40 +591,393 @@ def allocate_demand_to_availability( \
                                             number_cells_unmet_demand)
 
         # test iteration
-        if test_verbose and test_at_iter: print (message_str, exit_condition, \
-                                                 min_number_cells_unmet_demand)
-
-    # add the final information to the message string
-    demand_stats             = pcr_get_statistics(demand)
-    met_demand_stats         = pcr_get_statistics(met_demand)
-    unmet_demand_stats       = pcr_get_statistics(pcr.ifthenelse(unmet_demand > 0, unmet_demand, pcr.scalar(0)))
-    total_withdrawal_stats   = pcr_get_statistics(sum_list(list(withdrawal.values())))
-    total_alloc_demand_stats = pcr_get_statistics(sum_list(list(allocated_demand.values())))
+        if test_verbose and test_at_iter: print (iter_allocation, number_cells_unmet_demand, \
+                                                 exit_condition, min_number_cells_unmet_demand)
+
+    # return the output
+    return withdrawal, allocated_demand, met_demand, unmet_demand, \
+           number_cells_per_iteration
+
+def allocate_arrays( \
+                    demand, \
+                    availability, \
+                    zone_indices, \
+                   ):
     
-    # update the message_str
-    message_str = str.join('\n', \
-                          (message_str, \
-                           'statistics:',\
-                           '=' * len('statistics:'), \
-                           '%20s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                               ('demand', demand_stats['count'], demand_stats['average'], \
-                                demand_stats['min'], demand_stats['max']), \
-                           '%20s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                               ('met demand', met_demand_stats['count'], met_demand_stats['average'], \
-                                met_demand_stats['min'], demand_stats['max']), \
-                           '%20s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                               ('unmet demand', unmet_demand_stats['count'], unmet_demand_stats['average'], \
-                                unmet_demand_stats['min'], unmet_demand_stats['max']), \
-                           '%20s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                               ('alloc. demand', total_alloc_demand_stats['count'], total_alloc_demand_stats['average'], \
-                                total_alloc_demand_stats['min'], total_alloc_demand_stats['max']), \
-                           '%20s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                               ('total withdrawal', total_withdrawal_stats['count'], total_withdrawal_stats['average'], \
-                                total_withdrawal_stats['min'], total_withdrawal_stats['max']), \
-                            ))
-                               
+    '''
+allocate_arrays: vectorized kernel of the iterative allocation of the demand \
+to the availability over flat arrays of all cells; the sources are stacked \
+so that each iteration is processed as batched numpy operations. Missing \
+values are identified as NaN and are propagated as missing values in the \
+PCRaster equivalent.
+The first iteration processes all cells; subsequent iterations only process \
+the active cells, being the cells in the zones per source that still have \
+cells with unmet demand as well as availability. Zones become inactive as \
+soon as either is exhausted and the set of active cells shrinks accordingly; \
+the number of cells with unmet demand and remaining availability is updated \
+for the active cells only.
+
+    Input:
+    ======
+    demand:                 demand per cell as a flat array of length n_cells;
+    availability:           availability per cell per source as an array of
+                            shape (n_sources, n_cells), same unit as the demand;
+                            this array is not modified;
+    zone_indices:           list of the zone indices per source, in the same
+                            order as the availability.
+    
+    Output:
+    =======
+    withdrawal:             withdrawal per source and cell as an array of
+                            shape (n_sources, n_cells);
+    allocated_demand:       allocated demand per source and cell as an array of
+                            shape (n_sources, n_cells);
+    met_demand:             the demand that is met per cell;
+    unmet_demand:           the demand that cannot be met per cell;
+    number_cells_unmet_demand:
+                            list with the number of cells with unmet demand and
+                            remaining availability per iteration.
+
+'''
+
+    # initialize the output: the availability is copied and updated, the
+    # withdrawal and allocated demand are set to zero where the demand is
+    # defined
+    availability     = np.array(availability, dtype = np.float64)
+    undefined_mask   = ~(demand >= 0)
+    withdrawal       = np.zeros(availability.shape)
+    withdrawal[:, undefined_mask] = np.nan
+    allocated_demand = withdrawal.copy()
+    
+    # set the met and unmet demand
+    met_demand   = np.where(undefined_mask, np.nan, 0.0)
+    unmet_demand = np.maximum(0, demand - met_demand)
+
+    # initialize the buffers that hold the intermediate values per source;
+    # these are used for the active cells only
+    buffers = np.empty((4, ) + availability.shape)
+    cell_buffer = np.empty(demand.shape)
+
+    # set the active cells, initially all cells, and the corresponding zone
+    # indices per source; cells of the active cells that are outside the
+    # active zones of a source are masked once the set of active cells shrinks
+    active_cells  = np.arange(demand.size)
+    outside_masks = [None for zones in zone_indices]
+
+    # set the exit condition; the cells with unmet demand and remaining
+    # availability are tracked for all cells
+    unmet_demand_mask = np.zeros(demand.shape, dtype = bool)
+    number_cells_unmet_demand     = []
+    min_number_cells_unmet_demand = np.count_nonzero(~undefined_mask)
+    exit_condition = False
+
+    # iterate untill all demand is allocated or the availability is exhausted
+    while not exit_condition:
+
+        # get the values of the active cells
+        number_active_cells = active_cells.size
+        active_demand           = demand[active_cells]
+        active_availability     = availability[:, active_cells]
+        active_withdrawal       = withdrawal[:, active_cells]
+        active_allocated_demand = allocated_demand[:, active_cells]
+        active_unmet_demand     = unmet_demand[active_cells]
+        active_met_demand       = cell_buffer[:number_active_cells]
+
+        zonal_availability         = buffers[0, :, :number_active_cells]
+        zonal_potential_allocation = buffers[1, :, :number_active_cells]
+        allocation_ratio           = buffers[2, :, :number_active_cells]
+        increment                  = buffers[3, :, :number_active_cells]
+
+        # obtain the allocation ratio per source from the zonal availability
+        # and the potential allocation on the basis of the demand fraction;
+        # outside the active zones, the potential allocation is zero
+        for ix, zones in enumerate(zone_indices):
+            zones.get_total(active_availability[ix], out = zonal_availability[ix])
+            zones.get_fraction(active_unmet_demand, out = zonal_potential_allocation[ix])
+            if not isinstance(outside_masks[ix], NoneType):
+                zonal_availability[ix, outside_masks[ix]] = 0
+                zonal_potential_allocation[ix, outside_masks[ix]] = 0
+        zonal_potential_allocation *= zonal_availability
+        np.sum(zonal_potential_allocation, axis = 0, out = active_met_demand)
+        np_return_val_div_zero(zonal_potential_allocation, active_met_demand, \
+                               very_small_number, out = allocation_ratio)
+
+        # get the actual allocation as the minimum of the allocated available
+        # supply and the local demand and update the allocated demand
+        np.multiply(allocation_ratio, active_unmet_demand, out = increment)
+        np.minimum(zonal_potential_allocation, increment, \
+                   out = zonal_potential_allocation)
+        active_allocated_demand += zonal_potential_allocation
+
+        # get the increment in the withdrawal and update the withdrawal and
+        # the availability
+        for ix, zones in enumerate(zone_indices):
+            zones.get_total(zonal_potential_allocation[ix], out = increment[ix])
+        np_return_val_div_zero(increment, zonal_availability, \
+                               very_small_number, out = increment)
+        increment *= active_availability
+        active_withdrawal   += increment
+        active_availability -= increment
+        np.maximum(active_availability, 0, out = active_availability)
+
+        # met demand and unmet demand
+        np.sum(active_allocated_demand, axis = 0, out = active_met_demand)
+        np.subtract(active_demand, active_met_demand, out = active_unmet_demand)
+        np.maximum(active_unmet_demand, 0, out = active_unmet_demand)
+
+        # return the values of the active cells
+        availability[:, active_cells]     = active_availability
+        withdrawal[:, active_cells]       = active_withdrawal
+        allocated_demand[:, active_cells] = active_allocated_demand
+        met_demand[active_cells]          = active_met_demand
+        unmet_demand[active_cells]        = active_unmet_demand
+
+        # update the number of cells with unmet demand and remaining
+        # availability and assess the exit condition
+        with np.errstate(invalid = 'ignore'):
+            active_mask = (active_unmet_demand > 0) & \
+                          (active_availability.sum(axis = 0) - \
+                           active_withdrawal.sum(axis = 0) > 0)
+        number_cells = np.count_nonzero(active_mask) - \
+                       np.count_nonzero(unmet_demand_mask[active_cells])
+        if len(number_cells_unmet_demand) > 0:
+            number_cells = number_cells + number_cells_unmet_demand[-1]
+        unmet_demand_mask[active_cells] = active_mask
+        number_cells_unmet_demand.append(number_cells)
+
+        exit_condition = number_cells == 0 or \
+                         number_cells == min_number_cells_unmet_demand
+        min_number_cells_unmet_demand = min(min_number_cells_unmet_demand, \
+                                            number_cells)
+
+        # shrink the active cells: zones remain active if they contain cells
+        # with unmet demand and have availability left
+        if not exit_condition:
+            with np.errstate(invalid = 'ignore'):
+                unmet_demand_flag = (active_unmet_demand > 0).astype(np.float64)
+                active_zones = [(zones.get_zonal_values(unmet_demand_flag, np.add, 0.0) > 0) & \
+                                (zones.get_zonal_values(active_availability[ix], np.add, 0.0) > 0) \
+                                for ix, zones in enumerate(zone_indices)]
+            active_cells = np.unique(np.concatenate( \
+                                     [zones.flat_cells[active_zones[ix][zones.labels]] \
+                                      for ix, zones in enumerate(zone_indices)]))
+            zone_indices = [zones.get_subset(active_zones[ix], active_cells) \
+                            for ix, zones in enumerate(zone_indices)]
+            for ix, zones in enumerate(zone_indices):
+                outside_masks[ix] = np.ones(active_cells.size, dtype = bool)
+                outside_masks[ix][zones.cells] = False
+            
+            # no active cells left
+            exit_condition = active_cells.size == 0
+
+    # return the output
+    return withdrawal, allocated_demand, met_demand, unmet_demand, \
+           number_cells_unmet_demand
+
+def allocate_arrays_proportional( \
+                                 demand, \
+                                 availability, \
+                                 zone_indices, \
+                                ):
+    
+    '''
+allocate_arrays_proportional: closed-form alternative to allocate_arrays that \
+assigns the minimum of the demand and the availability proportionally over \
+the zones from the zonal demand and availability per source. If all sources \
+share the same zones, a single pass is exact: the demand in a zone is fully \
+met if the total zonal availability suffices and the availability is other- \
+wise exhausted, so the iterative allocation converges after one iteration. If \
+the zones differ, a single pass is not exact and the iterative allocation is \
+used instead. See allocate_arrays for the input and output.
+
+'''
+
+    # use the iterative allocation if the zones differ
+    global proportional_fallback_logged
+    if not all(zones.has_same_zones(zone_indices[0]) for zones in zone_indices):
+        if not proportional_fallback_logged:
+            logger.warning('the proportional allocation requires the same zones for all sources; ' + \
+                           'the iterative allocation is used instead')
+            proportional_fallback_logged = True
+        return allocate_arrays(demand       = demand, \
+                               availability = availability, \
+                               zone_indices = zone_indices)
+
+    # initialize the output: the availability is copied and updated, the
+    # withdrawal and allocated demand are set to zero where the demand is
+    # defined
+    availability     = np.array(availability, dtype = np.float64)
+    undefined_mask   = ~(demand >= 0)
+    withdrawal       = np.zeros(availability.shape)
+    withdrawal[:, undefined_mask] = np.nan
+    allocated_demand = withdrawal.copy()
+    
+    # set the met and unmet demand
+    met_demand   = np.where(undefined_mask, np.nan, 0.0)
+    unmet_demand = np.maximum(0, demand - met_demand)
+
+    # get the zonal availability and the potential allocation on the basis
+    # of the demand fraction per source, and the allocation ratio
+    zonal_availability = np.stack([zones.get_total(availability[ix]) \
+                                   for ix, zones in enumerate(zone_indices)])
+    zonal_potential_allocation = zonal_availability * \
+                                 np.stack([zones.get_fraction(unmet_demand) \
+                                           for zones in zone_indices])
+    allocation_ratio = np_return_val_div_zero(zonal_potential_allocation, \
+                                              zonal_potential_allocation.sum(axis = 0), \
+                                              very_small_number)
+
+    # get the allocation as the minimum of the potential allocation and
+    # the share of the demand and derive the withdrawal proportionally
+    # from the availability
+    allocation = np.minimum(zonal_potential_allocation, \
+                            allocation_ratio * unmet_demand)
+    increment  = availability * \
+                 np_return_val_div_zero(np.stack([zones.get_total(allocation[ix]) \
+                                                  for ix, zones in enumerate(zone_indices)]), \
+                                        zonal_availability, \
+                                        very_small_number)
+
+    # update the values
+    allocated_demand += allocation
+    withdrawal       += increment
+    availability      = np.maximum(0, availability - increment)
+    met_demand   = allocated_demand.sum(axis = 0)
+    unmet_demand = np.maximum(0, demand - met_demand)
+
+    # get the number of cells with unmet demand and remaining availability
+    with np.errstate(invalid = 'ignore'):
+        number_cells_unmet_demand = [np.count_nonzero((unmet_demand > 0) & \
+                                                      (availability.sum(axis = 0) - \
+                                                       withdrawal.sum(axis = 0) > 0))]
+
     # return the output
-    return withdrawal, allocated_demand, met_demand, unmet_demand, message_str    
+    return withdrawal, allocated_demand, met_demand, unmet_demand, \
+           number_cells_unmet_demand
+
+def allocate_demand_to_availability_np( \
+                                       demand, \
+                                       availability, \
+                                       zones, \
+                                       source_names, \
+                                       kernel = allocate_arrays, \
+                                      ):
+    
+    '''
+allocate_demand_to_availability_np: iterative allocation of the demand to \
+the availability using the vectorized kernel over numpy arrays, or the closed- \
+form kernel if set; the PCRaster fields are converted on entry and on return; \
+see allocate_demand_to_availability for the input and output; instead of the \
+message string, the number of cells with unmet demand and remaining avail- \
+ability per iteration is returned.
+
+'''
+
+    # convert the input and get the zone indices
+    shape = get_clone_shape()
+    zone_indices = [get_zone_index(zones[source_name]) \
+                    for source_name in source_names]
+    withdrawal, allocated_demand, met_demand, unmet_demand, \
+                number_cells_unmet_demand = kernel( \
+                          demand       = pcr_to_array(demand), \
+                          availability = np.stack([pcr_to_array(availability[source_name]) \
+                                                   for source_name in source_names]), \
+                          zone_indices = zone_indices)
+
+    # convert the output
+    withdrawal       = dict((source_name, array_to_pcr(withdrawal[ix], shape)) \
+                            for ix, source_name in enumerate(source_names))
+    allocated_demand = dict((source_name, array_to_pcr(allocated_demand[ix], shape)) \
+                            for ix, source_name in enumerate(source_names))
+
+    # return the output
+    return withdrawal, allocated_demand, array_to_pcr(met_demand, shape), \
+           array_to_pcr(unmet_demand, shape), number_cells_unmet_demand
+
+def allocate_demand_to_availability( \
+                                    demand, \
+                                    availability, \
+                                    zones, \
+                                    source_names, \
+                                    closed_form = False, \
+                                   ):
+    
+    '''
+    
+    Input:
+    ======
+    demand:                 demand per cell as a scalar PCRaster field;
+    availability:           availability per cell per source, same
+                            unit as the total demand and organized as a dict-
+                            ionary with the source names as keys and scalar
+                            PCRaster fields as values; availability can be spec-
+                            ified for any or all cells within a zone;
+    zones:                  zones over which the demand and availability are
+                            totaled; organized as a dictionary with the source 
+                            names as keys and nominal PCRaster fields as values;
+                            these can also be given as zone or local indices;
+    source_names:           list of names of the available sources;
+    closed_form:            if True, the closed-form proportional allocation is
+                            used instead of the iterative allocation (default:
+                            False).
+    
+    Output:
+    =======
+    
+    withdrawal:             withdrawal per cell subdivided over the sour-
+                            ces on the basis of the availability, organized as
+                            a dictionary with the sources as keys and as values
+                            scalar PCRaster fields;
+    allocated_demand:       allocation of the demand subdivided over the sour-
+                            ces on the basis of the availability, organized as
+                            a dictionary with the sources as keys and as values
+                            scalar PCRaster fields;
+    met_demand:             the demand that is met and the sum of the allocat-
+                            ion per source;
+    unmet_demand:           the demand that cannot be met;
+    message_str:            a message string that provides an overview of the
+                            allocation process; empty if the diagnostics are
+                            not enabled.
+    
+'''
+    # allocate the demand in closed form or iteratively, using the vectorized
+    # kernel or the PCRaster fields
+    if closed_form:
+        withdrawal, allocated_demand, met_demand, unmet_demand, \
+                number_cells_unmet_demand = \
+                allocate_demand_to_availability_np(demand       = demand, \
+                                                   availability = availability, \
+                                                   zones        = zones, \
+                                                   source_names = source_names, \
+                                                   kernel       = allocate_arrays_proportional)
+    else:
+        if use_numpy_kernel:
+            allocation_function = allocate_demand_to_availability_np
+        else:
+            allocation_function = allocate_demand_to_availability_pcr
+        withdrawal, allocated_demand, met_demand, unmet_demand, \
+                number_cells_unmet_demand = \
+                allocation_function(demand       = demand, \
+                                    availability = availability, \
+                                    zones        = zones, \
+                                    source_names = source_names)
+
+    # add the iterations and the final statistics to the diagnostics; these
+    # are only computed if the diagnostics are enabled
+    diagnostics = allocation_diagnostics()
+    diagnostics.add_iterations(number_cells_unmet_demand)
+    if diagnostics.enabled:
+        diagnostics.add_message('statistics:', '=' * len('statistics:'))
+        diagnostics.add_statistics( \
+                names  = ['demand', 'met demand', 'unmet demand', \
+                          'alloc. demand', 'total withdrawal'], \
+                fields = [demand, met_demand, unmet_demand, \
+                          sum_list(list(allocated_demand.values())), \
+                          sum_list(list(withdrawal.values()))])
+
+    # return the output
+    return withdrawal, allocated_demand, met_demand, unmet_demand, \
+           diagnostics.format()
 
 def allocate_demand_to_availability_with_options(\
                                                  demand, \
@@ -385,6 +987,7 @@ def allocate_demand_to_availability_with_options(\
                                                  use_local_first, \
                                                  reallocate_surplus, \
                                                  use_allocation_zone = True, \
+                                                 allocation_mode     = 'iterative', \
                                                  ):
     
     '''
@@ -406,7 +1009,13 @@ def allocate_demand_to_availability_with_options(\
     reallocate_surplus    : boolean variable (True, False) indicating that any
                             surplus will be used to satisfy any local demand.
     use_allocation_zone   : boolean variable (True, False) indicating that water
-                            can be pooled from an allocation zone
+                            can be pooled from an allocation zone;
+    allocation_mode       : mode of the zonal allocation, either 'iterative'
+                            (default) or 'proportional'; the closed-form
+                            proportional allocation is only used if the local
+                            resources are not used first and any surplus is
+                            not reallocated, otherwise the allocation is
+                            iterative.
     
     output:
     ======
@@ -422,12 +1031,14 @@ def allocate_demand_to_availability_with_options(\
                             ion per source;
     unmet_demand          : the demand that cannot be met;
     message_str           : a message string that provides an overview of the
-                            allocation process.
+                            allocation process; empty if the diagnostics are
+                            not enabled.
 
 '''
 
     # initialize the output
-    message_str      = 'allocation of demand to availability with options:'
+    diagnostics      = allocation_diagnostics( \
+                           'allocation of demand to availability with options:')
     withdrawal       = dict((source_name, \
                              pcr.ifthen(demand >= 0, pcr.scalar(0))) \
                              for source_name in source_names)
@@ -463,14 +1074,13 @@ def allocate_demand_to_availability_with_options(\
     use_local_first_flag = pcr.cellvalue(pcr.mapmaximum(pcr.scalar(use_local_first)), 1)[0] == 1
     
     if use_local_first_flag:
-        message_str = str.join('\n', \
-                                (message_str, '', \
-                                 '* allocating local resources first:'))
+        diagnostics.add_message('', '* allocating local resources first:')
         
-        # set the temporary zones
-        local_zones = dict((source_name, pcr.ifthen(use_local_first, \
-                                         pcr.nominal(pcr.uniqueid(\
-                                                     use_local_first)))) \
+        # set the temporary zones: each local cell is a zone of its own so
+        # the allocation is elementwise; as all sources share these zones,
+        # the closed-form allocation is exact
+        local_zone_index = local_index(use_local_first)
+        local_zones = dict((source_name, local_zone_index) \
                            for source_name in source_names)
         
         opt_withdrawal, opt_allocated_demand, \
@@ -480,6 +1090,7 @@ def allocate_demand_to_availability_with_options(\
                                                         availability       = remaining_availability, \
                                                         zones              = local_zones, \
                                                         source_names       = source_names, \
+                                                        closed_form        = True, \
                                                         )
 
         # update the values:
@@ -501,9 +1112,8 @@ def allocate_demand_to_availability_with_options(\
                                                           remaining_availability[source_name] - \
                                                           opt_withdrawal[source_name])
 
-        # and update the message_str
-        message_str = str.join('\n', \
-                               (message_str, sub_message_str))
+        # and update the diagnostics
+        diagnostics.add_message(sub_message_str)
 
 
     ##############
@@ -512,9 +1122,13 @@ def allocate_demand_to_availability_with_options(\
     ##############
     # allocate water with the provided zones
     if use_allocation_zone:
-        message_str = str.join('\n', \
-                            (message_str, '', \
-                             '* allocating the available supply over the provided zones:'))
+        diagnostics.add_message('', \
+                                '* allocating the available supply over the provided zones:')
+        
+        # the closed-form proportional allocation applies to the zonal
+        # allocation only
+        closed_form = allocation_mode == 'proportional' and \
+                      not use_local_first_flag and not reallocate_surplus
         
         opt_withdrawal, opt_allocated_demand, \
                         opt_met_demand, unmet_demand, sub_message_str = \
@@ -523,6 +1137,7 @@ def allocate_demand_to_availability_with_options(\
                                                         availability       = remaining_availability, \
                                                         zones              = zones, \
                                                         source_names       = source_names, \
+                                                        closed_form        = closed_form, \
                                                         )
         
         # update the values:
@@ -544,9 +1159,8 @@ def allocate_demand_to_availability_with_options(\
                                                           remaining_availability[source_name] - \
                                                           opt_withdrawal[source_name])
         
-        # and update the message_str
-        message_str = str.join('\n', \
-                               (message_str, sub_message_str))
+        # and update the diagnostics
+        diagnostics.add_message(sub_message_str)
         
     #################
     # surplus       #
@@ -554,9 +1168,8 @@ def allocate_demand_to_availability_with_options(\
     #################
     # reallocate any surplus, if selected
     if reallocate_surplus:
-        message_str = str.join('\n', \
-                                (message_str, '',\
-                                '* allocating any surplus from available supplyresources to satisfy outstanding demand:'))
+        diagnostics.add_message('', \
+                                '* allocating any surplus from available supplyresources to satisfy outstanding demand:')
         
         # free up supply iteratively as follows:
         # 0: initialize the deficit as the unmet demand;
@@ -584,13 +1197,9 @@ def allocate_demand_to_availability_with_options(\
             other_source_names = source_names[:]
             other_source_names.remove(source_name)
             
-            s_str = str.join('', other_source_names)
-            s_str = str.join('', \
-                   ('- processing %s with any surplus for ' %  source_name,\
-                   s_str))
-            message_str = str.join('\n', \
-                                   (message_str, \
-                                    s_str))
+            if diagnostics.enabled:
+                diagnostics.add_message('- processing %s with any surplus for %s' % \
+                                        (source_name, str.join('', other_source_names)))
             
             # get the zonal deficit
             zonal_deficit = get_zonal_total(local_values = deficit, \
@@ -685,50 +1294,222 @@ def allocate_demand_to_availability_with_options(\
                                                           remaining_availability[source_name] - \
                                                           opt_withdrawal[source_name])
         
-        # and update the message_str
-        message_str = str.join('\n', \
-                               (message_str, sub_message_str))        
+        # and update the diagnostics
+        diagnostics.add_message(sub_message_str)
     
     ##########
     # report #
     ##########
-    # final allocation known, add the overall statistics
-    message_str = str.join('\n', \
-                        (message_str, '', \
-                         '* overall allocation of the available supply resources over the provided zones:'))
-    
-    # add the final information to the message string
-    demand_stats             = pcr_get_statistics(demand)
-    met_demand_stats         = pcr_get_statistics(met_demand)
-    unmet_demand_stats       = pcr_get_statistics(pcr.ifthenelse(unmet_demand > 0, unmet_demand, pcr.scalar(0)))
-    total_withdrawal_stats   = pcr_get_statistics(sum_list(list(withdrawal.values())))
-    total_alloc_demand_stats = pcr_get_statistics(sum_list(list(allocated_demand.values())))
-    
-    # update the message_str
-    message_str = str.join('\n', \
-                          (message_str, '',\
-                           '=' * len('statistics:'), \
-                           'statistics:',\
-                           '=' * len('statistics:'), \
-                           '%-20s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                               ('demand', demand_stats['count'], demand_stats['average'], \
-                                demand_stats['min'], demand_stats['max']), \
-                           '%-20s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                               ('met demand', met_demand_stats['count'], met_demand_stats['average'], \
-                                met_demand_stats['min'], met_demand_stats['max']), \
-                           '%-20s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                               ('unmet demand', unmet_demand_stats['count'], unmet_demand_stats['average'], \
-                                unmet_demand_stats['min'], unmet_demand_stats['max']), \
-                           '%-20s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                               ('alloc. demand', total_alloc_demand_stats['count'], total_alloc_demand_stats['average'], \
-                                total_alloc_demand_stats['min'], total_alloc_demand_stats['max']), \
-                           '%-20s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                               ('total withdrawal', total_withdrawal_stats['count'], total_withdrawal_stats['average'], \
-                                total_withdrawal_stats['min'], total_withdrawal_stats['max']), \
-                            ))
-    
+    # final allocation known, add the overall statistics to the diagnostics;
+    # these are only computed if the diagnostics are enabled
+    if diagnostics.enabled:
+        diagnostics.add_message('', \
+                                '* overall allocation of the available supply resources over the provided zones:', \
+                                '', \
+                                '=' * len('statistics:'), \
+                                'statistics:', \
+                                '=' * len('statistics:'))
+        diagnostics.add_statistics( \
+                names       = ['demand', 'met demand', 'unmet demand', \
+                               'alloc. demand', 'total withdrawal'], \
+                fields      = [demand, met_demand, unmet_demand, \
+                               sum_list(list(allocated_demand.values())), \
+                               sum_list(list(withdrawal.values()))], \
+                name_format = '%-20s')
+
     # all options processed, return the output
-    return withdrawal, allocated_demand, met_demand, unmet_demand, message_str
+    return withdrawal, allocated_demand, met_demand, unmet_demand, \
+           diagnostics.format()
+
+def allocate_withdrawal_to_sectors_pcr(withdrawal, \
+                                       demand, \
+                                       zones, \
+                                       sector_names):
+
+    '''
+allocate_withdrawal_to_sectors_pcr: allocates the withdrawal per sector to the \
+demand per sector over the zones per sector using PCRaster fields, processing \
+the sectors one by one; see allocate_withdrawal_to_sectors for the input and \
+output.
+
+'''
+
+    # initialize the output
+    allocated_demand    = {}
+    required_withdrawal = {}
+
+    # allocate the withdrawals to the demand per sector
+    for sector_name in sector_names:
+
+        # set the total zonal withdrawal per sector
+        total_zonal_withdrawal = get_zonal_total( \
+                                        local_values = withdrawal[sector_name], \
+                                        zones        = zones[sector_name])
+
+        # get the allocated withdrawals per cell based on the fractional
+        # total demand per sector and the total zonal withdrawals; this may
+        # exceed the demand if the withdrawal is plenty
+        allocated_withdrawal = total_zonal_withdrawal * \
+                               get_zonal_fraction( \
+                                        local_values = demand[sector_name], \
+                                        zones        = zones[sector_name])
+
+        # allocate the withdrawals to the demand; this returns the amount of
+        # withdrawals that are applied locally
+        allocated_demand[sector_name] = pcr.min(allocated_withdrawal, \
+                                                demand[sector_name])
+
+        # the withdrawal that is required is dependent on the ratio of the
+        # zonal totals of the allocated demand and the total zonal withdrawal
+        required_withdrawal[sector_name] = \
+            withdrawal[sector_name] * \
+            pcr.min(1.0, \
+                    pcr_return_val_div_zero( \
+                                            get_zonal_total( \
+                                                            local_values = allocated_demand[sector_name], \
+                                                            zones        = zones[sector_name]), \
+                                            total_zonal_withdrawal, \
+                                            very_small_number))
+
+    # return the output
+    return allocated_demand, required_withdrawal
+
+def allocate_withdrawal_arrays(withdrawal, demand, zones):
+
+    '''
+allocate_withdrawal_arrays: vectorized kernel of the allocation of the \
+withdrawal to the demand over the zones; the values of all sectors that share \
+the same zones are stacked so that each zonal total is obtained as a single \
+segmented reduction over the stack.
+
+    Input:
+    ======
+    withdrawal:             withdrawal per sector and cell as an array of shape
+                            (n_sectors, n_cells);
+    demand:                 demand per sector and cell as an array of shape
+                            (n_sectors, n_cells), same unit as the withdrawal;
+    zones:                  zone index of the zones shared by the sectors.
+
+    Output:
+    =======
+    allocated_demand:       allocated demand per sector and cell as an array of
+                            shape (n_sectors, n_cells);
+    required_withdrawal:    required withdrawal per sector and cell as an array
+                            of shape (n_sectors, n_cells).
+
+'''
+
+    # get the total zonal withdrawal and the allocated withdrawals on the
+    # basis of the fractional demand; this may exceed the demand
+    total_zonal_withdrawal = zones.get_total(withdrawal)
+    allocated_withdrawal   = total_zonal_withdrawal * zones.get_fraction(demand)
+
+    # allocate the withdrawals to the demand and get the required withdrawal
+    allocated_demand    = np.minimum(allocated_withdrawal, demand)
+    required_withdrawal = withdrawal * \
+                          np.minimum(1.0, \
+                                     np_return_val_div_zero( \
+                                                zones.get_total(allocated_demand), \
+                                                total_zonal_withdrawal, \
+                                                very_small_number))
+
+    # return the output
+    return allocated_demand, required_withdrawal
+
+def allocate_withdrawal_to_sectors_np(withdrawal, \
+                                      demand, \
+                                      zones, \
+                                      sector_names):
+
+    '''
+allocate_withdrawal_to_sectors_np: allocates the withdrawal per sector to the \
+demand per sector using the vectorized kernel; the sectors are grouped by \
+their zone map so that all sectors in a group are processed in one pass; see \
+allocate_withdrawal_to_sectors for the input and output.
+
+'''
+
+    # initialize the output
+    allocated_demand    = {}
+    required_withdrawal = {}
+
+    # group the sectors by their zone map, keeping the order of the sectors
+    sector_groups = {}
+    for sector_name in sector_names:
+        key = id(zones[sector_name])
+        if key not in sector_groups:
+            sector_groups[key] = []
+        sector_groups[key].append(sector_name)
+
+    # process the groups of sectors
+    for group_names in sector_groups.values():
+
+        # get the zone index and allocate the stacked values
+        zone_indices = get_zone_index(zones[group_names[0]])
+        group_allocated_demand, group_required_withdrawal = \
+            allocate_withdrawal_arrays( \
+                withdrawal = np.stack([pcr_to_array(withdrawal[sector_name]) \
+                                       for sector_name in group_names]), \
+                demand     = np.stack([pcr_to_array(demand[sector_name]) \
+                                       for sector_name in group_names]), \
+                zones      = zone_indices)
+
+        # convert the output
+        for ix, sector_name in enumerate(group_names):
+            allocated_demand[sector_name]    = \
+                array_to_pcr(group_allocated_demand[ix], zone_indices.shape)
+            required_withdrawal[sector_name] = \
+                array_to_pcr(group_required_withdrawal[ix], zone_indices.shape)
+
+    # return the output
+    return allocated_demand, required_withdrawal
+
+def allocate_withdrawal_to_sectors(withdrawal, \
+                                   demand, \
+                                   zones, \
+                                   sector_names):
+
+    '''
+allocate_withdrawal_to_sectors: allocates the withdrawal per sector to the \
+demand per sector over the zones per sector; the sectors are independent and \
+are processed in batches per zone map if the vectorized kernel is set by the \
+allocation kernel (see set_allocation_kernel).
+
+    Input:
+    ======
+    withdrawal:             withdrawal per sector, organized as a dictionary
+                            with the sector names as keys and scalar PCRaster
+                            fields as values;
+    demand:                 outstanding demand per sector, organized as the
+                            withdrawal and with the same unit;
+    zones:                  zones over which the withdrawal is allocated, or-
+                            ganized as a dictionary with the sector names as
+                            keys and nominal PCRaster fields as values;
+    sector_names:           list of the names of the sectors.
+
+    Output:
+    =======
+    allocated_demand:       the demand that is met per sector, organized as a
+                            dictionary with the sector names as keys and scalar
+                            PCRaster fields as values;
+    required_withdrawal:    the withdrawal that is required to meet the alloc-
+                            ated demand per sector, organized as the allocated
+                            demand.
+
+'''
+
+    # allocate the withdrawals, using the vectorized kernel or the PCRaster
+    # fields
+    if use_numpy_kernel:
+        allocation_function = allocate_withdrawal_to_sectors_np
+    else:
+        allocation_function = allocate_withdrawal_to_sectors_pcr
+
+    # return the output
+    return allocation_function(withdrawal   = withdrawal, \
+                               demand       = demand, \
+                               zones        = zones, \
+                               sector_names = sector_names)
 
 def allocate_demand_to_withdrawals(withdrawal_names, \
                                    source_names, \
@@ -799,7 +1580,8 @@ def allocate_demand_to_withdrawals(withdrawal_names, \
                             demand per sector that is actually met;
     message_str:            a message string that provides an overview of the
                             allocation process, including the number of iter-
-                            ations and the allocated supply/demand.
+                            ations and the allocated supply/demand; empty if
+                            the diagnostics are not enabled.
     
     The package requires all input to be compatible with spatial, scalar PCRaster
     fields and the values of supply and demand to have the same value, being volume
@@ -807,7 +1589,8 @@ def allocate_demand_to_withdrawals(withdrawal_names, \
     '''
     
     # initialize the output
-    message_str = 'allocation of demand to supply with water quality:'
+    diagnostics = allocation_diagnostics( \
+                      'allocation of demand to supply with water quality:')
     
     # initialize the variables
     # allocated withdrawal  and demand per sector, grouped per withdrawal and source
@@ -835,23 +1618,23 @@ def allocate_demand_to_withdrawals(withdrawal_names, \
                                              pcr.scalar(0))) \
                                  for sector_name in sector_names)
     
-    # total remaining withdrawal and demand per source
-    remaining_withdrawal_per_source_sector = {'renewable'   : deepcopy(renewable_withdrawal_per_sector), \
-                                              'nonrenewable': deepcopy(nonrenewable_withdrawal_per_sector)}
-    
-    remaining_demand_per_sector = deepcopy(demand_per_sector)
+    # total remaining withdrawal per source; only the dictionaries are copied
+    # as the fields are replaced and not modified when updated
+    remaining_withdrawal_per_source_sector = {'renewable'   : copy_dicts(renewable_withdrawal_per_sector), \
+                                              'nonrenewable': copy_dicts(nonrenewable_withdrawal_per_sector)}
     
     # allocate water withdrawn to pixels
-    # 1st: local use, using single cell IDs as allocation zones
+    # 1st: local use, using single cells as allocation zones
     # 2nd: actual allocation zones
     
     # initializing local allocation parameters
     use_local_first = pcr.spatial(use_local_first)
     use_local_first_flag = pcr.cellvalue(pcr.mapmaximum(pcr.scalar(use_local_first)), 1)[0] == 1
+    # the local zones are shared by all sources and sectors; each local cell
+    # is a zone of its own so that the allocation is elementwise
+    local_zone_index = local_index(use_local_first)
     local_zones = dict((source_name, \
-                        dict((sector_name, \
-                              pcr.ifthen(use_local_first, \
-                                         pcr.nominal(pcr.uniqueid(use_local_first)))) \
+                        dict((sector_name, local_zone_index) \
                              for sector_name in sector_names)) \
                        for source_name in source_names)
     
@@ -866,95 +1649,56 @@ def allocate_demand_to_withdrawals(withdrawal_names, \
         
         # process if the option is True
         if option_flag:
-            # add the option to the message string
-            message_str = str.join('\n', \
-                                  (message_str, '', \
-                                   '* %s:' % option_str))
+            # add the option to the diagnostics
+            diagnostics.add_message('', '* %s:' % option_str)
             
             # evaluate per withdrawal and source
             for withdrawal_name in withdrawal_names:
                 for source_name in source_names:
                     
-                    # add the option to the message string
-                    message_str = str.join('\n', \
-                                          (message_str, \
-                                           '- allocating demand to %s %s withdrawal' % \
-                                           (withdrawal_name, source_name)))
-                    
-                    # initialize variable
-                    actual_allocated_withdrawal = pcr.scalar(0)
+                    # add the option to the diagnostics
+                    if diagnostics.enabled:
+                        diagnostics.add_message('- allocating demand to %s %s withdrawal' % \
+                                                (withdrawal_name, source_name))
                     
                     # set the key
                     key = get_key([withdrawal_name, source_name])
                     
-                    # allocate the withdrawals to the demand per sector
+                    # allocate the withdrawals to the outstanding demand of
+                    # all sectors; this returns the amount of withdrawals that
+                    # are applied locally per sector from the current supply
+                    # and source and the withdrawal that this requires
+                    allocated_withdrawal_demand, required_allocated_withdrawal = \
+                        allocate_withdrawal_to_sectors( \
+                            withdrawal   = remaining_withdrawal_per_source_sector[withdrawal_name][source_name], \
+                            demand       = dict((sector_name, \
+                                                 pcr.max(0, \
+                                                         demand_per_sector[sector_name] - met_demand_per_sector[sector_name])) \
+                                                for sector_name in sector_names), \
+                            zones        = option_zones[source_name], \
+                            sector_names = sector_names)
+                    
+                    # update the totals per sector
                     for sector_name in sector_names:
                         
-                        # set the total zonal withdrawal per sector
-                        total_zonal_withdrawal = \
-                            get_zonal_total( \
-                                            local_values = remaining_withdrawal_per_source_sector\
-                                                           [withdrawal_name][source_name][sector_name], \
-                                            zones        = option_zones[source_name][sector_name])
-                        
-                        # get the allocated withdrawals per cell based on
-                        # the fractional total demand per sector and the total zonal withdrawals;
-                        # this may exceed the demand if the withdrawal is plenty
-                        allocated_withdrawal = \
-                            total_zonal_withdrawal * \
-                            get_zonal_fraction( \
-                                               local_values = pcr.max(0, \
-                                                                      demand_per_sector[sector_name] - met_demand_per_sector[sector_name]), \
-                                               zones        = option_zones[source_name][sector_name])
-                        
-                        # allocate the withdrawals to the demand; this returns
-                        # the amount of withdrawals that are applied locally
-                        # for the current sector from the current supply
-                        # and source; this is a local value in the loop, 
-                        # which is subsequently added to the allocated demand
-                        # per sector
-                        allocated_withdrawal_demand = \
-                            pcr.min(allocated_withdrawal, \
-                                    pcr.max(0, \
-                                            demand_per_sector[sector_name] - met_demand_per_sector[sector_name]))
-                        
-                        # update the totals: allocated supply per sector
-                        # the supply that is required is dependent on the supply
-                        # allocated to the demand on the ratio of the zonal totals
-                        # of the allocated_withdrawal_demand and the total zonal
-                        # supply;
-                        # updated here too are the allocated supply per section and
-                        # the actual_allocated_withdrawal
-                        required_allocated_withdrawal = \
-                            remaining_withdrawal_per_source_sector[withdrawal_name][source_name][sector_name] * \
-                            pcr.min(1.0, \
-                                    pcr_return_val_div_zero( \
-                                                            get_zonal_total( \
-                                                                            local_values = allocated_withdrawal_demand, \
-                                                                            zones        = option_zones[source_name][sector_name]), \
-                                                            total_zonal_withdrawal, \
-                                                            very_small_number))
-                        
                         # update the totals
                         # - allocated demand per sector
                         # - met demand per sector
-                        # - actual allocated withdrawal
+                        # - allocated withdrawal per sector
                         allocated_demand_per_sector[key][sector_name] += \
-                               allocated_withdrawal_demand
+                               allocated_withdrawal_demand[sector_name]
                         
                         met_demand_per_sector[sector_name] += \
-                               allocated_withdrawal_demand
+                               allocated_withdrawal_demand[sector_name]
                         
                         allocated_withdrawal_per_sector[key][sector_name] += \
-                               required_allocated_withdrawal
-                        
-                        actual_allocated_withdrawal += \
-                               required_allocated_withdrawal
+                               required_allocated_withdrawal[sector_name]
                         
                         # update remaining withdrawal
                         remaining_withdrawal_per_source_sector[withdrawal_name][source_name][sector_name] = \
                             pcr.max(0.0, \
-                                    remaining_withdrawal_per_source_sector[withdrawal_name][source_name][sector_name] - required_allocated_withdrawal)
+                                    remaining_withdrawal_per_source_sector[withdrawal_name][source_name][sector_name] - \
+                                    required_allocated_withdrawal[sector_name])
     
     # aggregating results
     remaining_withdrawal_per_source = {}
@@ -966,84 +1710,63 @@ def allocate_demand_to_withdrawals(withdrawal_names, \
     
     # .........................................................................................
     # add the statistics on the withdrawal, remaining withdrawal, demand and met demand
-    # final allocation known, add the overall statistics
-    message_str = str.join('\n', \
-                           (message_str, '', \
-                            '* overall allocation of the supply to meet demand over the provided zones:'))
-    
-    # add the final information to the message string
-    # demand and allocation
-    for sector_name in sector_names:
+    # final allocation known, add the overall statistics; these are only
+    # computed if the diagnostics are enabled
+    if diagnostics.enabled:
+        diagnostics.add_message('', \
+                                '* overall allocation of the supply to meet demand over the provided zones:')
         
-        # get the total and the unmet demand
-        demand_stats     = pcr_get_statistics(demand_per_sector[sector_name])
-        met_demand_stats = pcr_get_statistics(met_demand_per_sector[sector_name])
+        # demand and allocation
+        for sector_name in sector_names:
+            
+            # add the total and the met demand
+            diagnostics.add_message('', \
+                                    '=' * len('statistics - %s demand:' % sector_name), \
+                                    'statistics - %s demand:' % sector_name, \
+                                    '=' * len('statistics - %s demand:' % sector_name))
+            diagnostics.add_statistics( \
+                    names       = ['demand', 'met demand'], \
+                    fields      = [demand_per_sector[sector_name], \
+                                   met_demand_per_sector[sector_name]], \
+                    name_format = '-%60s')
+            
+            # add the allocated supply and demand per sector
+            names  = []
+            fields = []
+            for withdrawal_name in withdrawal_names:
+                for source_name in source_names:
+                    key = get_key([withdrawal_name, source_name])
+                    key_str = get_key([sector_name, 'from', key])
+                    names.extend(['%s - %s' % ('supply', key_str), \
+                                  '%s - %s' % ('demand', key_str)])
+                    fields.extend([allocated_withdrawal_per_sector[key][sector_name], \
+                                   allocated_demand_per_sector[key][sector_name]])
+            diagnostics.add_statistics(names       = names, \
+                                       fields      = fields, \
+                                       name_format = '%-60s')
         
-        # update the message_str
-        message_str = str.join('\n', \
-                               (message_str, '', \
-                                '=' * len('statistics - %s demand:' % sector_name), \
-                                'statistics - %s demand:' % sector_name,\
-                                '=' * len('statistics - %s demand:' % sector_name), \
-                                     '-%60s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                                         ('demand', demand_stats['count'], demand_stats['average'], \
-                                         demand_stats['min'], demand_stats['max']), \
-                                     '-%60s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                                         ('met demand', met_demand_stats['count'], met_demand_stats['average'], \
-                                         met_demand_stats['min'], met_demand_stats['max'])))
+        # overall supply
+        diagnostics.add_message('', \
+                                '=' * len('statistics - supply'), \
+                                'statistics - supply', \
+                                '=' * len('statistics - supply'))
         
-        # get the allocated supply and demand per sector
+        withdrawal_per_source = {'renewable'   : renewable_withdrawal_per_sector, \
+                                 'nonrenewable': nonrenewable_withdrawal_per_sector}
         for withdrawal_name in withdrawal_names:
             for source_name in source_names:
-                key = get_key([withdrawal_name, source_name])
-                key_str = get_key([sector_name, 'from', key])
-                
-                # statistics on withdrawal and demand
-                withdrawal_stats = pcr_get_statistics(allocated_withdrawal_per_sector[key][sector_name])
-                demand_stats = pcr_get_statistics(allocated_demand_per_sector[key][sector_name])
-                
-                # update the message_str
-                message_str = str.join('\n', \
-                                       (message_str, \
-                                        '%-60s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                                            ('%s - %s' % ('supply', key_str), withdrawal_stats['count'], withdrawal_stats['average'], \
-                                            withdrawal_stats['min'], withdrawal_stats['max']), \
-                                        '%-60s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                                            ('%s - %s' % ('demand', key_str), demand_stats['count'], demand_stats['average'], \
-                                            demand_stats['min'], demand_stats['max'])))
-    
-    # overall supply
-    message_str = str.join('\n', \
-                           (message_str, '', \
-                            '=' * len('statistics - supply'), \
-                                    'statistics - supply', \
-                                    '=' * len('statistics - supply')))
-    
-    for withdrawal_name in withdrawal_names:
-        for source_name in source_names:
-            for sector_name in sector_names:
-                # statistics on supply
-                withdrawal_per_source = {'renewable'   : renewable_withdrawal_per_sector, \
-                                         'nonrenewable': nonrenewable_withdrawal_per_sector}
-                total_withdrawal_stats     = pcr_get_statistics(withdrawal_per_source[withdrawal_name][source_name][sector_name])
-                remaining_withdrawal_stats = pcr_get_statistics(remaining_withdrawal_per_source_sector[withdrawal_name][source_name][sector_name])
-                
-                # update the message_str
-                message_str = str.join('\n', \
-                            (message_str, '', \
-                              '%-60s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                                  ('total supply %s - %s - %s' % (withdrawal_name, source_name, sector_name),  \
-                                  total_withdrawal_stats['count'], total_withdrawal_stats['average'], \
-                                  total_withdrawal_stats['min'], total_withdrawal_stats['max']), \
-                              '%-60s - count: %6d - avg.: %10g - min: %10g - max: %10g' % \
-                                  ('remaining supply %s - %s - %s' % (withdrawal_name, source_name, sector_name), \
-                                  remaining_withdrawal_stats['count'], remaining_withdrawal_stats['average'], \
-                                  remaining_withdrawal_stats['min'], remaining_withdrawal_stats['max'])))
-    
-    # add a blank line at last
-    message_str = str.join('\n', \
-                           (message_str, ''))
+                for sector_name in sector_names:
+                    diagnostics.add_message('')
+                    diagnostics.add_statistics( \
+                            names       = ['total supply %s - %s - %s' % (withdrawal_name, source_name, sector_name), \
+                                           'remaining supply %s - %s - %s' % (withdrawal_name, source_name, sector_name)], \
+                            fields      = [withdrawal_per_source[withdrawal_name][source_name][sector_name], \
+                                           remaining_withdrawal_per_source_sector[withdrawal_name][source_name][sector_name]], \
+                            name_format = '%-60s')
+        
+        # add a blank line at last
+        diagnostics.add_message('')
     
     # return the allocated demand, the 
     return allocated_withdrawal_per_sector, remaining_withdrawal_per_source, \
-           allocated_demand_per_sector, met_demand_per_sector, message_str
+           allocated_demand_per_sector, met_demand_per_sector, diagnostics.format()
@@ -0,0 +1,808 @@
+#!/usr/bin/python
+
+"""
+
+allocation_benchmark.py: micro-benchmark of the allocation functions of the \
+QUAlloc model on synthetic clones; the clones are generated with a config- \
+urable size, number of zones, sources and sectors and distribution of the \
+demand and availability. All allocation entry points are timed and the \
+iteration counts, the cost per iteration and the peak memory are reported and \
+written to a JSON file so that the results can be compared between releases; \
+the increase of the peak resident set size of each entry point is measured in \
+a separate process that is forked for that entry point only.
+In the compare mode, the vectorized kernels are not timed but compared with \
+the allocation with PCRaster fields on the same synthetic clones instead.
+In the copies mode, the entry points are timed and measured both with the \
+dictionaries of PCRaster fields copied by copy_dicts, as in the model, and \
+with these deep-copied, as before copy_dicts was introduced.
+
+usage: python allocation_benchmark.py [options] [OUTPUTFILE]
+
+e.g. python allocation_benchmark.py -s 100x100,540x1080 -z 250 benchmark.json
+     python allocation_benchmark.py --compare --distinct_zones
+     python allocation_benchmark.py --copies --pcr_kernel -s 540x1080
+
+"""
+
+###########
+# modules #
+###########
+#-general modules and packages
+import os
+import sys
+import json
+import time
+import optparse
+import platform
+import resource
+import tracemalloc
+import multiprocessing
+
+from copy import deepcopy
+
+import numpy as np
+import pcraster as pcr
+
+# specific packages
+import allocation
+
+from allocation import allocate_demand_to_availability, \
+                       allocate_demand_to_availability_with_options, \
+                       allocate_demand_to_withdrawals, \
+                       allocate_demand_to_availability_np, \
+                       allocate_demand_to_availability_pcr, \
+                       allocate_arrays_proportional, \
+                       allocate_withdrawal_to_sectors_np, \
+                       allocate_withdrawal_to_sectors_pcr, \
+                       set_allocation_kernel
+from basic_functions import copy_dicts
+from zonal_aggregation import clear_zone_indices
+
+####################
+# global variables #
+####################
+
+# type set to identify None (compatible with pytyon 2.x)
+NoneType = type(None)
+
+# default settings of the benchmark
+default_clone_sizes      = '100x100,360x720'
+default_number_zones     = 100
+default_source_names     = 'groundwater,surfacewater'
+default_sector_names     = 'irrigation,domestic,livestock,manufacture,thermoelectric'
+default_distribution     = 'lognormal'
+default_availability_ratio = 1.0
+default_land_fraction    = 0.3
+default_zero_fraction    = 0.2
+default_repeats          = 3
+default_seed             = 1
+
+# relative and absolute tolerance of the comparison of the kernels
+default_rtol             = 1.0e-6
+default_atol             = 1.0e-9
+
+# distributions of the demand and availability
+allowed_distributions = ['uniform', 'exponential', 'lognormal']
+
+# cell size and origin of the synthetic clones
+cell_size = 1.0 / 12
+west      = -180.0
+north     =   90.0
+
+# missing values of the synthetic maps
+nominal_mv = -1
+scalar_mv  = -999.9
+
+#############
+# functions #
+#############
+
+def parse_clone_sizes(clone_sizes_str):
+
+    '''
+parse_clone_sizes: returns the list of clone sizes as tuples of the number \
+of rows and columns from a string of entries of the form ROWSxCOLS that are \
+separated by commas.
+
+'''
+
+    # return the clone sizes
+    return [tuple(int(value) for value in clone_size_str.lower().split('x')) \
+            for clone_size_str in clone_sizes_str.split(',')]
+
+def get_random_values(rng, distribution, shape, zero_fraction):
+
+    '''
+get_random_values: returns random values of the specified distribution with \
+a unit mean, of which a fraction is set to zero.
+
+'''
+
+    # get the values
+    if distribution == 'uniform':
+        values = rng.uniform(0.0, 2.0, shape)
+    elif distribution == 'exponential':
+        values = rng.exponential(1.0, shape)
+    else:
+        values = rng.lognormal(-0.5, 1.0, shape)
+
+    # set the zero values
+    values[rng.random(shape) < zero_fraction] = 0.0
+
+    # return the values
+    return values
+
+def create_synthetic_clone(number_rows, number_cols, number_zones, \
+                           source_names, sector_names, distribution, \
+                           availability_ratio, land_fraction, zero_fraction, \
+                           distinct_zones, seed):
+
+    '''
+create_synthetic_clone: sets the clone to the specified size and returns the \
+synthetic maps of the allocation as PCRaster fields.
+
+    Input:
+    ======
+    number_rows, number_cols:
+                            size of the clone;
+    number_zones:           approximate number of zones, which are obtained
+                            as a tiling of the clone;
+    source_names:           names of the sources;
+    sector_names:           names of the sectors;
+    distribution:           distribution of the demand and availability;
+    availability_ratio:     ratio of the total availability over all sources
+                            to the total demand;
+    land_fraction:          fraction of the cells that is land, the other
+                            cells are missing;
+    zero_fraction:          fraction of the cells with zero demand or avail-
+                            ability;
+    distinct_zones:         if True, the zones of the sources are shifted with
+                            respect to each other;
+    seed:                   seed of the random generator.
+
+    Output:
+    =======
+    clone_maps:             dictionary with the landmask, the demand, the
+                            demand per sector, the availability per source,
+                            the renewable and non-renewable withdrawal per
+                            source and sector and the zones per source and
+                            sector.
+
+'''
+
+    # set the clone
+    pcr.setclone(number_rows, number_cols, cell_size, west, north)
+    rng = np.random.default_rng(seed)
+    shape = (number_rows, number_cols)
+    number_sources = len(source_names)
+    number_sectors = len(sector_names)
+
+    # get the landmask; the first cell is always land
+    land_mask = rng.random(shape) < land_fraction
+    land_mask.flat[0] = True
+
+    # get the zones as a tiling of the clone
+    number_zone_rows = max(1, int(round((number_zones * number_rows / float(number_cols)) ** 0.5)))
+    number_zone_cols = max(1, int(np.ceil(number_zones / float(number_zone_rows))))
+    rows, cols = np.indices(shape)
+    zone_maps = {}
+    for ix, source_name in enumerate(source_names):
+        offset = 0
+        if distinct_zones:
+            offset = ix * number_cols // (2 * number_zone_cols * number_sources)
+        zone_ids = (rows * number_zone_rows // number_rows) * number_zone_cols + \
+                   ((cols + offset) % number_cols) * number_zone_cols // number_cols + 1
+        zone_ids = np.where(land_mask, zone_ids, nominal_mv)
+        if ix == 0 or distinct_zones:
+            zone_map = pcr.numpy2pcr(pcr.Nominal, zone_ids.astype(np.int32), nominal_mv)
+        zone_maps[source_name] = zone_map
+
+    # get the demand per sector and the availability and withdrawals per
+    # source, scaled to the total demand
+    def get_field(values):
+        return pcr.numpy2pcr(pcr.Scalar, \
+                             np.where(land_mask, values, scalar_mv), scalar_mv)
+
+    demand_per_sector = dict((sector_name, \
+                              get_random_values(rng, distribution, shape, zero_fraction) / \
+                              number_sectors) \
+                             for sector_name in sector_names)
+    availability = dict((source_name, \
+                         get_random_values(rng, distribution, shape, zero_fraction) * \
+                         availability_ratio / number_sources) \
+                        for source_name in source_names)
+    withdrawal_per_sector = dict((withdrawal_name, \
+                                  dict((source_name, \
+                                        dict((sector_name, \
+                                              get_random_values(rng, distribution, shape, zero_fraction) * \
+                                              availability_ratio / (2 * number_sources * number_sectors)) \
+                                             for sector_name in sector_names)) \
+                                       for source_name in source_names)) \
+                                 for withdrawal_name in ['renewable', 'nonrenewable'])
+
+    # set the clone maps
+    clone_maps = {}
+    clone_maps['landmask']          = pcr.numpy2pcr(pcr.Boolean, land_mask.astype(np.uint8), 255)
+    clone_maps['demand']            = get_field(sum(demand_per_sector.values()))
+    clone_maps['demand_per_sector'] = dict((sector_name, get_field(values)) \
+                                           for sector_name, values in demand_per_sector.items())
+    clone_maps['availability']      = dict((source_name, get_field(values)) \
+                                           for source_name, values in availability.items())
+    clone_maps['withdrawal_per_sector'] = \
+                    dict((withdrawal_name, \
+                          dict((source_name, \
+                                dict((sector_name, get_field(values)) \
+                                     for sector_name, values in sector_values.items())) \
+                               for source_name, sector_values in source_values.items())) \
+                         for withdrawal_name, source_values in withdrawal_per_sector.items())
+    clone_maps['zones']             = zone_maps
+    clone_maps['zones_per_sector']  = dict((source_name, \
+                                            dict((sector_name, zone_maps[source_name]) \
+                                                 for sector_name in sector_names)) \
+                                           for source_name in source_names)
+
+    # return the clone maps
+    return clone_maps
+
+def get_number_iterations(clone_maps, source_names, closed_form):
+
+    '''
+get_number_iterations: returns the number of iterations of the allocation of \
+the demand to the availability for the synthetic clone.
+
+'''
+
+    # get the number of cells with unmet demand per iteration
+    if closed_form:
+        number_cells_unmet_demand = allocate_demand_to_availability_np( \
+                        demand       = clone_maps['demand'], \
+                        availability = clone_maps['availability'], \
+                        zones        = clone_maps['zones'], \
+                        source_names = source_names, \
+                        kernel       = allocate_arrays_proportional)[-1]
+    elif allocation.use_numpy_kernel:
+        number_cells_unmet_demand = allocate_demand_to_availability_np( \
+                        demand       = clone_maps['demand'], \
+                        availability = clone_maps['availability'], \
+                        zones        = clone_maps['zones'], \
+                        source_names = source_names)[-1]
+    else:
+        number_cells_unmet_demand = allocate_demand_to_availability_pcr( \
+                        demand       = clone_maps['demand'], \
+                        availability = clone_maps['availability'], \
+                        zones        = clone_maps['zones'], \
+                        source_names = source_names)[-1]
+
+    # return the number of iterations
+    return len(number_cells_unmet_demand)
+
+def compare_fields(name, fields, reference_fields, rtol, atol):
+
+    '''
+compare_fields: compares the PCRaster fields, or dictionaries of these, with \
+the reference fields and returns the result as a dictionary with the name, \
+the maximum absolute difference and whether the fields agree within the \
+tolerances; missing values should coincide.
+
+'''
+
+    # get the fields as a stack of arrays
+    if isinstance(fields, dict):
+        keys = sorted(reference_fields.keys())
+        fields = [fields[key] for key in keys]
+        reference_fields = [reference_fields[key] for key in keys]
+    else:
+        fields = [fields]
+        reference_fields = [reference_fields]
+    values = np.stack([pcr.pcr2numpy(field, np.nan) for field in fields])
+    reference_values = np.stack([pcr.pcr2numpy(field, np.nan) for field in reference_fields])
+
+    # compare the values
+    differences = np.abs(values - reference_values)
+    max_difference = 0.0
+    if np.any(~np.isnan(differences)):
+        max_difference = float(np.nanmax(differences))
+
+    # return the comparison
+    return {'name'          : name, \
+            'max_difference': max_difference, \
+            'agrees'        : bool(np.allclose(values, reference_values, \
+                                               rtol = rtol, atol = atol, \
+                                               equal_nan = True))}
+
+def run_comparison(clone_size, number_zones, source_names, sector_names, \
+                   distribution, availability_ratio, land_fraction, \
+                   zero_fraction, distinct_zones, seed, rtol, atol):
+
+    '''
+run_comparison: compares the vectorized kernels with the allocation with \
+PCRaster fields for a synthetic clone and returns the results as a list of \
+dictionaries; the closed-form proportional allocation is compared with the \
+iterative allocation as well, which it should match.
+
+'''
+
+    # create the synthetic clone and clear any zone indices of earlier clones
+    clear_zone_indices()
+    number_rows, number_cols = clone_size
+    clone_maps = create_synthetic_clone( \
+                        number_rows        = number_rows, \
+                        number_cols        = number_cols, \
+                        number_zones       = number_zones, \
+                        source_names       = source_names, \
+                        sector_names       = sector_names, \
+                        distribution       = distribution, \
+                        availability_ratio = availability_ratio, \
+                        land_fraction      = land_fraction, \
+                        zero_fraction      = zero_fraction, \
+                        distinct_zones     = distinct_zones, \
+                        seed               = seed)
+    keywords = {'demand'       : clone_maps['demand'], \
+                'availability' : clone_maps['availability'], \
+                'zones'        : clone_maps['zones'], \
+                'source_names' : source_names}
+
+    # allocate the demand to the availability with all kernels
+    reference_output   = allocate_demand_to_availability_pcr(**keywords)
+    numpy_output       = allocate_demand_to_availability_np(**keywords)
+    closed_form_output = allocate_demand_to_availability_np( \
+                                 kernel = allocate_arrays_proportional, **keywords)
+
+    # allocate the withdrawal to the sectors with both kernels
+    source_name = source_names[0]
+    withdrawal_keywords = { \
+            'withdrawal'   : clone_maps['withdrawal_per_sector']['renewable'][source_name], \
+            'demand'       : clone_maps['demand_per_sector'], \
+            'zones'        : clone_maps['zones_per_sector'][source_name], \
+            'sector_names' : sector_names}
+    reference_withdrawal_output = allocate_withdrawal_to_sectors_pcr(**withdrawal_keywords)
+    numpy_withdrawal_output     = allocate_withdrawal_to_sectors_np(**withdrawal_keywords)
+
+    # compare the output
+    results = []
+    for kernel, output, reference in [ \
+            ('numpy', numpy_output, reference_output), \
+            ('proportional', closed_form_output, reference_output), \
+            ('numpy sectors', numpy_withdrawal_output, reference_withdrawal_output)]:
+        if kernel == 'numpy sectors':
+            names = ['allocated demand', 'required withdrawal']
+        else:
+            names = ['withdrawal', 'allocated demand', 'met demand', 'unmet demand']
+        for ix, name in enumerate(names):
+            result = compare_fields(name, output[ix], reference[ix], rtol, atol)
+            result.update({'clone_size': [number_rows, number_cols], \
+                           'kernel'    : kernel})
+            results.append(result)
+            print('%-12s %-16s %-20s max. difference: %10.3e - %s' % \
+                  ('%dx%d' % (number_rows, number_cols), kernel, name, \
+                   result['max_difference'], \
+                   'agrees' if result['agrees'] else 'DIFFERS'))
+
+    # return the results
+    return results
+
+def get_max_rss():
+
+    '''returns the peak resident set size of the current process in bytes'''
+
+    # get the peak resident set size; this is in kilobytes on linux and in
+    # bytes on macos
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss = max_rss * 1024
+
+    # return the peak resident set size
+    return max_rss
+
+def send_rss_increase(function, keywords, connection):
+
+    '''
+send_rss_increase: calls the function with the keywords in a child process \
+and sends the increase of the peak resident set size of the child process in \
+bytes over the connection.
+
+'''
+
+    # call the function and send the increase
+    start_rss = get_max_rss()
+    function(**keywords)
+    connection.send(get_max_rss() - start_rss)
+    connection.close()
+
+def get_rss_increase(function, keywords):
+
+    '''
+get_rss_increase: calls the function with the keywords once in a forked child \
+process and returns the increase of the peak resident set size of the child \
+in bytes, which includes the memory allocated by PCRaster; as the peak of a \
+process can only go up, each call is measured in its own child process that \
+starts from the current memory use. Returns None if processes cannot be \
+forked on this platform.
+
+'''
+
+    # check if processes can be forked
+    if not 'fork' in multiprocessing.get_all_start_methods():
+        return None
+
+    # call the function in a child process and receive the increase
+    context = multiprocessing.get_context('fork')
+    parent_connection, child_connection = context.Pipe(duplex = False)
+    process = context.Process(target = send_rss_increase, \
+                              args = (function, keywords, child_connection))
+    process.start()
+    child_connection.close()
+    try:
+        rss_increase = parent_connection.recv()
+    except EOFError:
+        rss_increase = None
+    process.join()
+
+    # return the increase
+    return rss_increase
+
+def time_function(function, keywords, repeats):
+
+    '''
+time_function: calls the function with the keywords repeatedly and returns \
+the elapsed times in seconds, the peak of the memory traced by python, which \
+includes the numpy arrays but not the memory allocated by PCRaster, and the \
+increase of the peak resident set size of a single call in bytes, which is \
+measured in a child process (see get_rss_increase).
+
+'''
+
+    # time the function
+    times = []
+    for repeat in range(repeats):
+        start_time = time.perf_counter()
+        function(**keywords)
+        times.append(time.perf_counter() - start_time)
+
+    # trace the memory in a separate call as tracing slows down the function
+    tracemalloc.start()
+    function(**keywords)
+    peak_traced_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # get the increase of the peak resident set size
+    rss_increase = get_rss_increase(function, keywords)
+
+    # return the timings and the memory use
+    return times, peak_traced_memory, rss_increase
+
+def get_entry_points(clone_maps, source_names, sector_names):
+
+    '''
+get_entry_points: returns the allocation entry points for the synthetic clone \
+as a list of tuples of the name, the mode, the function, the keywords and the \
+closed-form flag for the number of iterations, if applicable.
+
+'''
+
+    no_local_first = pcr.spatial(pcr.boolean(0))
+
+    # set the entry points
+    entry_points = [ \
+        ('allocate_demand_to_availability', 'iterative', \
+         allocate_demand_to_availability, \
+         {'demand'       : clone_maps['demand'], \
+          'availability' : clone_maps['availability'], \
+          'zones'        : clone_maps['zones'], \
+          'source_names' : source_names}, False), \
+        ('allocate_demand_to_availability', 'proportional', \
+         allocate_demand_to_availability, \
+         {'demand'       : clone_maps['demand'], \
+          'availability' : clone_maps['availability'], \
+          'zones'        : clone_maps['zones'], \
+          'source_names' : source_names, \
+          'closed_form'  : True}, True), \
+        ('allocate_demand_to_availability_with_options', 'local first and surplus', \
+         allocate_demand_to_availability_with_options, \
+         {'demand'             : clone_maps['demand'], \
+          'availability'       : clone_maps['availability'], \
+          'zones'              : clone_maps['zones'], \
+          'source_names'       : source_names, \
+          'use_local_first'    : clone_maps['landmask'], \
+          'reallocate_surplus' : True}, None), \
+        ('allocate_demand_to_availability_with_options', 'proportional', \
+         allocate_demand_to_availability_with_options, \
+         {'demand'             : clone_maps['demand'], \
+          'availability'       : clone_maps['availability'], \
+          'zones'              : clone_maps['zones'], \
+          'source_names'       : source_names, \
+          'use_local_first'    : no_local_first, \
+          'reallocate_surplus' : False, \
+          'allocation_mode'    : 'proportional'}, None), \
+        ('allocate_demand_to_withdrawals', 'local first', \
+         allocate_demand_to_withdrawals, \
+         {'withdrawal_names'                   : ['renewable', 'nonrenewable'], \
+          'source_names'                       : source_names, \
+          'sector_names'                       : sector_names, \
+          'demand_per_sector'                  : clone_maps['demand_per_sector'], \
+          'renewable_withdrawal_per_sector'    : clone_maps['withdrawal_per_sector']['renewable'], \
+          'nonrenewable_withdrawal_per_sector' : clone_maps['withdrawal_per_sector']['nonrenewable'], \
+          'zones_per_sector'                   : clone_maps['zones_per_sector'], \
+          'use_local_first'                    : clone_maps['landmask']}, None), \
+        ]
+
+    # return the entry points
+    return entry_points
+
+def run_benchmark(clone_size, number_zones, source_names, sector_names, \
+                  distribution, availability_ratio, land_fraction, \
+                  zero_fraction, distinct_zones, repeats, seed):
+
+    '''
+run_benchmark: runs the benchmark of all allocation entry points for a \
+synthetic clone and returns the results as a list of dictionaries.
+
+'''
+
+    # create the synthetic clone and clear any zone indices of earlier clones
+    clear_zone_indices()
+    number_rows, number_cols = clone_size
+    clone_maps = create_synthetic_clone( \
+                        number_rows        = number_rows, \
+                        number_cols        = number_cols, \
+                        number_zones       = number_zones, \
+                        source_names       = source_names, \
+                        sector_names       = sector_names, \
+                        distribution       = distribution, \
+                        availability_ratio = availability_ratio, \
+                        land_fraction      = land_fraction, \
+                        zero_fraction      = zero_fraction, \
+                        distinct_zones     = distinct_zones, \
+                        seed               = seed)
+    entry_points = get_entry_points(clone_maps, source_names, sector_names)
+
+    # run the benchmark per entry point
+    results = []
+    for name, mode, function, keywords, closed_form in entry_points:
+
+        # time the function and get the number of iterations
+        times, peak_traced_memory, rss_increase = time_function(function, keywords, repeats)
+        number_iterations = None
+        time_per_iteration = None
+        if not isinstance(closed_form, NoneType):
+            number_iterations = get_number_iterations(clone_maps, source_names, closed_form)
+            time_per_iteration = float(np.median(times)) / max(1, number_iterations)
+
+        # add the results
+        results.append({ \
+                        'clone_size'            : [number_rows, number_cols], \
+                        'number_cells'          : number_rows * number_cols, \
+                        'entry_point'           : name, \
+                        'mode'                  : mode, \
+                        'numpy_kernel'          : allocation.use_numpy_kernel, \
+                        'repeats'               : repeats, \
+                        'times'                 : times, \
+                        'min_time'              : min(times), \
+                        'median_time'           : float(np.median(times)), \
+                        'number_iterations'     : number_iterations, \
+                        'time_per_iteration'    : time_per_iteration, \
+                        'peak_traced_memory'    : peak_traced_memory, \
+                        'rss_increase'          : rss_increase, \
+                       })
+        print('%-12s %-46s %-24s median: %10.4f s - iterations: %4s - peak traced: %8.1f MB - rss increase: %8s MB' % \
+              ('%dx%d' % (number_rows, number_cols), name, mode, \
+               results[-1]['median_time'], number_iterations, \
+               peak_traced_memory / 1.0e6, \
+               'n/a' if isinstance(rss_increase, NoneType) else '%.1f' % (rss_increase / 1.0e6)))
+
+    # return the results
+    return results
+
+def run_copy_comparison(clone_size, number_zones, source_names, sector_names, \
+                        distribution, availability_ratio, land_fraction, \
+                        zero_fraction, distinct_zones, repeats, seed):
+
+    '''
+run_copy_comparison: times all allocation entry points for a synthetic clone \
+with the dictionaries of PCRaster fields on the allocation path copied by \
+copy_dicts, which shares the fields, and deep-copied, which duplicates them, \
+and returns the timings and the increase of the peak resident set size as a \
+list of dictionaries.
+
+'''
+
+    # create the synthetic clone and clear any zone indices of earlier clones
+    clear_zone_indices()
+    number_rows, number_cols = clone_size
+    clone_maps = create_synthetic_clone( \
+                        number_rows        = number_rows, \
+                        number_cols        = number_cols, \
+                        number_zones       = number_zones, \
+                        source_names       = source_names, \
+                        sector_names       = sector_names, \
+                        distribution       = distribution, \
+                        availability_ratio = availability_ratio, \
+                        land_fraction      = land_fraction, \
+                        zero_fraction      = zero_fraction, \
+                        distinct_zones     = distinct_zones, \
+                        seed               = seed)
+    entry_points = get_entry_points(clone_maps, source_names, sector_names)
+
+    # run the entry points with both copies; the copy function is replaced
+    # in the allocation module, where the dictionaries are copied
+    results = []
+    for name, mode, function, keywords, closed_form in entry_points:
+        for copy_name, copy_function in [('deepcopy', deepcopy), ('copy_dicts', copy_dicts)]:
+            try:
+                allocation.copy_dicts = copy_function
+                times, peak_traced_memory, rss_increase = time_function(function, keywords, repeats)
+            finally:
+                allocation.copy_dicts = copy_dicts
+
+            # add the results
+            results.append({ \
+                            'clone_size'            : [number_rows, number_cols], \
+                            'number_cells'          : number_rows * number_cols, \
+                            'entry_point'           : name, \
+                            'mode'                  : mode, \
+                            'copy'                  : copy_name, \
+                            'numpy_kernel'          : allocation.use_numpy_kernel, \
+                            'repeats'               : repeats, \
+                            'times'                 : times, \
+                            'min_time'              : min(times), \
+                            'median_time'           : float(np.median(times)), \
+                            'peak_traced_memory'    : peak_traced_memory, \
+                            'rss_increase'          : rss_increase, \
+                           })
+            print('%-12s %-46s %-24s %-10s median: %10.4f s - rss increase: %8s MB' % \
+                  ('%dx%d' % (number_rows, number_cols), name, mode, copy_name, \
+                   results[-1]['median_time'], \
+                   'n/a' if isinstance(rss_increase, NoneType) else '%.1f' % (rss_increase / 1.0e6)))
+
+    # return the results
+    return results
+
+###############################################################################
+# end of functions                                                            #
+###############################################################################
+
+########
+# MAIN #
+########
+
+def main():
+    # parses options and arguments from the command line and runs the
+    # benchmark for all clone sizes
+
+    usage = 'usage: %prog [options] [OUTPUTFILE]'
+    parser = optparse.OptionParser(usage = usage)
+    parser.add_option('-s', '--clone_sizes', dest = 'clone_sizes', \
+                      default = default_clone_sizes, \
+                      help = 'clone sizes as ROWSxCOLS separated by commas [%default]')
+    parser.add_option('-z', '--number_zones', dest = 'number_zones', type = 'int', \
+                      default = default_number_zones, \
+                      help = 'approximate number of zones [%default]')
+    parser.add_option('--sources', dest = 'source_names', \
+                      default = default_source_names, \
+                      help = 'source names separated by commas [%default]')
+    parser.add_option('--sectors', dest = 'sector_names', \
+                      default = default_sector_names, \
+                      help = 'sector names separated by commas [%default]')
+    parser.add_option('-d', '--distribution', dest = 'distribution', \
+                      default = default_distribution, \
+                      help = 'distribution of the demand and availability, any of %s [%%default]' % \
+                             str.join(', ', allowed_distributions))
+    parser.add_option('-a', '--availability_ratio', dest = 'availability_ratio', type = 'float', \
+                      default = default_availability_ratio, \
+                      help = 'ratio of the total availability to the total demand [%default]')
+    parser.add_option('-l', '--land_fraction', dest = 'land_fraction', type = 'float', \
+                      default = default_land_fraction, \
+                      help = 'fraction of the cells that is land [%default]')
+    parser.add_option('--zero_fraction', dest = 'zero_fraction', type = 'float', \
+                      default = default_zero_fraction, \
+                      help = 'fraction of the cells with zero demand or availability [%default]')
+    parser.add_option('--distinct_zones', dest = 'distinct_zones', action = 'store_true', \
+                      default = False, \
+                      help = 'use distinct zones per source')
+    parser.add_option('--pcr_kernel', dest = 'pcr_kernel', action = 'store_true', \
+                      default = False, \
+                      help = 'use the PCRaster fields instead of the vectorized kernel')
+    parser.add_option('--compare', dest = 'compare', action = 'store_true', \
+                      default = False, \
+                      help = 'compare the vectorized kernels with the PCRaster fields instead of timing')
+    parser.add_option('--copies', dest = 'copies', action = 'store_true', \
+                      default = False, \
+                      help = 'time the entry points with deep copies and with copy_dicts of the dictionaries')
+    parser.add_option('--rtol', dest = 'rtol', type = 'float', \
+                      default = default_rtol, \
+                      help = 'relative tolerance of the comparison [%default]')
+    parser.add_option('--atol', dest = 'atol', type = 'float', \
+                      default = default_atol, \
+                      help = 'absolute tolerance of the comparison [%default]')
+    parser.add_option('-r', '--repeats', dest = 'repeats', type = 'int', \
+                      default = default_repeats, \
+                      help = 'number of repeats per entry point [%default]')
+    parser.add_option('--seed', dest = 'seed', type = 'int', \
+                      default = default_seed, \
+                      help = 'seed of the random generator [%default]')
+    (options, arguments) = parser.parse_args()
+
+    # check on values
+    if not options.distribution in allowed_distributions:
+        parser.error('distribution %s is invalid, any of the following allowed: %s' % \
+                     (options.distribution, str.join(', ', allowed_distributions)))
+
+    # set the output file and the kernel
+    output_filename = 'allocation_benchmark.json'
+    if len(arguments) > 0:
+        output_filename = arguments[0]
+    if options.pcr_kernel:
+        set_allocation_kernel('pcraster')
+    else:
+        set_allocation_kernel('numpy')
+
+    # run the comparison or the benchmark
+    source_names = options.source_names.split(',')
+    sector_names = options.sector_names.split(',')
+    results = []
+    for clone_size in parse_clone_sizes(options.clone_sizes):
+        if options.compare:
+            results.extend(run_comparison( \
+                        clone_size         = clone_size, \
+                        number_zones       = options.number_zones, \
+                        source_names       = source_names, \
+                        sector_names       = sector_names, \
+                        distribution       = options.distribution, \
+                        availability_ratio = options.availability_ratio, \
+                        land_fraction      = options.land_fraction, \
+                        zero_fraction      = options.zero_fraction, \
+                        distinct_zones     = options.distinct_zones, \
+                        seed               = options.seed, \
+                        rtol               = options.rtol, \
+                        atol               = options.atol))
+            continue
+        if options.copies:
+            results.extend(run_copy_comparison( \
+                        clone_size         = clone_size, \
+                        number_zones       = options.number_zones, \
+                        source_names       = source_names, \
+                        sector_names       = sector_names, \
+                        distribution       = options.distribution, \
+                        availability_ratio = options.availability_ratio, \
+                        land_fraction      = options.land_fraction, \
+                        zero_fraction      = options.zero_fraction, \
+                        distinct_zones     = options.distinct_zones, \
+                        repeats            = options.repeats, \
+                        seed               = options.seed))
+            continue
+        results.extend(run_benchmark( \
+                        clone_size         = clone_size, \
+                        number_zones       = options.number_zones, \
+                        source_names       = source_names, \
+                        sector_names       = sector_names, \
+                        distribution       = options.distribution, \
+                        availability_ratio = options.availability_ratio, \
+                        land_fraction      = options.land_fraction, \
+                        zero_fraction      = options.zero_fraction, \
+                        distinct_zones     = options.distinct_zones, \
+                        repeats            = options.repeats, \
+                        seed               = options.seed))
+
+    # write the results with the settings and the platform
+    benchmark = {'settings': vars(options), \
+                 'platform': {'python'   : platform.python_version(), \
+                              'numpy'    : np.__version__, \
+                              'machine'  : platform.machine(), \
+                              'system'   : platform.system(), \
+                              'processor': platform.processor()}, \
+                 'date'    : time.strftime('%Y-%m-%dT%H:%M:%S'), \
+                 'results' : results}
+    with open(output_filename, 'w') as json_file:
+        json.dump(benchmark, json_file, indent = 2)
+    print('results written to %s' % os.path.abspath(output_filename))
+
+    # exit with an error if any of the kernels differs
+    if options.compare and not all(result['agrees'] for result in results):
+        sys.exit('error: the vectorized kernels differ from the allocation with PCRaster fields')
+
+########
+# main #
+########
+if __name__ == '__main__':
+    main()
+    print ('all done')
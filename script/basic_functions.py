@@ -255,6 +255,21 @@ do not match if halt_on_key_error is set respecively False or True \
     # and return the resulting dictionary
     return c_dict 
 
+def copy_dicts(dict_in):
+    '''
+copy_dicts: generic function that returns a copy of a (nested) dictionary in \
+which all dictionaries are new objects but all other entries are shared with \
+the input. This replaces a deep copy of dictionaries with PCRaster fields as \
+values: these fields are not modified in place, as the PCRaster operations \
+return new fields, so only the dictionaries that are updated need to be \
+copied, not the fields themselves.
+
+'''
+
+    # return the copy, processing the dictionaries recursively
+    return dict((key, copy_dicts(value) if isinstance(value, dict) else value) \
+                for key, value in dict_in.items())
+
 def get_decision(question_str, possible_outcomes):
     
     '''
@@ -805,6 +820,47 @@ This function is typically intended to avoid errors when dividing by zero.
 
 #== end of pcr_return_val_div_zero function ===================================
 
+def np_return_val_div_zero(x, y, y_lim, z_def = 0.00, out = None):
+    '''
+np_return_val_div_zero: numpy equivalent of pcr_return_val_div_zero that tests \
+the denominator in a division of arrays on the occurrence of (small) values and \
+returns a default answer where this condition is met:
+
+    z = x / y           if y > y_lim
+    z = z_def           if y <= y_lim
+
+Missing values, identified as NaN in y, are propagated to z.
+
+    Input:
+    ======
+    x:                  numerator of the fraction of which result is z;
+    y:                  denominator of the fraction of which the result is z;
+                        this array is broadcast against x;
+    y_lim:              value against which the denominator y is tested;
+    z_def:              value that is returned if y <= y_lim; default value is
+                        zero;
+    out:                optional array to which the result is written; this
+                        can be x or y.
+
+    Output:
+    =======
+    z:                  result of the fraction x / y as a numpy array.
+
+'''
+
+    # get the mask of the default values before any values are overwritten
+    default_mask = np.less_equal(y, y_lim)
+
+    # get the result of the division, ignoring the warnings on NaN
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        z = np.divide(x, np.maximum(y_lim, y), out = out)
+    np.copyto(z, z_def, where = default_mask)
+
+    # return the result, z
+    return z
+
+#== end of np_return_val_div_zero function ====================================
+
 def pcr_tanh(x):
     '''
 pcr_tanh: returns the hyperbolic tangen for a PCRaster field (x) as \
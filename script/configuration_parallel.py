@@ -7,7 +7,7 @@
 ###########
 # Modules #
 ###########
-import os, sys
+import os, sys, re
 
 ###########
 # Process #
@@ -70,6 +70,19 @@ if "-wqf" in system_arguments:
     msg = "The consideration of sectoral water quality requirements is set based on the system argument (-wqf): " + water_quality_flag
     print(msg)
 
+# - forcing cache that is shared by the clones running on the same node; the
+#   placeholder is replaced or, if absent, the value of the key is set
+if "-sfcd" in system_arguments:
+    shared_forcing_cache_dir = system_arguments[system_arguments.index("-sfcd") + 1]
+    if "SHARED_FORCING_CACHE_DIR" in file_ini_content:
+        file_ini_content = file_ini_content.replace("SHARED_FORCING_CACHE_DIR", shared_forcing_cache_dir)
+    else:
+        file_ini_content = re.sub(r"^(shared_forcing_cache_path\s*=).*$", \
+                                  lambda match: "%s %s" % (match.group(1), shared_forcing_cache_dir), \
+                                  file_ini_content, flags = re.MULTILINE)
+    msg = "The folder of the shared forcing cache is set based on the system argument (-sfcd): " + shared_forcing_cache_dir
+    print(msg)
+
 # folder for saving original and modified ini files
 new_ini_file_name = os.path.join(config_file_folder, f'{start_year}_wq{water_quality_flag}', f'{config_file_name.split(".")[0]}_{clone_code}.cfg')
 
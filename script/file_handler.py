@@ -58,11 +58,11 @@ import pcraster as pcr
 try:
     from .spatialDataSet2PCR import spatialAttributes, spatialDataSet, \
                                     compareSpatialAttributes, setClone
-    from .netCDF_recipes import netCDF_file_info
+    from .netCDF_recipes import netCDF_file_info, nc_field_array, nc_lock
 except:
     from spatialDataSet2PCR import spatialAttributes, spatialDataSet, \
                                     compareSpatialAttributes, setClone
-    from netCDF_recipes import netCDF_file_info
+    from netCDF_recipes import netCDF_file_info, nc_field_array, nc_lock
 
 logger = logging.getLogger(__name__)
 
@@ -106,6 +106,15 @@ very_small_number =  1.0e-12
 # types
 NoneType = type(None)
 
+# spatial attributes of the PCRaster files read and their comparison with the
+# clone, identified by the file name; these are obtained once with GDAL as the
+# files and the clone are fixed for the run
+spatial_attributes_cache = {}
+
+# boolean arrays of the masks to which fields are clipped, identified by the
+# identity of the PCRaster map of the mask, which is kept with its array
+mask_arrays = {}
+
 # and the default extensions to use:
 file_extensions = { \
         '.map':   'pcraster', \
@@ -208,6 +217,17 @@ returns True if this is the case.
     # return the test condition
     return file_extensions[file_ext] == 'pcraster'
 
+def get_mask_array(mask):
+    
+    '''returns the boolean array of the PCRaster map of the mask, which is obtained once per map'''
+    
+    # get the array of the mask, missing values are excluded
+    if not id(mask) in mask_arrays.keys():
+        mask_arrays[id(mask)] = (mask, pcr.pcr2numpy(pcr.boolean(mask), 0) == 1)
+
+    # return the array
+    return mask_arrays[id(mask)][1]
+
 def read_file_entry( \
                     filename,
                     variablename, \
@@ -219,6 +239,8 @@ def read_file_entry( \
                     date                    = None, \
                     date_selection_method   = 'exact', \
                     allow_year_substitution = False, \
+                    landmask                = None, \
+                    cover_value             = None, \
                     ):
     
     '''
@@ -257,7 +279,11 @@ given date. This may concern spatial information or single entries.
                             changed and match a particular year; this is part-
                             icularly useful to read climatologies or reuse
                             existing data over longer periods (e.g., spinup),
-                            (default: False).
+                            (default: False);
+    landmask:               PCRaster map of the mask to which spatial output is
+                            clipped; for netCDF input of scalar fields, this is
+                            done when the field is created from the array;
+    cover_value:            value used to cover missing values within the mask.
 
     Output:
     =======
@@ -265,8 +291,9 @@ given date. This may concern spatial information or single entries.
                             non-spatial.
 
 '''
-    # initialize var_out as NoneType
+    # initialize var_out as NoneType and whether it is clipped to the mask
     var_out = None
+    masked = False
 
     # ensure the file name and value are strings
     filename = str(filename)
@@ -282,16 +309,24 @@ given date. This may concern spatial information or single entries.
     if existing_file and file_is_nc(filename):
         
         # netCDF: read as such from the cache
-        var_out =  nc_info.read_nc_field( \
-                    filename, \
-                    variablename, \
-                    clone_attributes        = clone_attributes, \
-                    forced_non_spatial      = forced_non_spatial, \
-                    datatype                = datatype, \
-                    date                    = date, \
-                    date_selection_method   = date_selection_method, \
-                    allow_year_substitution = allow_year_substitution, \
-                    )
+        mask = None
+        if not isinstance(landmask, NoneType):
+            mask = get_mask_array(landmask)
+        with nc_lock:
+            var_out =  nc_info.read_nc_field( \
+                        filename, \
+                        variablename, \
+                        clone_attributes        = clone_attributes, \
+                        forced_non_spatial      = forced_non_spatial, \
+                        datatype                = datatype, \
+                        date                    = date, \
+                        date_selection_method   = date_selection_method, \
+                        allow_year_substitution = allow_year_substitution, \
+                        mask                    = mask, \
+                        cover_value             = cover_value, \
+                        )
+            masked = not isinstance(mask, NoneType) and \
+                     nc_info.applies_mask(filename, variablename, datatype)
 
     elif existing_file and file_is_pcr(filename):
    
@@ -306,11 +341,14 @@ given date. This may concern spatial information or single entries.
             logger.error(message_str)
             sys.exit(message_str)
             
-        # compare extent
-        data_attributes = spatialAttributes(filename)
-        fits_extent, same_resolution,  x_resample_ratio, y_resample_ratio = \
+        # compare extent, obtained once per file
+        if not filename in spatial_attributes_cache.keys():
+            data_attributes = spatialAttributes(filename)
+            spatial_attributes_cache[filename] = \
                     compareSpatialAttributes(data_attributes, \
                                              clone_attributes)
+        fits_extent, same_resolution,  x_resample_ratio, y_resample_ratio = \
+                    spatial_attributes_cache[filename]
 
         file_ext = os.path.splitext(filename)[1]
         same_clone = fits_extent and same_resolution and file_ext == '.map'
@@ -376,15 +414,135 @@ given date. This may concern spatial information or single entries.
             logger.error('%s is not recognized as a netCDF or PCRaster file and cannot be converted' % \
                          filename)
 
+    # clip the output to the mask if not done when read and return it
+    return clip_to_mask(var_out, landmask, cover_value, masked)
+
+def clip_to_mask(var_out, landmask, cover_value, masked):
+    
+    '''clips the output to the mask, if not None, with missing values covered by the cover value, if not None, unless already masked when read'''
+    
+    # clip the output to the mask if not done when read
+    if not isinstance(landmask, NoneType) and not masked:
+        if not isinstance(cover_value, NoneType):
+            var_out = pcr.cover(var_out, cover_value)
+        var_out = pcr.ifthen(landmask, var_out)
+
     # return the output
     return var_out
 
+def read_file_array( \
+                    filename,
+                    variablename, \
+                    inputpath               = '', \
+                    file_subst_args         = (),\
+                    clone_attributes        = None, \
+                    forced_non_spatial      = False, \
+                    datatype                = pcr.Scalar, \
+                    date                    = None, \
+                    date_selection_method   = 'exact', \
+                    allow_year_substitution = False, \
+                    landmask                = None, \
+                    cover_value             = None, \
+                    ):
+    
+    '''
+
+read_file_array: reads the entry of a netCDF file as read_file_entry, but \
+without any PCRaster operations so that it can be called from a worker thread; \
+PCRaster is not thread-safe. Spatial fields are returned as arrays that are \
+converted into PCRaster fields by convert_file_array on the main thread; None \
+is returned for entries that can only be read by read_file_entry. The input is \
+the same as that of read_file_entry; the land mask and cover value are applied \
+by convert_file_array.
+
+'''
+    # compose the file name and read any netCDF file as an array
+    filename, existing_file = compose_filename(str(filename), inputpath, file_subst_args)
+    
+    if existing_file and file_is_nc(filename):
+        with nc_lock:
+            return nc_info.read_nc_field( \
+                        filename, \
+                        variablename, \
+                        clone_attributes        = clone_attributes, \
+                        forced_non_spatial      = forced_non_spatial, \
+                        datatype                = datatype, \
+                        date                    = date, \
+                        date_selection_method   = date_selection_method, \
+                        allow_year_substitution = allow_year_substitution, \
+                        as_array                = True, \
+                        )
+    
+    # returns None
+    return None
+
+def convert_file_array(file_array, **read_arguments):
+    
+    '''
+
+convert_file_array: converts the output of read_file_array into the output of \
+read_file_entry, clipped to the land mask if specified; if the entry could not \
+be read as an array, it is read by read_file_entry. This is called on the main \
+thread.
+
+    Input:
+    ======
+    file_array:             output of read_file_array;
+    read_arguments:         keyword arguments of read_file_array and
+                            read_file_entry.
+
+'''
+    # read the entry directly if it could not be read as an array
+    if isinstance(file_array, NoneType):
+        return read_file_entry(**read_arguments)
+    
+    # convert the array of a spatial field, which is clipped to the mask when
+    # the field is created from the array for scalar fields
+    landmask    = read_arguments.get('landmask')
+    cover_value = read_arguments.get('cover_value')
+    var_out = file_array
+    masked = False
+    if isinstance(file_array, nc_field_array):
+        mask = None
+        if not isinstance(landmask, NoneType):
+            mask = get_mask_array(landmask)
+        with nc_lock:
+            var_out = nc_info.get_array_field(file_array, mask, cover_value)
+            masked = not isinstance(mask, NoneType) and \
+                     nc_info.applies_mask(file_array.ncfilename, \
+                                          file_array.variablename, \
+                                          file_array.datatype)
+    
+    # clip the output to the mask if not done when converted and return it
+    return clip_to_mask(var_out, landmask, cover_value, masked)
+
+
+def set_nc_block_reads(block_length, memory_cap):
+    
+    '''sets the number of time steps that are read as a block from timed netCDF input and the memory cap of the buffer in bytes'''
+    
+    with nc_lock:
+        nc_info.set_block_reads(block_length, memory_cap)
+
+    # return None
+    return None
+
+def set_nc_handle_limits(max_open_files, max_open_bytes):
+    
+    '''sets the maximum number of netCDF input files that are kept open and the maximum memory of their chunk caches in bytes'''
+    
+    with nc_lock:
+        nc_info.set_handle_limits(max_open_files, max_open_bytes)
+
+    # return None
+    return None
 
 def close_nc_cache():
     
     '''closes the cache of netCDF input files'''
     
-    nc_info.close_cache()
+    with nc_lock:
+        nc_info.close_cache()
 
     # return None
     return None
@@ -0,0 +1,191 @@
+# forcing prefetcher module of the QUAlloc model
+
+# this module provides the background reading of the forcing of the next time
+# step while the current time step is computed: the reads of a time step are
+# submitted as a set of requests, identified by the date of the time step and
+# a name per request, to a pool of worker threads and are collected when the
+# time step is processed; requests that were not prefetched or that differ
+# from the arguments at the time of processing are read directly.
+# The number of time steps that can be pending is bounded; requests of earlier
+# time steps that were not collected are discarded when the next time step is
+# prefetched so that they do not block the prefetching, and the pool is
+# shut down at the end of the run, cancelling any outstanding reads.
+# Note that the worker threads only read arrays: access to the netCDF library
+# is serialized by the lock of the netCDF_recipes module and the arrays are
+# converted into PCRaster fields on the main thread when the requests are
+# collected as neither library is thread-safe.
+
+# modules
+import logging
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# global variables
+
+# type of None, compatible with python 2.6
+NoneType = type(None)
+
+logger = logging.getLogger(__name__)
+
+###################
+# class definition #
+###################
+
+class forcing_prefetcher(object):
+
+    '''
+forcing_prefetcher: reads the forcing of future time steps in the background \
+by means of a pool of worker threads.
+
+    Attributes:
+    ===========
+    reader:                 function that is called with the keyword arguments
+                            of a request to read its field in a worker thread;
+                            it should not use any PCRaster operations;
+    converter:              function that is called on the main thread with
+                            the output of the reader and the keyword arguments
+                            of the request to obtain the field, e.g., as a
+                            PCRaster field; if None, the output of the reader
+                            is returned;
+    enabled:                flag whether the forcing is prefetched; if False,
+                            all requests are read directly;
+    max_pending_steps:      maximum number of time steps that can be pending;
+    pending:                ordered dictionary with the requests per time step
+                            as a dictionary with the name as key and the
+                            keyword arguments and the future as value;
+    executor:               pool of worker threads or None if not enabled.
+
+'''
+
+    def __init__(self, reader, converter = None, enabled = True, \
+                 max_workers = 1, max_pending_steps = 1):
+
+        # init object
+        object.__init__(self)
+
+        # set the reader, the converter and the settings
+        self.reader            = reader
+        self.converter         = converter
+        self.enabled           = enabled
+        self.max_pending_steps = max_pending_steps
+
+        # set the pending requests and the pool of worker threads
+        self.pending = OrderedDict()
+        self.executor = None
+        if self.enabled:
+            self.executor = ThreadPoolExecutor(max_workers = max_workers)
+
+        # log the setting
+        logger.info('forcing is prefetched: %s' % self.enabled)
+
+    def prefetch(self, step_key, requests):
+
+        '''
+prefetch: submits the requests of the time step identified by the key to the \
+pool of worker threads; the requests of earlier time steps that are still \
+pending are discarded first; the requests are not submitted if the time step \
+is already pending or if the maximum number of pending time steps is reached.
+
+    Input:
+    ======
+    step_key:               key of the time step, e.g., its date, that can be
+                            ordered;
+    requests:               dictionary of the requests with the name as key and
+                            the keyword arguments of the reader as value.
+
+'''
+
+        # discard the requests of earlier time steps that were not collected
+        for pending_key in list(self.pending.keys()):
+            if pending_key < step_key:
+                logger.debug('%d uncollected requests to prefetch the forcing for %s are discarded' % \
+                             (len(self.pending[pending_key]), pending_key))
+                self.discard(pending_key)
+
+        # submit the requests if possible
+        if self.enabled and not step_key in self.pending and \
+                len(self.pending) < self.max_pending_steps:
+
+            self.pending[step_key] = dict( \
+                    (name, (kwargs, self.executor.submit(self.reader, **kwargs))) \
+                    for name, kwargs in requests.items())
+
+            # log the message
+            logger.debug('%d requests submitted to prefetch the forcing for %s' % \
+                         (len(requests), step_key))
+
+        # returns None
+        return None
+
+    def read(self, step_key, request_name, **kwargs):
+
+        '''
+read: returns the field of the request identified by the key of the time step \
+and its name; the prefetched field is returned if it was read with the same \
+keyword arguments, otherwise it is read directly.
+
+'''
+
+        # get the prefetched request, if any
+        request = None
+        if step_key in self.pending:
+            request = self.pending[step_key].pop(request_name, None)
+            if len(self.pending[step_key]) == 0:
+                del self.pending[step_key]
+
+        # get the output of the reader
+        if not isinstance(request, NoneType) and request[0] == kwargs:
+            output = request[1].result()
+        else:
+            if not isinstance(request, NoneType):
+                request[1].cancel()
+            output = self.reader(**kwargs)
+
+        # return the field
+        if isinstance(self.converter, NoneType):
+            return output
+        else:
+            return self.converter(output, **kwargs)
+
+    def discard(self, step_key = None):
+
+        '''
+discard: cancels all requests of the time step identified by the key or of all \
+time steps if the key is None.
+
+'''
+
+        # get the time steps
+        if isinstance(step_key, NoneType):
+            step_keys = list(self.pending.keys())
+        else:
+            step_keys = [step_key]
+
+        # cancel the requests
+        for step_key in step_keys:
+            for kwargs, future in self.pending.pop(step_key, {}).values():
+                future.cancel()
+
+        # returns None
+        return None
+
+    def shutdown(self):
+
+        '''
+shutdown: cancels all pending requests and shuts down the pool of worker \
+threads once any running reads are finished.
+
+'''
+
+        # discard all requests and shut down the pool
+        self.discard()
+        if not isinstance(self.executor, NoneType):
+            self.executor.shutdown(wait = True)
+            self.executor = None
+        self.enabled = False
+
+        # returns None
+        return None
+
+# end of the forcing prefetcher module
@@ -215,6 +215,7 @@ class model_time(object):
         self.startdate = datetime.datetime(self.startyear,  1,  1)
         self.enddate   = datetime.datetime(self.endyear,   12, 31)
         self.date      = self.startdate
+        self.increment = 0
 
         # get the length of the simulation
         if self.time_increment == 'daily':
@@ -242,13 +243,13 @@ class model_time(object):
         #-report on timers
         return self.date
 
-    def update(self, increment):
-        # update the date by incrementing it by one time step at the time
+    def get_date(self, increment):
+        # returns the date and the time step length in days for the increment
         if self.time_increment == 'daily':
             # set the time step length in days
-            self.time_step_length =  1
-            self.date = self.startdate + \
-                        datetime.timedelta(days = (increment - 1) * self.time_step_length)
+            time_step_length =  1
+            date = self.startdate + \
+                   datetime.timedelta(days = (increment - 1) * time_step_length)
         elif self.time_increment == 'monthly':
             # get the year and month for the new date
             year  = self.startdate.year + (increment - 1) // 12
@@ -257,11 +258,23 @@ class model_time(object):
             else:
                 month = increment % 12
             # set the date and increment
-            self.date = datetime.datetime(year, month, 1)
+            date = datetime.datetime(year, month, 1)
             # set the time step length in days
-            self.time_step_length =  calendar.monthrange(year, month)[1]
+            time_step_length =  calendar.monthrange(year, month)[1]
         else:
             sys.exit('%s cannot be used' % self.time_increment)
+        return date, time_step_length
+
+    def get_next_date(self):
+        # returns the date of the next time step or None at the last time step
+        if self.last_time_step:
+            return None
+        return self.get_date(self.increment + 1)[0]
+
+    def update(self, increment):
+        # update the date by incrementing it by one time step at the time
+        self.increment = increment
+        self.date, self.time_step_length = self.get_date(increment)
 
         # get the year, month and day
         self.year = self.date.year
@@ -28,24 +28,35 @@
 #                                                                             #
 ###############################################################################
 
+import os
 import sys
+import pickle
+import hashlib
 import datetime
 import logging
+import threading
+
+from collections import OrderedDict
+from queue import Queue
 
 import numpy as np
 import pcraster as pcr
 import netCDF4 as nc
 
-from types import BuiltinMethodType
 from copy import copy, deepcopy
 
 from spatialDataSet2PCR import compareSpatialAttributes, spatialAttributes, spatialDataSet
+from regridding import get_regridder, get_axis_step
+from shared_forcing_cache import use_shared_cache, get_shared_slab
 
 logger = logging.getLogger(__name__)
 
 # all netCDF information is stored in a class object holding information in the
 # form of dictionaries with the file names as key on:
-# - a cache holding all open netCDF file objects
+# - a cache holding the open netCDF file objects, of which the least recently
+#   used ones are closed when the number of open files or their estimated
+#   memory use exceeds the limits; closed files keep their information and
+#   are reopened when read again;
 # - a store of all non-dimensional variables in the netCDF objects with their
 #   dimensions;
 # - a store of all non-dimensional variables in the netCDF objects with the
@@ -115,6 +126,40 @@ resample_methods = { \
                       }
 
 
+# lock to serialize all access to the netCDF library, which is not thread-safe,
+# so that input can be read in the background while output is written
+nc_lock = threading.RLock()
+
+# timed input can be read in blocks of consecutive time steps, e.g., a year of
+# monthly fields, that are kept in a buffer of limited size [bytes] from which
+# the subsequent time steps are served; a block length of one reads each time
+# step separately
+default_block_length = 1
+default_block_memory_cap = 512 * 1024 ** 2
+
+# limits on the netCDF input files that are kept open: the maximum number of
+# open files and the maximum memory [bytes] of their chunk caches; the least
+# recently used files are closed first
+default_max_open_files = 64
+default_max_open_bytes = 1024 * 1024 ** 2
+
+# path where the metadata of the netCDF input files are stored so that these
+# can be reused by subsequent runs; if None, metadata are not stored
+metadata_cache_path = None
+
+# spatial data that do not match the clone are read over the window that covers
+# the clone and resampled in-process if the source grid is regular; otherwise,
+# or if set False, the data are processed with GDAL by spatialDataSet
+use_inprocess_resampling = True
+
+# spatial variables are read without masking by netCDF4 if their missing values
+# are only identified by the fill value and they are not packed; scalar fields
+# that are clipped to a mask are filled in a single-precision buffer per
+# variable, in which values outside the mask are set to the following value
+unmasked_read_exclusions = ['scale_factor', 'add_offset', \
+                            'valid_min', 'valid_max', 'valid_range']
+buffer_missing_value = float(np.finfo(np.float32).min)
+
 nc_mv_id_str = '_FillValue'
 # default netCDF type and variable attributes set
 # createVariable functions called with all variables specified set to the following default values
@@ -124,6 +169,8 @@ default_zlib = False; default_complevel = 4; default_shuffle = True;
 default_fletcher32 = False; default_contiguous = False; default_chunksizes = None;
 default_endian = 'native'; default_least_significant_digit = None; default_fill_value = -999.9; 
 exclude_list = ['group', 'set', '_', '__']
+sync_intervals = ['write', 'year', 'run']
+chunk_shapes = [None, 'slab', 'tile']; default_chunk_tile_size = 256
 test_verbose = False
 
 def update_year_of_date(date, new_year, dates):
@@ -334,6 +381,163 @@ module.
     # return date_index, matched date and message_Str
     return date_index, matched_date, message_str
 
+class date_lookup(object):
+
+    '''
+date_lookup: index of the dates of the time dimension of a netCDF file that is \
+built once when the file is added to the cache; dates are matched on their \
+numerical values in the units and calendar of the file, exact matches by means \
+of a dictionary and before, after and nearest matches by a binary search over \
+the sorted values. Matches of substituted years are cached per date.
+The matches reproduce those of get_date_index and substitute_years_of_dates: \
+of equal dates, the first one is returned.
+
+    Attributes:
+    ===========
+    dates:                  dates of the time dimension;
+    units:                  units of the time dimension;
+    calendar:               calendar of the time dimension;
+    values:                 numerical values of the dates;
+    index:                  dictionary with the first position per value;
+    order:                  positions that sort the values, stable for equal
+                            values;
+    sorted_values:          values in sorted order;
+    substitutions:          cached matches of dates with substituted years,
+                            identified by the date, the replacement date and
+                            the date selection method.
+
+'''
+
+    def __init__(self, values, dates, units, calendar):
+
+        # init object
+        object.__init__(self)
+
+        # set the dates and their units and calendar
+        self.dates    = dates
+        self.units    = units
+        self.calendar = calendar
+
+        # set the values and the index for exact matches
+        self.values = np.ma.filled(np.asarray(values, dtype = np.float64).ravel(), np.nan)
+        self.index = {}
+        for position, value in enumerate(self.values.tolist()):
+            self.index.setdefault(value, position)
+
+        # sort the values for the other matches
+        self.order = np.argsort(self.values, kind = 'stable')
+        self.sorted_values = self.values[self.order]
+
+        # initialize the substitutions
+        self.substitutions = {}
+
+    def get_value(self, date):
+
+        '''returns the numerical value of the date in the units and calendar of the dates'''
+
+        return float(nc.date2num(date, self.units, self.calendar))
+
+    def has_date(self, date):
+
+        '''returns True if the date is present in the dates'''
+
+        return self.get_value(date) in self.index
+
+    def get_first_position(self, value):
+
+        '''returns the first position of the value in the dates'''
+
+        # get the range of the value in the sorted values
+        first = np.searchsorted(self.sorted_values, value, side = 'left')
+        last  = np.searchsorted(self.sorted_values, value, side = 'right')
+
+        # return the position
+        return int(self.order[first:last].min())
+
+    def get_date_index(self, date, date_selection_method, \
+                       substituted_dates = False):
+
+        '''
+get_date_index: returns the position of the date specified in the dates \
+following the date selection method: exact, before, after or nearest; None \
+is returned if no match is found.
+
+'''
+
+        # get the value and process any exact match
+        value = self.get_value(date)
+        if value in self.index and not substituted_dates:
+            return self.index[value]
+
+        elif date_selection_method == 'exact':
+            return None
+
+        # number of dates
+        number_dates = self.sorted_values.size
+
+        # date before or after
+        if date_selection_method == 'before':
+            position = np.searchsorted(self.sorted_values, value, side = 'left') - 1
+            if position < 0:
+                return None
+            return self.get_first_position(self.sorted_values[position])
+
+        elif date_selection_method == 'after':
+            position = np.searchsorted(self.sorted_values, value, side = 'right')
+            if position >= number_dates:
+                return None
+            return self.get_first_position(self.sorted_values[position])
+
+        elif date_selection_method == 'nearest':
+            # get the nearest values on either side
+            position = np.searchsorted(self.sorted_values, value, side = 'left')
+            candidates = [self.sorted_values[ix] for ix in (position - 1, position) \
+                          if ix >= 0 and ix < number_dates]
+            offset = min(abs(candidate - value) for candidate in candidates)
+            # return the first position of the values at the nearest offset
+            return min(self.get_first_position(candidate) for candidate in candidates \
+                       if abs(candidate - value) == offset)
+
+        else:
+            sys.exit('index date_selection_method %s is not allowed or does not yield a result' % \
+                     date_selection_method)
+
+    def get_substituted_date_index(self, date, replacement_date, \
+                                   date_selection_method):
+
+        '''
+get_substituted_date_index: returns the position and the matched date of the \
+date specified after the years of the dates have been substituted to include \
+the replacement date, following substitute_years_of_dates; as this shifts all \
+dates by the same offset, the date is matched after it is shifted backwards.
+The matches are cached.
+
+'''
+
+        # return the match if available
+        key = (date, replacement_date, date_selection_method)
+        if key in self.substitutions:
+            return self.substitutions[key]
+
+        # get the offset from the nearest date to the replacement year
+        nearest_date = self.dates[self.get_date_index(replacement_date, 'nearest')]
+        date_offset = datetime.datetime(replacement_date.year, \
+                                        nearest_date.month, nearest_date.day) - \
+                      datetime.datetime(nearest_date.year, \
+                                        nearest_date.month, nearest_date.day)
+
+        # get the position and the matched date
+        date_index = self.get_date_index(date - date_offset, \
+                                         date_selection_method, \
+                                         substituted_dates = True)
+        matched_date = None
+        if not isinstance(date_index, NoneType):
+            matched_date = self.dates[date_index] + date_offset
+
+        # cache and return the match
+        self.substitutions[key] = date_index, matched_date
+        return date_index, matched_date
+
 def print_dictionary(dobj, level  = 0):
     '''iterates over all items in a dictionary and print key,value pairs'''
     for key, value in dobj.items():
@@ -363,9 +567,10 @@ def get_nc_object_attributes(obj, \
             if item[:len_str]  == check_item:
                 include_entry = include_entry and False
 
-        # add the attributes
+        # add the attributes; methods are class objects, which are bound
+        # methods rather than built-in methods in recent netCDF4 versions
         if include_entry:
-            if isinstance(getattr(obj,item), BuiltinMethodType):
+            if callable(getattr(obj,item)):
                 if not exclude_class_objects:
                     try:
                         dobj[item] = getattr(obj,item)()
@@ -411,6 +616,25 @@ def get_nc_attributes(ncfilename):
 
     rootgrp = nc.Dataset(ncfilename, 'r',)
     
+    #-get the attributes from the open dataset
+    nc_format, nc_attributes, nc_dimattrs, nc_varattrs = \
+               get_nc_dataset_attributes(rootgrp)
+
+    #-close file
+    rootgrp.close()
+
+    #-return output
+    return nc_format, nc_attributes, nc_dimattrs, nc_varattrs
+
+def get_nc_dataset_attributes(rootgrp):
+
+    '''
+ get_nc_dataset_attributes: function that returns the format, attributes, \
+ dimensions and attributes of the variables of an open netCDF dataset as \
+ returned by get_nc_attributes; the dataset is left open.
+ 
+'''
+
     #-retrieve file format, dimensions, atributes, variables, and missing value
     nc_format      = rootgrp.file_format
     nc_dimensions  = rootgrp.dimensions.copy()   
@@ -443,12 +667,190 @@ def get_nc_attributes(ncfilename):
         nc_varattrs[key] = get_nc_object_attributes(nc_variables[key], \
                 exclude_list = exclude_list)
 
-    #-close file
-    rootgrp.close()
-
     #-return output
     return nc_format, nc_attributes, nc_dimattrs, nc_varattrs
 
+class nc_spatial_attributes(object):
+
+    '''
+nc_spatial_attributes: spatial attributes of a netCDF variable with the same \
+names as those of spatialAttributes, set from a dictionary.
+
+'''
+
+    def __init__(self, attributes):
+
+        # init object
+        object.__init__(self)
+
+        # set the attributes
+        for key, value in attributes.items():
+            setattr(self, key, value)
+
+def get_nc_spatial_attributes(rootgrp, variablename):
+
+    '''
+get_nc_spatial_attributes: function that returns the spatial attributes of a \
+variable in an open netCDF dataset as a dictionary with the same entries as \
+spatialAttributes; these are derived from the coordinate variables of its last \
+two dimensions that should be regular. The missing value is the fill value or \
+the missing value of the variable or else the default fill value of its type. \
+None is returned if the spatial attributes cannot be derived in this way.
+
+'''
+
+    # get the variable and its dimensions
+    variable = rootgrp.variables[variablename]
+    nc_dims = variable.dimensions
+    if len(nc_dims) < 2:
+        return None
+
+    # get the coordinates of the rows and columns
+    y_dimension, x_dimension = nc_dims[-2:]
+    if not y_dimension in rootgrp.variables or \
+            not x_dimension in rootgrp.variables:
+        return None
+
+    y_values = np.asarray(rootgrp.variables[y_dimension][:], dtype = np.float64).ravel()
+    x_values = np.asarray(rootgrp.variables[x_dimension][:], dtype = np.float64).ravel()
+    y_step = get_axis_step(y_values)
+    x_step = get_axis_step(x_values)
+    if isinstance(y_step, NoneType) or isinstance(x_step, NoneType):
+        return None
+    y_step = abs(y_step); x_step = abs(x_step)
+
+    # get the missing value
+    mv = None
+    for key in [nc_mv_id_str, 'missing_value']:
+        if isinstance(mv, NoneType) and key in variable.ncattrs():
+            mv = float(np.asarray(variable.getncattr(key)).ravel()[0])
+    if isinstance(mv, NoneType):
+        mv = nc.default_fillvals.get('%s%d' % (variable.dtype.kind, \
+                                                variable.dtype.itemsize))
+
+    # return the attributes
+    return { \
+            'dataFormat':  'netCDF', \
+            'numberRows':  y_values.size, \
+            'numberCols':  x_values.size, \
+            'xResolution': x_step, \
+            'yResolution': y_step, \
+            'xLL':         x_values.min() - 0.5 * x_step, \
+            'yLL':         y_values.min() - 0.5 * y_step, \
+            'xUR':         x_values.max() + 0.5 * x_step, \
+            'yUR':         y_values.max() + 0.5 * y_step, \
+            'dataType':    str(variable.dtype), \
+            'minValue':    None, \
+            'maxValue':    None, \
+            'noDataValue': mv, \
+            }
+
+def set_metadata_cache_path(path):
+
+    '''
+set_metadata_cache_path: sets the path where the metadata of the netCDF input \
+files are stored to be reused by subsequent runs.
+
+'''
+
+    # set the global path and create it if needed
+    global metadata_cache_path
+    metadata_cache_path = path
+    if not isinstance(path, NoneType) and not os.path.isdir(path):
+        os.makedirs(path)
+
+    # log the setting
+    logger.debug('metadata of netCDF files are stored in %s' % path)
+
+    # returns None
+    return None
+
+def get_nc_metadata_key(ncfilename):
+
+    '''
+get_nc_metadata_key: returns the key that identifies the metadata of a netCDF \
+file as its absolute path, time of modification and size.
+
+'''
+
+    # get the key
+    ncfilename = os.path.abspath(ncfilename)
+    file_stat = os.stat(ncfilename)
+
+    # return the key
+    return ncfilename, file_stat.st_mtime, file_stat.st_size
+
+def get_nc_metadata_filename(key):
+
+    '''
+get_nc_metadata_filename: returns the name of the file in the metadata cache \
+path that holds the metadata of the netCDF file identified by its key.
+
+'''
+
+    # return the file name
+    return os.path.join(metadata_cache_path, 'ncmetadata_%s.pkl' % \
+                        hashlib.md5(key[0].encode('utf-8')).hexdigest())
+
+def read_nc_metadata(ncfilename):
+
+    '''
+read_nc_metadata: returns the metadata of the netCDF file from the metadata \
+cache path as a dictionary, or None if these are not available or if the file \
+has changed.
+
+'''
+
+    # set the default output
+    metadata = None
+
+    # read the metadata if the file exists and holds the same key
+    if not isinstance(metadata_cache_path, NoneType):
+
+        key = get_nc_metadata_key(ncfilename)
+        filename = get_nc_metadata_filename(key)
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'rb') as metadata_file:
+                    metadata = pickle.load(metadata_file)
+                if metadata['key'] != key:
+                    metadata = None
+            except Exception:
+                metadata = None
+                logger.warning('metadata of %s could not be read from %s' % \
+                               (ncfilename, filename))
+
+    # return the metadata
+    return metadata
+
+def write_nc_metadata(ncfilename, metadata):
+
+    '''
+write_nc_metadata: writes the metadata of the netCDF file to the metadata \
+cache path, if set, by way of a temporary file that is renamed once complete, \
+so that concurrent runs only find complete metadata.
+
+'''
+
+    # write the metadata
+    if not isinstance(metadata_cache_path, NoneType):
+
+        metadata['key'] = get_nc_metadata_key(ncfilename)
+        filename = get_nc_metadata_filename(metadata['key'])
+        temporary_filename = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            with open(temporary_filename, 'wb') as metadata_file:
+                pickle.dump(metadata, metadata_file, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_filename, filename)
+        except Exception:
+            logger.warning('metadata of %s could not be written to %s' % \
+                           (ncfilename, filename))
+            if os.path.isfile(temporary_filename):
+                os.remove(temporary_filename)
+
+    # returns None
+    return None
+
 def initialize_ncfile(ncfilename,  \
                      nc_format = None, \
                      nc_global_attributes= {}, \
@@ -569,7 +971,7 @@ the netCDF4 createVariable function.
         if key in nc_defaults.keys():
             
             # replace the value
-            nc_var_attrs[key] = nc_var_attrs[key]
+            nc_defaults[key] = nc_var_attrs[key]
             
             # and strip the key word from the attributes
             del nc_var_attrs[key]
@@ -716,6 +1118,8 @@ def add_data_to_netCDF( \
                 variable_array, \
                 dim_slices, \
                 cache = {}, \
+                time_steps = None, \
+                sync = True, \
                 **additional_info):
 
     '''
@@ -735,6 +1139,12 @@ add_data_to_netCDF: function that adds data to the netCDF file specified.
                         over the full domain. If specified, the values should be
                         a tuple of the first and last indices of the slice;
     cache:              dictionary with already open files;
+    time_steps:         optional list with the number of time steps in the file
+                        and the last time value, which is kept up to date by
+                        this function, so that dates that follow the last
+                        date are appended without reading the time variable;
+    sync:               flag whether the file is synchronized to disk after
+                        the data are added (default: True);
     additional_info:    additional information; this should include a
                         list of dates (dates) as well as the name of the 
                         dimension that holds the time stamps (time_dimension)
@@ -752,13 +1162,9 @@ add_data_to_netCDF: function that adds data to the netCDF file specified.
     else:
         rootgrp = nc.Dataset(ncfilename, 'a')
 
-    # copy the slice with dimension and the variable array
-    dim_slices     = deepcopy(dim_slices)
-    variable_array = deepcopy(variable_array)
+    # copy the slice with dimension, the slices themselves are not changed
+    dim_slices = dict(dim_slices)
     
-    # simple temporal update
-    simple_update = True
-
     # dimension names
     dim_keys= list(rootgrp.variables[name].dimensions)
 
@@ -771,41 +1177,47 @@ add_data_to_netCDF: function that adds data to the netCDF file specified.
         time_dimension = additional_info['time_dimension']
         dates = additional_info['dates']
 
-        # temporal information, add the dates
+        # get the number of time steps and the last time value, if any
         nc_time = rootgrp.variables[time_dimension]
-        if len(nc_time[:]) > 0:
+        if isinstance(time_steps, NoneType):
+            number_time_steps = len(nc_time)
+            last_time = None
+            if number_time_steps > 0:
+                last_time = nc_time[number_time_steps - 1]
+        else:
+            number_time_steps, last_time = time_steps
+
+        # temporal information: dates that follow the last date are appended
+        # and the time values are added, otherwise the dates are matched
+        time_values = np.array(nc.date2num(dates, nc_time.units, nc_time.calendar)).ravel()
+        if number_time_steps == 0 or time_values[0] > last_time:
+            date_ixs = np.arange(len(dates)) + number_time_steps
+            nc_time[date_ixs[0]:date_ixs[-1] + 1] = time_values
+        elif len(dates) == 1 and time_values[0] == last_time:
+            date_ixs = np.array([number_time_steps - 1])
+        else:
             try:
                 date_ixs = np.array(nc.date2index(dates, nc_time)).ravel()
             except:
-                date_ixs = np.arange(len(dates)) + len(nc_time[:])
-        else:
-            date_ixs = np.arange(len(dates)) + len(nc_time[:])
-            
-        # add the dates
-        date_ixs = date_ixs.tolist()
-        for date_ix in date_ixs:
-       
-            # add the date to the netCDF time variable
-            date = dates[date_ixs.index(date_ix)]
-            nc_time[date_ix] = nc.date2num(date, nc_time.units, nc_time.calendar)
+                date_ixs = np.arange(len(dates)) + number_time_steps
+            for date_ix, time_value in zip(date_ixs.tolist(), time_values):
+                nc_time[date_ix] = time_value
+
+        # update the number of time steps and the last time value
+        if date_ixs[-1] + 1 >= number_time_steps:
+            number_time_steps = int(date_ixs[-1]) + 1
+            last_time = time_values[-1]
+        if not isinstance(time_steps, NoneType):
+            time_steps[:] = [number_time_steps, last_time]
 
         # insert the date indices in case the dimension values are not set
         if isinstance(dim_slices[time_dimension], NoneType):
-
-            # simple_update
-            simple_update = True
-            
-            # insert the first and last position
-            dim_slices[time_dimension] = (date_ixs[0], date_ixs[-1] + 1)
-        
-        else:
-            simple_update = False
+            dim_slices[time_dimension] = (int(date_ixs[0]), int(date_ixs[-1]) + 1)
     
     # update the other indices of the dimension slices if set to None
-    # and retrieve the required size of the variable array in case it is sliced
-    # and for the maximum non-temporal dimensions, in which the processing is
-    # simplified
+    # and retrieve the required size of the variable array
     req_size = 1
+    slab_shape = []
 
     for dim_key in dim_keys:
 
@@ -813,71 +1225,28 @@ add_data_to_netCDF: function that adds data to the netCDF file specified.
         if isinstance(dim_slices[dim_key], NoneType):
             
             # set the indices
-            dim_slices[dim_key] = (0, len(rootgrp.variables[dim_key][:]))
+            dim_slices[dim_key] = (0, len(rootgrp.dimensions[dim_key]))
             
-        # decide on simple processing
-        if dim_key != time_dimension:
-            simple_update = simple_update and \
-                    ((dim_slices[dim_key][1] - dim_slices[dim_key][0]) == \
-                            len(rootgrp.variables[dim_key][:]))
-
         # update the required size
-        req_size = req_size * (dim_slices[dim_key][1] - dim_slices[dim_key][0])
+        slab_shape.append(dim_slices[dim_key][1] - dim_slices[dim_key][0])
+        req_size = req_size * slab_shape[-1]
         
     # update the required size
     while variable_array.size != req_size:
         sys.exit('array sizes do not match!')
 
-    # and decide on the processing:
-    # a simple update is possible if the variable array has the correct size
-    # to add a single time stap
-    
-    if simple_update:
-        
-        # timed or not?
-        if time_dimension != '':
-            # timed: write to the last field
-            rootgrp.variables[name][dim_slices[time_dimension][0], ...] = variable_array[:]
-        else:
-            # not timed, write the full array
-            rootgrp.variables[name][...] = variable_array[:]
-    
-    else:   
-        
-        # additional processing is necessary to add the data
-    
-        # create a boolean array and an array of indices that is used to 
-        # set the corresponding entries to True
-        mask_array = np.ones(rootgrp.variables[name][:].shape, dtype = bool)
-        g_ixs = np.indices(mask_array.shape)
-        # iterate over the dimensions and set the boolean mask to True
-        for dim_key in dim_keys:
-            
-            # get the key position
-            dim_ix = dim_keys.index(dim_key)
-    
-            # set the mask
-            mask_ix = (g_ixs[dim_ix] >= dim_slices[dim_key][0]) & \
-                    (g_ixs[dim_ix] < dim_slices[dim_key][1])
-    
-            # update the mask array
-            mask_array = mask_array & mask_ix
-            
-        # use the mask to update the variable array and the corresponding mask
-        v_a =  rootgrp.variables[name][:].copy()
-           
-        v_a[mask_array] = variable_array[:].ravel()
-            
-        rootgrp.variables[name][:] = v_a.copy()
+    # write the slab of the dimension slices only; for timed variables, this
+    # appends or replaces the time steps of the dates without reading the
+    # variable, so that the cost of a write does not depend on the length
+    # of the run
+    slab_index = tuple(slice(dim_slices[dim_key][0], dim_slices[dim_key][1]) \
+                       for dim_key in dim_keys)
+    rootgrp.variables[name][slab_index] = \
+            np.reshape(variable_array, slab_shape)
        
     #-update and close
-    rootgrp.sync()
-
-    # delete temporary variables
-    v_a = None
-    mask_array = None
-    mask_ix = None
-    del v_a, mask_array, mask_ix
+    if sync:
+        rootgrp.sync()
 
     # if not in cache, close the file
     if not ncfilename in cache:
@@ -923,6 +1292,36 @@ get_nc_dates: returns a list of sorted dates from a timet netCDF file.
 
 #///start of file with class definitions///
 
+class nc_field_array(object):
+    
+    '''
+nc_field_array: array of a spatial field read from a netCDF file that is not \
+yet converted into a PCRaster field, so that it can be read without any \
+PCRaster operations, e.g., in a worker thread; see netCDF_file_info.read_nc_field \
+and get_array_field.
+
+    Attributes:
+    ===========
+    ncfilename:             name of the netCDF file;
+    variablename:           name of the variable;
+    datatype:               PCRaster data type of the field;
+    values:                 array of the field on the clone;
+    mv:                     missing value of the array.
+
+'''
+    
+    def __init__(self, ncfilename, variablename, datatype, values, mv):
+        
+        # init the object
+        object.__init__(self)
+        
+        # set the attributes
+        self.ncfilename   = ncfilename
+        self.variablename = variablename
+        self.datatype     = datatype
+        self.values       = values
+        self.mv           = mv
+
 class netCDF_file_info(object):
     
     def __init__(self,):
@@ -930,19 +1329,101 @@ class netCDF_file_info(object):
         # init the object
         object.__init__(self)
         
-        # create cache of open files and information
-        self.cache             = dict()
+        # create cache of open files, with the least recently used file
+        # first, and information
+        self.cache             = OrderedDict()
+        self.handle_bytes      = dict()
         self.attributes        = dict()
         self.dimensions        = dict()
         self.variables         = dict()
         self.spatialattributes = dict()
         self.time_dimension    = dict()
+        self.date_lookups      = dict()
+        self.regridders        = dict()
+        self.unmasked_reads    = dict()
+        self.buffers           = dict()
+        
+        # buffer of blocks of timed input, with the oldest block first
+        self.blocks            = OrderedDict()
+        self.block_bytes       = 0
+        self.set_block_reads(default_block_length, default_block_memory_cap)
+        self.set_handle_limits(default_max_open_files, default_max_open_bytes)
         
 
     def test_ncfile_in_cache(self, ncfilename):
-        '''tests if the specified nc file name is present in the cache'''
+        '''tests if the specified nc file name is present in the cache; its file may be closed'''
         
-        return ncfilename in self.cache.keys()
+        return ncfilename in self.attributes.keys()
+
+    def set_handle_limits(self, max_open_files, max_open_bytes):
+        '''
+set_handle_limits: function that sets the maximum number of netCDF files that \
+are kept open and the maximum memory in bytes of their chunk caches; the least \
+recently used files are closed first but at least one file is kept open.
+
+'''
+        # set the limits
+        self.max_open_files = max(1, int(max_open_files))
+        self.max_open_bytes = max_open_bytes
+
+        # close any files beyond the limits
+        self.close_handles()
+
+        # log message
+        logger.debug('at most %d netCDF files are kept open with %.1f MB of chunk cache' % \
+                     (self.max_open_files, self.max_open_bytes / 1024.0 ** 2))
+
+        # returns None
+        return None
+
+    def close_handles(self):
+        '''closes the least recently used netCDF files until the open files are within the limits'''
+
+        while len(self.cache) > 1 and \
+                (len(self.cache) > self.max_open_files or \
+                 sum(self.handle_bytes.values()) > self.max_open_bytes):
+
+            # close the file but keep its information
+            ncfilename, rootgrp = self.cache.popitem(last = False)
+            rootgrp.close()
+            del self.handle_bytes[ncfilename]
+
+            # log message
+            logger.debug('neCDF file %s closed, its information is kept' % ncfilename)
+
+        # returns None
+        return None
+
+    def get_dataset(self, ncfilename):
+        '''
+get_dataset: function that returns the open netCDF file, which is opened again \
+if it was closed; it is marked as the most recently used file and the least \
+recently used files are closed if the limits are exceeded.
+
+'''
+        # get the open file or open it
+        if ncfilename in self.cache.keys():
+            self.cache.move_to_end(ncfilename)
+
+        else:
+            rootgrp = nc.Dataset(ncfilename)
+            self.cache[ncfilename] = rootgrp
+
+            # estimate the memory of the file by its chunk caches
+            number_bytes = 0
+            for variable in rootgrp.variables.values():
+                try:
+                    if variable.chunking() != 'contiguous':
+                        number_bytes += variable.get_var_chunk_cache()[0]
+                except:
+                    pass
+            self.handle_bytes[ncfilename] = number_bytes
+
+            # close any other files beyond the limits
+            self.close_handles()
+
+        # return the file
+        return self.cache[ncfilename]
 
     def add_ncfile_to_cache(self, ncfilename, \
                             clone_attributes = None, \
@@ -951,11 +1432,25 @@ class netCDF_file_info(object):
 holding netCDF information to facilitate access.'''
 
         # add the netCDF file if it is not yet in the cache
-        if not ncfilename in self.cache.keys():
+        if not self.test_ncfile_in_cache(ncfilename):
 
-            # get all information
+            # open the file and add it to the cache
+            rootgrp = self.get_dataset(ncfilename)
+
+            # get all information from the metadata cache if the file has not
+            # changed or otherwise from the open file; the metadata include
+            # the spatial attributes of the variables once these are obtained
+            metadata = read_nc_metadata(ncfilename)
+            update_metadata = isinstance(metadata, NoneType)
+            if update_metadata:
+                metadata = { \
+                        'attributes':         get_nc_dataset_attributes(rootgrp), \
+                        'spatial_attributes': {}, \
+                        }
+
+            # get all information, copied as it is updated below
             nc_format, nc_attributes, nc_dimattrs, nc_varattrs = \
-                        get_nc_attributes(ncfilename)
+                        deepcopy(metadata['attributes'])
 
             # add the information to the cache           
             self.attributes[ncfilename] = nc_attributes.copy()
@@ -968,9 +1463,6 @@ holding netCDF information to facilitate access.'''
             else:
                 global_mv = default_fill_value
 
-            # open the file and add it to the cache
-            self.cache[ncfilename] = nc.Dataset(ncfilename)
-
             # get the time variable
             time_dimension = None
             for variablename in self.dimensions[ncfilename].keys():
@@ -985,6 +1477,13 @@ holding netCDF information to facilitate access.'''
                                 self.variables[ncfilename][time_dimension]['units'], \
                                 self.variables[ncfilename][time_dimension]['calendar'], \
                                 )
+                # index the dates for later matches
+                self.date_lookups[ncfilename] = date_lookup( \
+                                self.dimensions[ncfilename][time_dimension]['values'], \
+                                dates, \
+                                self.variables[ncfilename][time_dimension]['units'], \
+                                self.variables[ncfilename][time_dimension]['calendar'], \
+                                )
                 self.dimensions[ncfilename][time_dimension]['values'] = dates[:]
 
             # check on the dimensions once the information is added
@@ -1018,15 +1517,29 @@ holding netCDF information to facilitate access.'''
                     # data is forced as non_spatial or not
                     if not forced_non_spatial:
 
-                        data_attributes = None 
-                        # try to get the spatial attributes
-                        try:
+                        # get the spatial attributes from the coordinates of
+                        # the last two dimensions or, if these are not available,
+                        # try to get them with GDAL
+                        if not variablename in metadata['spatial_attributes'].keys():
+
+                            spatial_attributes = get_nc_spatial_attributes( \
+                                                        rootgrp, variablename)
+
+                            if isinstance(spatial_attributes, NoneType) and len(nc_dims) >= 2:
+                                try:
+                                    spatial_attributes = vars(spatialAttributes('NETCDF:"%s":%s' %\
+                                                        (ncfilename, variablename))).copy()
+                                except:
+                                    pass
 
-                            # get data set if possible
-                            data_attributes = spatialAttributes('NETCDF:"%s":%s' %\
-                                                        (ncfilename, variablename))
-                        except:
+                            metadata['spatial_attributes'][variablename] = spatial_attributes
+                            update_metadata = True
 
+                        data_attributes = None 
+                        if not isinstance(metadata['spatial_attributes'][variablename], NoneType):
+                            data_attributes = nc_spatial_attributes( \
+                                                  metadata['spatial_attributes'][variablename])
+                        else:
                             logger.debug('%s in %s is treated as a non-spatial dataset' % \
                                          (variablename, ncfilename))
 
@@ -1097,6 +1610,10 @@ holding netCDF information to facilitate access.'''
                         # set missing value
                         self.variables[ncfilename][variablename][nc_mv_id_str ] = mv
 
+            # store the metadata if updated
+            if update_metadata:
+                write_nc_metadata(ncfilename, metadata)
+
             # log message
             logger.info('neCDF file %s added to cache' % ncfilename)
 
@@ -1105,16 +1622,28 @@ holding netCDF information to facilitate access.'''
 specified netCDF file.'''
 
         # add the netCDF file if it is not yet in the cache
-        if ncfilename in self.cache.keys():
+        if self.test_ncfile_in_cache(ncfilename):
             
-            # close the file name
-            self.cache[ncfilename].close()
-            del self.cache[ncfilename]
+            # close the file name if it is open
+            if ncfilename in self.cache.keys():
+                self.cache.pop(ncfilename).close()
+                del self.handle_bytes[ncfilename]
             
             # remove all information from the cache           
             del self.attributes[ncfilename]
             del self.dimensions[ncfilename]
             del self.variables[ncfilename]
+            self.date_lookups.pop(ncfilename, None)
+            for key in list(self.blocks.keys()):
+                if key[0] == ncfilename:
+                    self.block_bytes -= self.blocks.pop(key).nbytes
+            for key in list(self.regridders.keys()):
+                if key[0] == ncfilename:
+                    del self.regridders[key]
+            for cache in [self.unmasked_reads, self.buffers]:
+                for key in list(cache.keys()):
+                    if key[0] == ncfilename:
+                        del cache[key]
 
             # log message
             logger.info('neCDF file %s removed from cache' % ncfilename)
@@ -1138,6 +1667,226 @@ specified netCDF file.'''
         # return the dimensions
         return nc_dims
 
+    def set_block_reads(self, block_length, memory_cap):
+        '''
+set_block_reads: function that sets the number of time steps that are read as \
+a block from timed input and the maximum size in bytes of the buffer that \
+holds the blocks; blocks are not used if the block length is one or less.
+
+'''
+        # set the block length and the memory cap
+        self.block_length = max(1, int(block_length))
+        self.block_memory_cap = memory_cap
+
+        # remove any blocks beyond the memory cap
+        self.trim_blocks()
+
+        # log message
+        logger.debug('timed netCDF input is read in blocks of %d time steps with a buffer of %.1f MB' % \
+                     (self.block_length, self.block_memory_cap / 1024.0 ** 2))
+
+        # returns None
+        return None
+
+    def trim_blocks(self, number_bytes = 0):
+        '''removes the oldest blocks from the buffer until the number of bytes specified fits within the memory cap'''
+
+        while len(self.blocks) > 0 and \
+                self.block_bytes + number_bytes > self.block_memory_cap:
+            self.block_bytes -= self.blocks.popitem(last = False)[1].nbytes
+
+        # returns None
+        return None
+
+    def get_variable(self, ncfilename, variablename):
+        '''
+get_variable: function that returns the variable from the open netCDF file; \
+masking is disabled for spatial variables of which the missing values are \
+only identified by the fill value and that are not packed, so that these are \
+read as plain arrays with the fill value in place.
+
+'''
+        # get the variable
+        variable = self.get_dataset(ncfilename)[variablename]
+
+        # test once whether the variable can be read without masking
+        key = (ncfilename, variablename)
+        if not key in self.unmasked_reads.keys():
+            nc_attributes = variable.ncattrs()
+            self.unmasked_reads[key] = \
+                self.variables[ncfilename][variablename]['spatial_variable'] and \
+                nc_mv_id_str in nc_attributes and \
+                not any(name in nc_attributes for name in unmasked_read_exclusions) and \
+                (not 'missing_value' in nc_attributes or \
+                 bool(np.all(variable.getncattr('missing_value') == variable.getncattr(nc_mv_id_str))))
+
+        # disable the masking, the file may have been opened again
+        if self.unmasked_reads[key]:
+            variable.set_auto_mask(False)
+
+        # return the variable
+        return variable
+
+    def applies_mask(self, ncfilename, variablename, datatype):
+        '''returns True if a mask is applied to the variable when read, which holds for spatial scalar fields'''
+
+        return self.variables[ncfilename][variablename]['spatial_variable'] and \
+               (datatype == pcr.Scalar or datatype == str(pcr.Scalar))
+
+    def get_field(self, ncfilename, variablename, datatype, values, mv, \
+                  mask = None, cover_value = None):
+        '''
+get_field: function that returns the PCRaster field of the values on the clone \
+with the missing value specified; if a mask is specified as a boolean array, \
+the values are copied in a single pass into the single-precision buffer of the \
+variable in which missing values within the mask are covered by the cover \
+value, if not None, and values outside the mask are set to missing, so that \
+the field is created from the buffer directly.
+
+'''
+        # no mask, convert the values
+        if isinstance(mask, NoneType):
+            return pcr.numpy2pcr(datatype, values, mv)
+
+        # get the buffer of the variable
+        key = (ncfilename, variablename)
+        buffer = self.buffers.get(key)
+        if isinstance(buffer, NoneType) or buffer.shape != values.shape:
+            buffer = np.empty(values.shape, dtype = np.float32)
+            self.buffers[key] = buffer
+
+        # copy the values and set the missing values
+        np.copyto(buffer, np.ma.getdata(values), casting = 'unsafe')
+        missing = np.isnan(buffer)
+        if not isinstance(mv, NoneType):
+            missing |= np.ma.getdata(values) == mv
+        if np.ma.is_masked(values):
+            missing |= np.ma.getmaskarray(values)
+        if isinstance(cover_value, NoneType):
+            buffer[missing] = buffer_missing_value
+        else:
+            buffer[missing] = cover_value
+        buffer[~mask] = buffer_missing_value
+
+        # return the field
+        return pcr.numpy2pcr(datatype, buffer, buffer_missing_value)
+
+    def get_array_field(self, field_array, mask = None, cover_value = None):
+        '''returns the PCRaster field of the array of a field read from a netCDF file, clipped to the mask for spatial scalar fields as in read_nc_field'''
+
+        # convert the array
+        if self.applies_mask(field_array.ncfilename, field_array.variablename, \
+                             field_array.datatype):
+            return self.get_field(field_array.ncfilename, field_array.variablename, \
+                                  field_array.datatype, field_array.values, \
+                                  field_array.mv, mask, cover_value)
+        else:
+            return pcr.numpy2pcr(field_array.datatype, field_array.values, \
+                                 field_array.mv)
+
+    def read_nc_slab(self, ncfilename, variablename, date_index):
+        '''returns the full field of the variable at the date index with missing values set to the missing value of the variable'''
+
+        # read the field and set the missing values
+        slab = self.get_variable(ncfilename, variablename)[date_index]
+        mv = self.variables[ncfilename][variablename][nc_mv_id_str]
+        if not isinstance(mv, NoneType):
+            slab = np.ma.filled(slab, mv)
+
+        # return the field
+        return np.ma.getdata(slab)
+
+    def read_nc_array(self, ncfilename, variablename, date_index, window = None):
+        '''
+read_nc_array: function that returns the array of the variable in the netCDF \
+file specified at the date index, if not None, and over the window of rows and \
+columns, if specified, or else over the full extent. For timed variables, the \
+array is read as part of a block of consecutive time steps if block reads are \
+set; blocks are aligned on multiples of the block length and are kept in the \
+buffer until the memory cap is exceeded. If the shared forcing cache is used, \
+timed spatial variables are instead read as the full field of the time step \
+from the shared cache, of which the window is returned with missing values \
+set to the missing value of the variable.
+
+'''
+        # get the index of the rows and columns
+        if isinstance(window, NoneType):
+            spatial_index = (Ellipsis,)
+        else:
+            spatial_index = (Ellipsis, slice(window[0], window[1]), \
+                             slice(window[2], window[3]))
+
+        # get the window from the full field in the shared cache
+        if not isinstance(date_index, NoneType) and use_shared_cache() and \
+                self.variables[ncfilename][variablename]['spatial_variable']:
+
+            slab = get_shared_slab(get_nc_metadata_key(ncfilename) + \
+                                   (variablename, date_index), \
+                                   self.read_nc_slab, ncfilename, variablename, date_index)
+            return np.array(slab[spatial_index])
+
+        # not timed or read per time step
+        if isinstance(date_index, NoneType):
+            return self.get_variable(ncfilename, variablename)[spatial_index]
+        elif self.block_length <= 1:
+            return self.get_variable(ncfilename, variablename)[(date_index,) + spatial_index]
+
+        # get the block, read it if not in the buffer
+        first_index = date_index - date_index % self.block_length
+        key = (ncfilename, variablename, first_index, window)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+        else:
+            # the file is only opened if the block has to be read
+            variable = self.get_variable(ncfilename, variablename)
+            last_index = min(first_index + self.block_length, variable.shape[0])
+            block = variable[(slice(first_index, last_index),) + spatial_index]
+            # the block is only kept if it fits within the memory cap
+            if block.nbytes > self.block_memory_cap:
+                return block[date_index - first_index]
+            self.trim_blocks(block.nbytes)
+            self.blocks[key] = block
+            self.block_bytes += block.nbytes
+
+        # return the array of the time step
+        return self.blocks[key][date_index - first_index]
+
+    def get_regridder(self, ncfilename, variablename, clone_attributes, \
+                      resample_method):
+        '''
+get_regridder: function that returns the regridder to resample the variable \
+in the netCDF file specified in-process to the clone on the basis of the \
+coordinates of its last two dimensions; None is returned if the coordinates \
+are not available or if the grid is not regular. The regridder is kept per \
+file, variable and resample method.
+
+'''
+        # return the regridder if it was obtained before
+        key = (ncfilename, variablename, resample_method)
+        if key in self.regridders:
+            return self.regridders[key]
+
+        # set the default output
+        regridder = None
+
+        # get the dimensions and the coordinates of the rows and columns
+        nc_dims = self.obtain_dimensions(ncfilename, variablename)
+        if use_inprocess_resampling and len(nc_dims) >= 2:
+
+            y_dimension, x_dimension = nc_dims[-2:]
+            y_attributes = self.dimensions[ncfilename].get(y_dimension, {})
+            x_attributes = self.dimensions[ncfilename].get(x_dimension, {})
+
+            if 'values' in y_attributes and 'values' in x_attributes:
+                regridder = get_regridder(x_attributes['values'], \
+                                          y_attributes['values'], \
+                                          clone_attributes, \
+                                          resample_method)
+
+        # store and return the regridder
+        self.regridders[key] = regridder
+        return regridder
+
     def test_var_in_ncfile(self, ncfilename, variablename):
         '''
 test_var_in_ncfile: function that tests if a variable is present in the \
@@ -1154,6 +1903,9 @@ netCDF file specified.
                       date_selection_method = 'exact', \
                       allow_year_substitution = 'False', \
                       forced_non_spatial = False, \
+                      mask = None, \
+                      cover_value = None, \
+                      as_array = False, \
                       ):
         
         '''
@@ -1161,7 +1913,12 @@ netCDF file specified.
 read_nc_field: function that retrieves an entry of the variable name within \
 the specified netCDF file name with consideration of the spatial attributes of \
 the present clone. It can automatically retrieve the corresponding date, \
-depending on the type of match specified.
+depending on the type of match specified. Spatial scalar fields are clipped \
+to the mask, if specified as a boolean array of the clone, with missing values \
+within the mask covered by the cover value, if not None.
+If as_array is True, no PCRaster operations are used: spatial fields are \
+returned as an nc_field_array that is converted with get_array_field, and None \
+is returned if the field can only be read as a PCRaster map.
 
 '''
         # recast the date selection method as lower case
@@ -1198,11 +1955,8 @@ depending on the type of match specified.
         # if it is a timed variable, then get the position and band
         if self.variables[ncfilename][variablename]['timed_variable']:
             
-            # get the name of the variable representing the time
-            time_dimension = self.time_dimension[ncfilename]
-
-            # get the date index possibly from the substituted dates
-            dates = self.dimensions[ncfilename][time_dimension]['values'].copy()
+            # get the index of the dates, built when the file was added
+            dates = self.date_lookups[ncfilename]
 
             # initialize an empty message_str
             message_str = ''
@@ -1213,7 +1967,7 @@ depending on the type of match specified.
                 # is the date present? then make the match exact and                 
                 true_date = False
 
-                if date in dates:
+                if dates.has_date(date):
                     
                     true_date = True
                     date_selection_method = 'exact'
@@ -1229,12 +1983,17 @@ depending on the type of match specified.
                         sys.exit(message_str)
 
                 # get the date index from the actual dates
-                date_index = nc.date2index( \
-                            date, \
-                            self.cache[ncfilename].variables[time_dimension], \
-                            self.variables[ncfilename][time_dimension]['calendar'], \
-                            select = date_selection_method, \
-                            )
+                date_index = dates.get_date_index( \
+                            date, date_selection_method)
+                
+                if isinstance(date_index, NoneType):
+                    
+                    message_str = 'for variable %s, no %s match for date %s is encountered in %s' % \
+                                (variablename, date_selection_method, date, ncfilename) 
+                    logger.error(message_str)
+                    sys.exit(message_str)
+                
+                matched_date = dates.dates[date_index]
    
                 # true date
                 true_date = True
@@ -1242,8 +2001,11 @@ depending on the type of match specified.
             # year substitution is allowed, find the corresponding match
             else:
                 
-                date_index = get_date_index( \
-                            date, dates, date_selection_method)
+                date_index = dates.get_date_index( \
+                            date, date_selection_method)
+                matched_date = None
+                if not isinstance(date_index, NoneType):
+                    matched_date = dates.dates[date_index]
                 
                 # check whether the date was matched or not: if not, no
                 # match could be found and substitution of the date is
@@ -1278,19 +2040,15 @@ depending on the type of match specified.
                     # and the corresponding date
                     replacement_date = update_year_of_date(date, replacement_year, date)
 
-                    # replace the date in the years
-                    dates = substitute_years_of_dates(dates, replacement_date)
-                    
-                    # and get the corresponding date index
-                    date_index = get_date_index( \
-                            date, dates, date_selection_method, \
-                            substituted_dates = True)
+                    # and get the corresponding date index and date in the
+                    # dates of which the years are replaced
+                    date_index, matched_date = dates.get_substituted_date_index( \
+                            date, replacement_date, date_selection_method)
                     
                 # true date
                 true_date = False 
         
-            # finally, retrieve the matched dates and set the band
-            matched_date = dates[date_index]
+            # finally, set the band
             band_number = date_index + 1
             
         else:
@@ -1344,37 +2102,77 @@ depending on the type of match specified.
                         logger.error('data of type LDD as read from %s for %s can not be resampled' % \
                                      (ncfilename, variablename))
 
-                # if the areas are different, get the actual area using gdal_translate
-                var_out = getattr(spatialDataSet( \
-                                  variablename, \
-                                  'NETCDF:"%s":%s' % (ncfilename, variablename), \
-                                  datatypes[datatype_str], \
-                                  datatype, \
-                                  clone_attributes.xLL, \
-                                  clone_attributes.xUR, \
-                                  clone_attributes.yLL, \
-                                  clone_attributes.yUR, \
-                                  clone_attributes.xResolution, \
-                                  clone_attributes.yResolution, \
-                                  pixels = clone_attributes.numberCols, \
-                                  lines = clone_attributes.numberRows, \
-                                  resampleMethod = resample_method, \
-                                  band = band_number, \
-                                  ), variablename)
+                # get the regridder to resample the data in-process
+                regridder = self.get_regridder(ncfilename, variablename, \
+                                               clone_attributes, resample_method)
+
+                if not isinstance(regridder, NoneType):
+
+                    # read the window that covers the clone and resample it
+                    mv = self.variables[ncfilename][variablename][nc_mv_id_str]
+                    var_array = regridder.resample( \
+                                    self.read_nc_array(ncfilename, variablename, \
+                                                       date_index, regridder.window), \
+                                    mv)
+
+                    # array returned, convert to the map
+                    var_out = nc_field_array(ncfilename, variablename, datatype, \
+                                             var_array, mv)
+                    if not as_array:
+                        var_out = self.get_array_field(var_out, mask, cover_value)
+
+                    # delete the array
+                    var_array = None
+                    del var_array
+
+                elif as_array:
+
+                    # the actual area can only be read as a PCRaster map
+                    return None
+
+                else:
+
+                    # if the areas are different, get the actual area using gdal_translate
+                    var_out = getattr(spatialDataSet( \
+                                    variablename, \
+                                    'NETCDF:"%s":%s' % (ncfilename, variablename), \
+                                    datatypes[datatype_str], \
+                                    datatype, \
+                                    clone_attributes.xLL, \
+                                    clone_attributes.xUR, \
+                                    clone_attributes.yLL, \
+                                    clone_attributes.yUR, \
+                                    clone_attributes.xResolution, \
+                                    clone_attributes.yResolution, \
+                                    pixels = clone_attributes.numberCols, \
+                                    lines = clone_attributes.numberRows, \
+                                    resampleMethod = resample_method, \
+                                    band = band_number, \
+                                    ), variablename)
+
+                    # clip the map to the mask
+                    if self.applies_mask(ncfilename, variablename, datatype) and \
+                            not isinstance(mask, NoneType):
+                        var_out = self.get_field(ncfilename, variablename, datatype, \
+                                                 pcr.pcr2numpy(var_out, buffer_missing_value), \
+                                                 buffer_missing_value, mask, cover_value)
             
             
             else:
                 # data can be converted directly using numpy2pcr; get the array
                 if self.variables[ncfilename][variablename]['timed_variable']:
                     # get the variable array from the timed variable
-                    var_array = self.cache[ncfilename][variablename][date_index, :]
+                    var_array = self.read_nc_array(ncfilename, variablename, date_index)
                 else:
                    # not timed, get the appropriate dimension
-                    var_array = self.cache[ncfilename][variablename][date_index, :]
+                    var_array = self.get_dataset(ncfilename)[variablename][date_index, :]
                 
                 # array returned, convert to the map
-                var_out = pcr.numpy2pcr(datatype, var_array, \
-                                        self.variables[ncfilename][variablename][nc_mv_id_str])
+                mv = self.variables[ncfilename][variablename][nc_mv_id_str]
+                var_out = nc_field_array(ncfilename, variablename, datatype, \
+                                         var_array, mv)
+                if not as_array:
+                    var_out = self.get_array_field(var_out, mask, cover_value)
                 
                 # delete the array
                 var_array = None
@@ -1390,12 +2188,12 @@ depending on the type of match specified.
                         
                         # get the current date only
                         var_out = conversion_method(\
-                                self.cache[ncfilename][variablename][date_index])
+                                self.get_dataset(ncfilename)[variablename][date_index])
         
                     else:
                         
                         # get the slice
-                        var_out = self.cache[ncfilename][variablename][date_index, :]
+                        var_out = self.read_nc_array(ncfilename, variablename, date_index)
 
             else:
 
@@ -1425,7 +2223,7 @@ depending on the type of match specified.
     def close_cache(self):
         
         # close all the file names
-        for ncfilename in list(self.cache.keys()):
+        for ncfilename in list(self.attributes.keys()):
             
             # close the file name
             self.remove_ncfile_from_cache(ncfilename)
@@ -1446,7 +2244,7 @@ output netCDF files.
     
 '''
     
-    def __init__(self, model_configuration):
+    def __init__(self, model_configuration, landmask = None):
                 
         # init the object
         object.__init__(self)
@@ -1459,20 +2257,109 @@ output netCDF files.
         self.dimensions        = dict()
         self.time_dimension    = dict()
         
+        # number of time steps and last time value per file, which are
+        # updated as data are added
+        self.time_steps        = dict()
+        
+        # files with data that are not yet synchronized to disk and the number
+        # of time steps that have been completed
+        self.unsynced_files    = set()
+        self.number_time_steps = 0
+        
+        # queue of the writes that are processed in order by the writer
+        # thread, which is started when needed, and the first error raised
+        self.write_queue       = None
+        self.writer            = None
+        self.write_error       = None
+        
         # latitudes and longitudes
         self.latitude  = pcr.pcr2numpy(pcr.ycoordinate(pcr.spatial(pcr.boolean(1))), default_fill_value)[:, 0]
         self.longitude = pcr.pcr2numpy(pcr.xcoordinate(pcr.spatial(pcr.boolean(1))), default_fill_value)[0, :]
 
-        # netcdf format and zlib setup 
+        # netcdf format and compression setup: the compression, chunking and
+        # quantization only apply to the netCDF4 formats
         self.default_fill_value = default_fill_value
         self.nc_format = default_nc_format
         self.zlib = default_zlib
+        self.complevel = default_complevel
+        self.shuffle = default_shuffle
+        self.least_significant_digit = default_least_significant_digit
         if 'nc_format' in model_configuration.reporting.keys():
-            self.format = model_configuration.convert_string_to_input( \
+            self.nc_format = model_configuration.convert_string_to_input( \
                     model_configuration.reporting['nc_format'], str)
         if 'zlib' in model_configuration.reporting.keys():
-            self.format = model_configuration.convert_string_to_input( \
+            self.zlib = model_configuration.convert_string_to_input( \
                     model_configuration.reporting['zlib'], bool)
+        if 'complevel' in model_configuration.reporting.keys():
+            self.complevel = model_configuration.convert_string_to_input( \
+                    model_configuration.reporting['complevel'], int)
+        if 'shuffle' in model_configuration.reporting.keys():
+            self.shuffle = model_configuration.convert_string_to_input( \
+                    model_configuration.reporting['shuffle'], bool)
+        if 'least_significant_digit' in model_configuration.reporting.keys():
+            self.least_significant_digit = model_configuration.convert_string_to_input( \
+                    model_configuration.reporting['least_significant_digit'], int)
+
+        # chunk shape of the variables: the netCDF default (None), a full field
+        # per time step ('slab') or square tiles per time step ('tile') with
+        # the number of cells along each side
+        self.chunk_shape = None
+        self.chunk_tile_size = default_chunk_tile_size
+        if 'chunk_shape' in model_configuration.reporting.keys():
+            self.chunk_shape = model_configuration.convert_string_to_input( \
+                    model_configuration.reporting['chunk_shape'], str)
+            if not self.chunk_shape in chunk_shapes:
+                message_str = 'chunk shape %s is not one of %s' % \
+                              (self.chunk_shape, str.join(', ', [str(chunk_shape) \
+                                                                 for chunk_shape in chunk_shapes]))
+                logger.error(message_str)
+                sys.exit(message_str)
+        if 'chunk_tile_size' in model_configuration.reporting.keys():
+            self.chunk_tile_size = model_configuration.convert_string_to_input( \
+                    model_configuration.reporting['chunk_tile_size'], int)
+
+        # land-only output: spatial variables are stored for the cells of the
+        # land mask only along a single dimension, of which the values are the
+        # flat indices of the cells on the grid of latitudes and longitudes
+        # (compression by gathering, CF conventions); this requires the land
+        # mask to be passed
+        self.land = None
+        land_only = False
+        if 'land_only' in model_configuration.reporting.keys():
+            land_only = model_configuration.convert_string_to_input( \
+                    model_configuration.reporting['land_only'], bool)
+        if land_only and not isinstance(landmask, NoneType):
+            self.land = np.flatnonzero(pcr.pcr2numpy(pcr.boolean(landmask), 0) == 1).astype(np.int32)
+
+        # synchronization of the output to disk: after each write ('write'),
+        # every number of time steps, at the end of each year ('year') or only
+        # when the files are closed ('run'); in addition, the files can be
+        # synchronized at the restart points when the states are written
+        self.sync_interval = 'write'
+        self.sync_at_restart = True
+        if 'sync_interval' in model_configuration.reporting.keys():
+            self.sync_interval = model_configuration.convert_string_to_input( \
+                    model_configuration.reporting['sync_interval'], str).lower()
+            if self.sync_interval.isdigit() and int(self.sync_interval) >= 1:
+                self.sync_interval = int(self.sync_interval)
+            elif not self.sync_interval in sync_intervals:
+                message_str = 'sync interval %s is not one of %s or a positive number of time steps' % \
+                              (self.sync_interval, str.join(', ', sync_intervals))
+                logger.error(message_str)
+                sys.exit(message_str)
+        if 'sync_at_restart' in model_configuration.reporting.keys():
+            self.sync_at_restart = model_configuration.convert_string_to_input( \
+                    model_configuration.reporting['sync_at_restart'], bool)
+
+        # writes to the output files can be queued and processed by a writer
+        # thread while the model continues; the size of the queue limits the
+        # number of pending writes and the writes are processed directly if 0
+        self.write_queue_size = 0
+        if 'output_queue_size' in model_configuration.reporting.keys():
+            self.write_queue_size = model_configuration.convert_string_to_input( \
+                    model_configuration.reporting['output_queue_size'], int)
+        if self.write_queue_size > 0:
+            self.write_queue = Queue(maxsize = self.write_queue_size)
 
         # set the general netcdf attributes (based on the information given in the ini/configuration file) 
         self.nc_global_attributes = self.get_general_netcdf_attributes(model_configuration)
@@ -1512,6 +2399,20 @@ output netCDF files.
                             'standard_name' : 'longitude', \
                             'units'         : 'degrees_east', \
                            }
+        # the dimension of the land cells that replaces the latitude and
+        # longitude of spatial variables if the output is land-only
+        self.dimension_info['land'] = { \
+                           'dim_pos'        : 1, \
+                           'is_temporal'    : False, \
+                           'is_spatial'     : True, \
+                           'is_gathered'    : True, \
+                            'datatype'      : 'i4', \
+                            'unlimited'     : False, \
+                            'long_name'     : 'land cells', \
+                            'standard_name' : 'land cells', \
+                            'units'         : '1', \
+                            'compress'      : 'latitude longitude', \
+                           }
 
         # returns None
         return None
@@ -1573,6 +2474,8 @@ specified netCDF file.'''
             # close the file name
             self.cache[ncfilename].close()
             del self.cache[ncfilename]
+            self.time_steps.pop(ncfilename, None)
+            self.unsynced_files.discard(ncfilename)
 
             # log message
             logger.info('neCDF file %s removed from cache' % ncfilename)
@@ -1588,14 +2491,15 @@ for reduced IO.
 '''
         
         # add the netCDF file to the cache
-        self.add_ncfile_to_cache(ncfilename)
+        with nc_lock:
+            self.add_ncfile_to_cache(ncfilename)
         
-        # initialize the netCDF file
-        initialize_ncfile( \
-                          ncfilename = ncfilename, \
-                          nc_format = self.nc_format, \
-                          nc_global_attributes = self.nc_global_attributes, \
-                          cache = self.cache)
+            # initialize the netCDF file
+            initialize_ncfile( \
+                              ncfilename = ncfilename, \
+                              nc_format = self.nc_format, \
+                              nc_global_attributes = self.nc_global_attributes, \
+                              cache = self.cache)
 
     def initialize_nc_variable(self, \
                                ncfilename, \
@@ -1618,94 +2522,252 @@ Function wraps around the functions add_dimension_to_netCDF and add_variable_to_
 '''
 
         # initialize the netCDF file if necessary
-        if not self.test_ncfile_in_cache(ncfilename):
-            self.initialize_ncfile(ncfilename)
-        
-        # get the dimensions
-        var_dim_keys = []
-        for dim_key, dim_info in self.dimension_info.items():
-            dim_pos = dim_info['dim_pos']
-            if dim_info['is_spatial'] and is_spatial:
-                var_dim_keys.insert(dim_pos, dim_key)
-            if dim_info['is_temporal'] and is_temporal:
-                var_dim_keys.insert(dim_pos, dim_key)
+        with nc_lock:
+            if not self.test_ncfile_in_cache(ncfilename):
+                self.initialize_ncfile(ncfilename)
+        
+            # get the dimensions
+            var_dim_keys = []
+            for dim_key, dim_info in self.dimension_info.items():
+                dim_pos = dim_info['dim_pos']
+                if dim_info.get('is_gathered', False):
+                    continue
+                if dim_info['is_spatial'] and is_spatial:
+                    var_dim_keys.insert(dim_pos, dim_key)
+                if dim_info['is_temporal'] and is_temporal:
+                    var_dim_keys.insert(dim_pos, dim_key)
+            
+            # for land-only output, the latitude and longitude are added to
+            # the file but the variable is stored along the land cells
+            file_dim_keys = var_dim_keys[:]
+            if is_spatial and not isinstance(self.land, NoneType):
+                file_dim_keys.append('land')
+                var_dim_keys = [dim_key for dim_key in var_dim_keys \
+                                if not self.dimension_info[dim_key]['is_spatial']]
+                var_dim_keys.insert(self.dimension_info['land']['dim_pos'], 'land')
                 
-        # get the dimensions
-        nc_dim_keys = list(self.cache[ncfilename].dimensions.keys())
+            # get the dimensions
+            nc_dim_keys = list(self.cache[ncfilename].dimensions.keys())
         
-        # add the dimension
-        for dim_key in var_dim_keys:
-            if not dim_key in nc_dim_keys:
+            # add the dimension
+            for dim_key in file_dim_keys:
+                if not dim_key in nc_dim_keys:
                 
-                # add the dimension
-                logger.debug('dimension %s added to %s' % \
-                             (dim_key, ncfilename))
+                    # add the dimension
+                    logger.debug('dimension %s added to %s' % \
+                                 (dim_key, ncfilename))
                 
-                # get the dim_info
-                dim_info = self.dimension_info[dim_key]
+                    # get the dim_info
+                    dim_info = self.dimension_info[dim_key]
                 
-                # is temporal
-                if dim_info['is_temporal']:
-
-                    add_dimension_to_netCDF( \
-                        ncfilename    = ncfilename, \
-                        name          = dim_key, \
-                        datatype      = datatype, \
-                        unlimited     = dim_info['unlimited'], \
-                        cache         = self.cache, \
-                        long_name     = dim_info['long_name'], \
-                        standard_name = dim_info['standard_name'], \
-                        calendar      = dim_info['calendar'], \
-                        units         = dim_info['units'], \
-                        )
+                    # is temporal
+                    if dim_info['is_temporal']:
+
+                        add_dimension_to_netCDF( \
+                            ncfilename    = ncfilename, \
+                            name          = dim_key, \
+                            datatype      = datatype, \
+                            unlimited     = dim_info['unlimited'], \
+                            cache         = self.cache, \
+                            long_name     = dim_info['long_name'], \
+                            standard_name = dim_info['standard_name'], \
+                            calendar      = dim_info['calendar'], \
+                            units         = dim_info['units'], \
+                            )
 
-                    # add the temporal variable
-                    self.time_dimension[ncfilename] = dim_key
+                        # add the temporal variable, which is empty
+                        self.time_dimension[ncfilename] = dim_key
+                        self.time_steps[ncfilename] = [0, None]
                 
-                # is spatial
-                elif dim_info['is_spatial']:
+                    # is gathered, the land cells
+                    elif dim_info.get('is_gathered', False):
                     
-                    # spatial coordinates
-                    values = getattr(self, dim_key)
-                    add_dimension_to_netCDF( \
-                        ncfilename    = ncfilename, \
-                        name          = dim_key, \
-                        datatype      = datatype, \
-                        unlimited     = dim_info['unlimited'], \
-                        values        = values, \
-                        cache         = self.cache, \
-                        long_name     = dim_info['long_name'], \
-                        standard_name = dim_info['standard_name'], \
-                        units         = dim_info['units'], \
-                        )                   
+                        # indices of the land cells
+                        add_dimension_to_netCDF( \
+                            ncfilename    = ncfilename, \
+                            name          = dim_key, \
+                            datatype      = dim_info['datatype'], \
+                            unlimited     = dim_info['unlimited'], \
+                            values        = self.land, \
+                            cache         = self.cache, \
+                            fill_value    = False, \
+                            long_name     = dim_info['long_name'], \
+                            standard_name = dim_info['standard_name'], \
+                            units         = dim_info['units'], \
+                            compress      = dim_info['compress'], \
+                            )                   
                     
-                else:
-                    pass
+                    # is spatial
+                    elif dim_info['is_spatial']:
+                    
+                        # spatial coordinates
+                        values = getattr(self, dim_key)
+                        add_dimension_to_netCDF( \
+                            ncfilename    = ncfilename, \
+                            name          = dim_key, \
+                            datatype      = datatype, \
+                            unlimited     = dim_info['unlimited'], \
+                            values        = values, \
+                            cache         = self.cache, \
+                            long_name     = dim_info['long_name'], \
+                            standard_name = dim_info['standard_name'], \
+                            units         = dim_info['units'], \
+                            )                   
+                    
+                    else:
+                        pass
 
-        # add the dimension for the current variable
-        if not ncfilename in self.dimensions.keys():
-            self.dimensions[ncfilename] = {variablename : var_dim_keys}
+            # add the dimension for the current variable
+            if not ncfilename in self.dimensions.keys():
+                self.dimensions[ncfilename] = {variablename : var_dim_keys}
         
 
-        # add the variable
-        logger.debug('variable %s added to %s' % \
-                     (variablename, ncfilename))
+            # add the variable
+            logger.debug('variable %s added to %s' % \
+                         (variablename, ncfilename))
 
-        # initialize the variable
-        add_variable_to_netCDF( \
-            ncfilename    = ncfilename, \
-            name          = variablename, \
-            datatype      = datatype, \
-            dimensions    = var_dim_keys, \
-            cache         = self.cache, \
-            long_name     = long_name, \
-            standard_name = standard_name, \
-            units         = variable_units, \
-            )
+            # set the quantization for floating-point data only
+            least_significant_digit = None
+            if np.dtype(datatype).kind == 'f':
+                least_significant_digit = self.least_significant_digit
+
+            # initialize the variable
+            add_variable_to_netCDF( \
+                ncfilename    = ncfilename, \
+                name          = variablename, \
+                datatype      = datatype, \
+                dimensions    = var_dim_keys, \
+                cache         = self.cache, \
+                zlib          = self.zlib, \
+                complevel     = self.complevel, \
+                shuffle       = self.shuffle, \
+                chunksizes    = self.get_chunksizes(var_dim_keys), \
+                least_significant_digit = least_significant_digit, \
+                long_name     = long_name, \
+                standard_name = standard_name, \
+                units         = variable_units, \
+                )
 
         # all done, return None
         return None
 
+    def get_chunksizes(self, dim_keys):
+        
+        '''
+get_chunksizes: function of the netCDF_output_handler that returns the chunk \
+sizes of a variable with the dimensions specified for the chunk shape set: a \
+single time step with the full field for slabs or with square tiles, of which \
+the land cells are the equivalent number of cells; None is returned if the \
+default chunking of netCDF applies.
+
+'''
+
+        # no chunk shape set
+        if isinstance(self.chunk_shape, NoneType):
+            return None
+
+        # get the chunk size per dimension
+        chunksizes = []
+        for dim_key in dim_keys:
+            if self.dimension_info[dim_key]['is_temporal']:
+                size = 1
+            else:
+                size = len(getattr(self, dim_key))
+                if self.chunk_shape == 'tile':
+                    tile_size = self.chunk_tile_size
+                    if self.dimension_info[dim_key].get('is_gathered', False):
+                        tile_size = tile_size ** 2
+                    size = min(size, tile_size)
+            chunksizes.append(size)
+
+        # return the chunk sizes
+        return chunksizes
+
+    def start_writer(self):
+        
+        '''starts the writer thread that processes the queued writes, if not running'''
+        
+        if isinstance(self.writer, NoneType):
+            self.writer = threading.Thread(target = self.process_write_queue, \
+                                           name = 'netCDF_output_writer')
+            self.writer.daemon = True
+            self.writer.start()
+
+        # return None
+        return None
+
+    def process_write_queue(self):
+        
+        '''
+process_write_queue: function of the netCDF_output_handler that is run by the \
+writer thread and processes the queued writes in order until it receives None; \
+after an error, the remaining writes are skipped and the error is raised by \
+the model when it next uses the handler.
+
+'''
+
+        while True:
+            task = self.write_queue.get()
+            try:
+                if isinstance(task, NoneType):
+                    return None
+                function, kwargs = task
+                if isinstance(self.write_error, NoneType):
+                    function(**kwargs)
+            except Exception as error:
+                self.write_error = error
+                logger.error('writing the netCDF output failed: %s' % error)
+            finally:
+                self.write_queue.task_done()
+
+    def check_write_error(self):
+        
+        '''halts the model if the writer thread has encountered an error'''
+        
+        if not isinstance(self.write_error, NoneType):
+            message_str = 'netCDF output could not be written: %s' % self.write_error
+            logger.error(message_str)
+            sys.exit(message_str)
+
+        # return None
+        return None
+
+    def queue_task(self, function, **kwargs):
+        
+        '''
+queue_task: function of the netCDF_output_handler that adds the function with \
+its keyword arguments to the write queue, waiting if the queue is full, or \
+calls it directly if writes are not queued.
+
+'''
+
+        # raise any error of the previous writes
+        self.check_write_error()
+
+        # queue the task or process it directly
+        if isinstance(self.write_queue, NoneType):
+            function(**kwargs)
+        else:
+            self.start_writer()
+            self.write_queue.put((function, kwargs))
+
+        # return None
+        return None
+
+    def drain_write_queue(self):
+        
+        '''waits until all queued writes are processed and stops the writer thread'''
+        
+        if not isinstance(self.writer, NoneType):
+            self.write_queue.put(None)
+            self.write_queue.join()
+            self.writer.join()
+            self.writer = None
+        self.check_write_error()
+
+        # return None
+        return None
+
     def add_data_to_netCDF(self, \
                            ncfilename, \
                            variablename, \
@@ -1715,7 +2777,9 @@ Function wraps around the functions add_dimension_to_netCDF and add_variable_to_
         '''
 
 add_data_to_netCDF: function of the netCDF_output_handler that adds the output \
-to netCDF file for the variable specified.
+to netCDF file for the variable specified; if writes are queued, the data are \
+written by the writer thread in the order in which they were added, so the \
+array should not be changed afterwards.
 Function wraps around the function add_data_to_netCDF and initializes the tuple \
 of the dimensions to be written.
      
@@ -1736,26 +2800,99 @@ of the dimensions to be written.
         dim_slices = dict([(dim_key, None) 
                            for dim_key in self.dimensions[ncfilename][variablename]])
 
-        # call the function to add the data to the netCDF file
-        add_data_to_netCDF( \
-                ncfilename     = ncfilename, \
-                name           = variablename, \
-                variable_array = variable_array, \
-                dim_slices     = dim_slices, \
-                cache          = self.cache, \
-                **additional_info)
+        # get the values of the land cells for land-only output
+        if 'land' in dim_slices.keys():
+            variable_array = np.ravel(variable_array)[self.land]
+
+        # add the data to the netCDF file
+        self.queue_task(self.write_data_to_netCDF, \
+                        ncfilename     = ncfilename, \
+                        variablename   = variablename, \
+                        variable_array = variable_array, \
+                        dim_slices     = dim_slices, \
+                        additional_info = additional_info)
+
+        # return None
+        return None
+
+    def write_data_to_netCDF(self, ncfilename, variablename, variable_array, \
+                             dim_slices, additional_info):
+        
+        '''calls the function to add the data to the netCDF file'''
+        
+        with nc_lock:
+            add_data_to_netCDF( \
+                    ncfilename     = ncfilename, \
+                    name           = variablename, \
+                    variable_array = variable_array, \
+                    dim_slices     = dim_slices, \
+                    cache          = self.cache, \
+                    time_steps     = self.time_steps.get(ncfilename), \
+                    sync           = self.sync_interval == 'write', \
+                    **additional_info)
+            if self.sync_interval != 'write':
+                self.unsynced_files.add(ncfilename)
+
+        # return None
+        return None
+
+    def sync(self):
+        
+        '''synchronizes all files with data that are not yet written to disk, after any queued writes'''
+        
+        self.queue_task(self.sync_files)
+
+        # return None
+        return None
 
+    def sync_files(self):
+        
+        '''synchronizes all files with data that are not yet written to disk'''
+        
+        with nc_lock:
+            for ncfilename in sorted(self.unsynced_files):
+                self.cache[ncfilename].sync()
+            self.unsynced_files.clear()
+
+        # return None
+        return None
+
+    def finalize_time_step(self, end_of_year = False, restart_point = False):
+        
+        '''
+finalize_time_step: function of the netCDF_output_handler that is called once \
+all output of the time step has been added and that synchronizes the files to \
+disk depending on the sync interval: every number of time steps, at the end \
+of the year or, if set, at the restart points when the states are written.
+
+'''
+
+        # update the number of time steps
+        self.number_time_steps += 1
+
+        # synchronize the files if due
+        if isinstance(self.sync_interval, int):
+            sync_files = self.number_time_steps % self.sync_interval == 0
+        else:
+            sync_files = self.sync_interval == 'year' and end_of_year
+        sync_files = sync_files or (self.sync_at_restart and restart_point)
+        if sync_files:
+            self.sync()
 
         # return None
         return None
 
     def close_cache(self):
         
+        # process all queued writes
+        self.drain_write_queue()
+        
         # close all the file names
-        for ncfilename in list(self.cache.keys()):
+        with nc_lock:
+            for ncfilename in list(self.cache.keys()):
             
-            # close the file name
-            self.remove_ncfile_from_cache(ncfilename)
+                # close the file name
+                self.remove_ncfile_from_cache(ncfilename)
 
         # return None
         return None
@@ -10,12 +10,12 @@ import datetime
 import logging
 
 import pcraster as pcr
-from copy import deepcopy
 from spatialDataSet2PCR import spatialAttributes, setClone
 
 # modules from the QUAlloc model
-from basic_functions import sum_list, pcr_return_val_div_zero
-from file_handler import compose_filename, read_file_entry, close_nc_cache
+from basic_functions import sum_list, pcr_return_val_div_zero, copy_dicts
+from file_handler import compose_filename, read_file_entry, close_nc_cache, set_nc_block_reads, \
+                         set_nc_handle_limits, read_file_array, convert_file_array
 from initial_conditions_handler import get_initial_conditions, get_initial_condition_as_timed_dict
 from qualloc_reporting import  qualloc_report_initial_conditions
 
@@ -25,8 +25,13 @@ from water_management import water_management, water_management_missing_value, v
 from water_quality    import water_quality, water_quality_forcing_variables, unattainable_threshold
 
 # test
-from allocation import get_key
+from allocation import get_key, set_diagnostics_flag, set_allocation_kernel
+from zonal_aggregation import register_zone_indices
 from model_time import match_date_by_julian_number
+from regridding import set_regridder_cache_path
+from netCDF_recipes import set_metadata_cache_path
+from shared_forcing_cache import set_shared_cache_path
+from forcing_prefetcher import forcing_prefetcher
 
 # global variables
 logger = logging.getLogger(__name__)
@@ -150,6 +155,40 @@ class qualloc_model(object):
             self.model_flags['desalinated_water_use_flag'] = \
                 eval(self.model_configuration.water_management['desalinated_water_use_flag'])
         
+        # diagnostics of the allocation, only formatted and logged if set
+        self.model_flags['allocation_diagnostics_flag'] = False
+        if 'allocation_diagnostics_flag' in self.model_configuration.water_management.keys():
+            self.model_flags['allocation_diagnostics_flag'] = \
+                eval(self.model_configuration.water_management['allocation_diagnostics_flag'])
+        set_diagnostics_flag(self.model_flags['allocation_diagnostics_flag'])
+        
+        # kernel of the allocation, with PCRaster fields (default) or numpy
+        self.model_flags['allocation_kernel'] = 'pcraster'
+        if 'allocation_kernel' in self.model_configuration.water_management.keys():
+            self.model_flags['allocation_kernel'] = \
+                self.model_configuration.water_management['allocation_kernel'].lower()
+        set_allocation_kernel(self.model_flags['allocation_kernel'])
+        
+        # use of the local resources first and reallocation of any surplus
+        # in the allocation, both True by default
+        for flag_name in ['use_local_first_flag', 'reallocate_surplus']:
+            self.model_flags[flag_name] = True
+            if flag_name in self.model_configuration.water_management.keys():
+                self.model_flags[flag_name] = \
+                    eval(self.model_configuration.water_management[flag_name])
+        
+        # mode of the allocation, iterative (default) or proportional
+        self.model_flags['allocation_mode'] = 'iterative'
+        if 'allocation_mode' in self.model_configuration.water_management.keys():
+            self.model_flags['allocation_mode'] = \
+                self.model_configuration.water_management['allocation_mode'].lower()
+        
+        # prefetch of the forcing of the next time step in the background
+        self.model_flags['prefetch_forcing_flag'] = False
+        if 'prefetch_forcing_flag' in self.model_configuration.forcing.keys():
+            self.model_flags['prefetch_forcing_flag'] = \
+                eval(self.model_configuration.forcing['prefetch_forcing_flag'])
+        
         # initial conditions: this is a class that holds all the initial conditions
         self.modules = ['surfacewater','groundwater','water_management','water_quality']
         self.initial_conditions = initial_conditions
@@ -173,6 +212,55 @@ class qualloc_model(object):
         else:
             sys.exit('clone file %s does not exist' % clone_file)
         
+        # optional path to store the weights to regrid input that does not
+        # match the clone; relative paths are set relative to the output path
+        if 'regridder_cache_path' in model_configuration.general.keys() and \
+                model_configuration.general['regridder_cache_path'] != 'None':
+            set_regridder_cache_path(os.path.join(model_configuration.outputpath, \
+                                     model_configuration.general['regridder_cache_path']))
+        
+        # optional path to store the metadata of the netCDF input files;
+        # relative paths are set relative to the output path
+        if 'metadata_cache_path' in model_configuration.general.keys() and \
+                model_configuration.general['metadata_cache_path'] != 'None':
+            set_metadata_cache_path(os.path.join(model_configuration.outputpath, \
+                                    model_configuration.general['metadata_cache_path']))
+        
+        # optional block reads of timed netCDF input: the number of time steps
+        # per block and the memory cap of the buffer of blocks [MB]
+        if 'block_read_length' in model_configuration.general.keys():
+            block_read_length = int(model_configuration.general['block_read_length'])
+            block_read_memory_cap = 512.0
+            if 'block_read_memory_cap' in model_configuration.general.keys():
+                block_read_memory_cap = float(model_configuration.general['block_read_memory_cap'])
+            set_nc_block_reads(block_read_length, block_read_memory_cap * 1024 ** 2)
+        
+        # optional limits on the netCDF input files that are kept open: the
+        # number of files and the memory of their chunk caches [MB]
+        if 'max_open_ncfiles' in model_configuration.general.keys():
+            max_open_ncfiles = int(model_configuration.general['max_open_ncfiles'])
+            max_open_ncfiles_memory = 1024.0
+            if 'max_open_ncfiles_memory' in model_configuration.general.keys():
+                max_open_ncfiles_memory = float(model_configuration.general['max_open_ncfiles_memory'])
+            set_nc_handle_limits(max_open_ncfiles, max_open_ncfiles_memory * 1024 ** 2)
+        
+        # optional path of the forcing cache that is shared by the clones of
+        # a parallel run and the lifetime of the fields stored in it [h];
+        # the path should be absolute as the clones have their own output path
+        if 'shared_forcing_cache_path' in model_configuration.general.keys() and \
+                model_configuration.general['shared_forcing_cache_path'] != 'None':
+            if not os.path.isabs(model_configuration.general['shared_forcing_cache_path']):
+                message_str = 'shared forcing cache path %s is not an absolute path' % \
+                              model_configuration.general['shared_forcing_cache_path']
+                logger.error(message_str)
+                sys.exit('error: %s' % message_str)
+            shared_forcing_cache_lifetime = None
+            if 'shared_forcing_cache_lifetime' in model_configuration.general.keys():
+                shared_forcing_cache_lifetime = \
+                    float(model_configuration.general['shared_forcing_cache_lifetime']) * 3600.0
+            set_shared_cache_path(model_configuration.general['shared_forcing_cache_path'], \
+                                  shared_forcing_cache_lifetime)
+        
         message_str = str.join('\n', \
             ('', \
             '', \
@@ -630,8 +718,17 @@ class qualloc_model(object):
                     desalinated_water_use_flag                  = self.model_flags['desalinated_water_use_flag'], \
                     groundwater_pumping_capacity_flag           = self.model_flags['groundwater_pumping_capacity_flag'], \
                     surfacewater_pumping_capacity_flag          = self.model_flags['surfacewater_pumping_capacity_flag'], \
+                    use_local_first_flag                        = self.model_flags['use_local_first_flag'], \
+                    reallocate_surplus                          = self.model_flags['reallocate_surplus'], \
+                    allocation_mode                             = self.model_flags['allocation_mode'], \
                     )
         
+        # index the allocation zones per source and sector once; these are
+        # static and shared by all allocation functions during the run
+        register_zone_indices(dict((source_name, \
+                                    getattr(self.water_management, '%s_allocation_zones' % source_name)) \
+                                   for source_name in ['groundwater', 'surfacewater', 'desalwater']))
+        
         # remove temporal files
         groundwater_allocation_zones    = None; surfacewater_allocation_zones    = None;
         groundwater_withdrawal_points   = None; surfacewater_withdrawal_points   = None;
@@ -835,9 +932,68 @@ class qualloc_model(object):
         # set water quality object to water management
         setattr(self.water_management,'water_quality',self.water_quality)
         
+        # initialize the prefetcher of the forcing and submit the requests
+        # for the first time step
+        self.forcing_prefetcher = forcing_prefetcher( \
+                    read_file_array, \
+                    convert_file_array, \
+                    enabled = self.model_flags['prefetch_forcing_flag'])
+        date = self.model_time.get_date(1)[0]
+        self.forcing_prefetcher.prefetch(date, self.get_forcing_requests(date))
+        
         # returns None
         return None
     
+    def get_forcing_requests(self, date):
+        '''
+get_forcing_requests: function that returns the requests to read the forcing \
+of the time step with the date specified as a dictionary with the name of the \
+request as key and the arguments of read_file_entry as value; this includes \
+the hydrological forcing and, if evaluated, the short-term water quality.
+
+'''
+        # initialize the requests
+        requests = {}
+        
+        # hydrological forcing: for daily time steps, the first value of the
+        # month is read
+        forcing_date = date
+        if self.model_time.time_increment == 'daily' and date.day != 1:
+            forcing_date = datetime.datetime(date.year, date.month, 1)
+        
+        for forcing_variable in forcing_variables.keys():
+            requests[('forcing', forcing_variable)] = { \
+                'filename'                : self.forcing_info[forcing_variable]['ncfilename'], \
+                'variablename'            : forcing_variable, \
+                'inputpath'               : self.forcing_info[forcing_variable]['inputpath'], \
+                'clone_attributes'        : self.model_configuration.clone_attributes, \
+                'datatype'                : self.forcing_info[forcing_variable]['datatype'], \
+                'date'                    : forcing_date, \
+                'date_selection_method'   : self.forcing_info[forcing_variable]['date_selection_method'], \
+                'allow_year_substitution' : self.forcing_info[forcing_variable]['allow_year_substitution'], \
+                'landmask'                : self.landmask, \
+                'cover_value'             : 0, \
+                }
+        
+        # short-term water quality
+        if self.model_flags['water_quality_flag']:
+            for key, forcing_info in self.water_quality_forcing_info.items():
+                requests[('water_quality', key)] = { \
+                    'filename'                : forcing_info['ncfilename'], \
+                    'variablename'            : forcing_info['ncvariable'], \
+                    'inputpath'               : forcing_info['inputpath'], \
+                    'clone_attributes'        : self.model_configuration.clone_attributes, \
+                    'datatype'                : pcr.Scalar, \
+                    'date'                    : date, \
+                    'date_selection_method'   : 'nearest', \
+                    'allow_year_substitution' : False, \
+                    'landmask'                : self.landmask, \
+                    'cover_value'             : 0, \
+                    }
+        
+        # return the requests
+        return requests
+    
     def update(self):
         
         # ***********
@@ -851,34 +1007,23 @@ class qualloc_model(object):
         # --------------------------------------------------------------------------------------------------------------------------------------------
         
         # [ forcing: hydrology ] ...................................................................
+        # get the requests of the forcing, which may have been prefetched
+        forcing_requests = self.get_forcing_requests(self.model_time.date)
+        
         # read in forcing datasets
         for forcing_variable in forcing_variables.keys():
             
-            # check if the model time-step is daily
-            if self.model_time.time_increment == 'daily':
-                if date.day != 1:
-                    
-                    # read the first value of the month
-                    date = datetime.datetime(date.year, date.month, 1)
-                    
-                    # log message
-                    logger.info('%s variable does not have daily data, first value of the month is therefore read.' % \
-                                 forcing_variable.lower())
+            # log message if the first value of the month is read for daily
+            # time steps, as set by the requests
+            if forcing_requests[('forcing', forcing_variable)]['date'] != self.model_time.date:
+                logger.info('%s variable does not have daily data, first value of the month is therefore read.' % \
+                             forcing_variable.lower())
             
             # get the field
-            var_out = read_file_entry( \
-                filename                 = self.forcing_info[forcing_variable]['ncfilename'], \
-                variablename            = forcing_variable, \
-                inputpath               = self.forcing_info[forcing_variable]['inputpath'], \
-                clone_attributes        = self.model_configuration.clone_attributes, \
-                datatype                = self.forcing_info[forcing_variable]['datatype'], \
-                date                    = date, \
-                date_selection_method   = self.forcing_info[forcing_variable]['date_selection_method'], \
-                allow_year_substitution = self.forcing_info[forcing_variable]['allow_year_substitution'], \
-                )
-            
-            # clip to land mask
-            var_out = pcr.ifthen(self.landmask, pcr.cover(var_out, 0))
+            var_out = self.forcing_prefetcher.read( \
+                self.model_time.date, \
+                ('forcing', forcing_variable), \
+                **forcing_requests[('forcing', forcing_variable)])
             
             # update totals to rates (m/day)
             # in standard setup:
@@ -907,29 +1052,21 @@ class qualloc_model(object):
                 
                 # get value if dataset is available
                 if self.model_flags['water_quality_flag']:
-                    # get the field
-                    var_out = read_file_entry( \
-                        filename                 = self.water_quality_forcing_info[key]['ncfilename'], \
-                        variablename            = self.water_quality_forcing_info[key]['ncvariable'], \
-                        inputpath               = self.water_quality_forcing_info[key]['inputpath'], \
-                        clone_attributes        = self.model_configuration.clone_attributes, \
-                        datatype                = pcr.Scalar, \
-                        date                    = self.model_time.date, \
-                        date_selection_method   = 'nearest', \
-                        allow_year_substitution = False, \
-                        )
+                    # get the field, clipped to the land mask with missing
+                    # values covered by zero concentration values
+                    var_out = self.forcing_prefetcher.read( \
+                        self.model_time.date, \
+                        ('water_quality', key), \
+                        **forcing_requests[('water_quality', key)])
                     
                     msg_str = 'information on %s %s short-term quality read for %s' % \
                                (source_name, constituent_name, self.model_time.date)
                 
                 # set zero value if dataset is not available
                 else:
-                    var_out = pcr.spatial(pcr.scalar(0))
+                    var_out = pcr.ifthen(self.landmask, pcr.spatial(pcr.scalar(0)))
                     msg_str = 'no %s %s short-term quality is given for %s; a value of zero is considered' % \
                                (source_name, constituent_name, self.model_time.date)
-                    
-                # cover NaN to zero concentration values and clip map to land mask
-                var_out = pcr.ifthen(self.landmask, pcr.cover(var_out, 0))
                 
                 # set the variable in dictionary
                 constituent_shortterm_quality[source_name][constituent_name] = var_out
@@ -948,6 +1085,13 @@ class qualloc_model(object):
             # set variable
             setattr(self.water_management.water_quality, 'constituent_shortterm_quality', constituent_shortterm_quality)
         
+        # [ forcing: prefetch ] ....................................................................
+        # submit the requests of the next time step, which are read while
+        # the current time step is computed
+        next_date = self.model_time.get_next_date()
+        if not isinstance(next_date, NoneType):
+            self.forcing_prefetcher.prefetch(next_date, self.get_forcing_requests(next_date))
+        
         # [ forcing: withdrawal capacity ] .........................................................
         # read in regional water pumping capacity (if activated)
         for source_name in self.water_management.source_names:
@@ -1052,7 +1196,7 @@ class qualloc_model(object):
         # update environmental water demand and priority if evaluated
         # based on the channel storage required to meet the environmental flow requirements
         # (units: m3/day)
-        prioritization = deepcopy(self.water_management.prioritization)
+        prioritization = copy_dicts(self.water_management.prioritization)
         
         # [ DELETEME ] verbose <----------------------------------------------------------------------------------------------------------------------
         if verbose:
@@ -1381,6 +1525,8 @@ class qualloc_model(object):
         # close the caches
         # initial conditions
         self.report_initial_conditions_to_file.close()
+        # forcing prefetcher, before its files are closed
+        self.forcing_prefetcher.shutdown()
         # main module
         close_nc_cache()
         
@@ -13,6 +13,7 @@ import qualloc_variable_list as variable_attr
 import pcraster as pcr
 
 from netCDF_recipes import netCDF_output_handler
+from file_handler import read_file_entry
 from allocation import get_key
 
 logger = logging.getLogger(__name__)
@@ -80,6 +81,85 @@ intervals  = { \
 #///start of file with class definitions///
 
 
+class report_accumulator(object):
+    
+    '''
+report_accumulator: record of a statistic of a reportable variable that is \
+accumulated over an interval; intervals of a month or less are updated every \
+time step from the variable, longer intervals are updated at the end of each \
+month from the accumulator of the same statistic for the monthly interval.
+
+    Attributes:
+    ===========
+    key:                    key of the process variable, consisting of the
+                            variable name, interval and statistic;
+    variablename:           name of the reportable variable;
+    interval:               name of the interval;
+    statistic:              name of the statistic: count, sum, ssq, min or max;
+    source:                 monthly accumulator for intervals longer than a
+                            month, otherwise None;
+    value:                  accumulated value.
+
+'''
+    
+    def __init__(self, variablename, interval, statistic):
+        
+        # initialize the object
+        object.__init__(self)
+        
+        # set the attributes
+        self.key          = '%s_%s_%s' % (variablename, interval, statistic)
+        self.variablename = variablename
+        self.interval     = interval
+        self.statistic    = statistic
+        self.source       = None
+        self.value        = None
+    
+    def reset(self):
+        '''resets the value to the initial value of the statistic'''
+        
+        if self.statistic == 'min':
+            self.value = pcr.spatial(pcr.scalar(1.0e12))
+        
+        elif self.statistic == 'max':
+            self.value = pcr.spatial(pcr.scalar(-1.0e12))
+        
+        elif self.statistic == 'count':
+            self.value = int(0)
+        
+        else:
+            self.value = pcr.spatial(pcr.scalar(0))
+        
+        # returns None
+        return None
+    
+    def get_increment(self, field):
+        '''returns the increment of the statistic for the field of a single time step'''
+        
+        if self.statistic == 'count':
+            return 1
+        elif self.statistic == 'ssq':
+            return pcr.scalar(field ** 2)
+        else:
+            return pcr.scalar(field)
+    
+    def update(self, increment):
+        '''updates the value with the increment, which is the monthly value for longer intervals'''
+        
+        if self.statistic == 'min':
+            self.value = pcr.min(self.value, increment)
+        
+        elif self.statistic == 'max':
+            self.value = pcr.max(self.value, increment)
+        
+        else:
+            self.value = self.value + increment
+        
+        # returns None
+        return None
+
+
+
 class qualloc_reporting(object):
     
     def __init__(self, model_configuration):
@@ -137,57 +217,30 @@ class qualloc_reporting(object):
         message_str   = 'Reporting variables are updated for the following intervals:'
         interval_list = []        
         
-        # initialize the information to process
-        variablename_info = {}
-        
-        # process per time interval
-        for interval in intervals.keys():
-            for process_variable in self.process_variables:
-                if interval in process_variable:
-                    
-                    # get the variable name
-                    ix = process_variable.find(interval)
-                    variablename = process_variable[ : ix - 1]
-                    statistic    = process_variable[ix + len(interval) + 1 :]
+        # process per time interval, the accumulators are compiled per interval
+        for interval, accumulators in self.reset_plan.items():
                     
-                    # update status set to False
-                    update_status = False
-                    
-                    if not isinstance(time_flag, NoneType) \
-                                      and interval in time_flag:
-                        
-                        if not isinstance(time_flag_condition, NoneType):
-                            update_status = time_flag_condition
-                    
-                    # set the update status if global
-                    if isinstance(time_flag, NoneType) \
-                                  and isinstance(time_flag_condition, NoneType):
-                        
-                        # set the update_status to True
-                        update_status = True
-                    
-                    # add the variable
-                    if update_status:
-                        if process_variable not in variablename_info.keys():
-                            variablename_info[process_variable] = (variablename, \
-                                                                   statistic)
-                        if interval not in interval_list:
-                            interval_list.append(interval)
-        
-        for key, (variablename, statistic) in variablename_info.items():
+            # update status set to False
+            update_status = False
             
-            # update the variable
-            if statistic == 'min':
-                vars(self)[key] = pcr.spatial(pcr.scalar(1.0e12))
-            
-            elif statistic == 'max':
-                vars(self)[key] = pcr.spatial(pcr.scalar(-1.0e12))
+            if not isinstance(time_flag, NoneType) \
+                              and interval in time_flag:
+                
+                if not isinstance(time_flag_condition, NoneType):
+                    update_status = time_flag_condition
             
-            elif statistic == 'count':
-                vars(self)[key] = int(0)
+            # set the update status if global
+            if isinstance(time_flag, NoneType) \
+                          and isinstance(time_flag_condition, NoneType):
+                
+                # set the update_status to True
+                update_status = True
             
-            else:
-                vars(self)[key] = pcr.spatial(pcr.scalar(0))                                  
+            # reset the accumulators
+            if update_status and len(accumulators) > 0:
+                for accumulator in accumulators:
+                    accumulator.reset()
+                interval_list.append(interval)
         
         # log the message string
         for interval in interval_list:
@@ -266,13 +319,22 @@ class qualloc_reporting(object):
                         if key not in self.process_variables:
                             self.process_variables.append(key)
         
-        # initialize the variables
+        # compile the reporting plan and initialize the variables
+        self.compile_reporting_plan()
         self.reset_values_at_time()
         
         # all variables added, next initialize the netCDF output files
         
-        # initialize the netCDF object
-        self.nc_handler = netCDF_output_handler(self.model_configuration)
+        # initialize the netCDF object with the land mask, which is used if
+        # the output is stored for the land cells only
+        landmask = read_file_entry( \
+                filename                = self.model_configuration.general['clone'], \
+                variablename            = 'landmask', \
+                inputpath               = self.model_configuration.general['inputpath'], \
+                clone_attributes        = self.model_configuration.clone_attributes, \
+                datatype                = pcr.Boolean, \
+                )
+        self.nc_handler = netCDF_output_handler(self.model_configuration, landmask)
         
         # get all the file names
         for report_interval in self.report_intervals:
@@ -320,6 +382,75 @@ class qualloc_reporting(object):
         # return None
         return None
 
+    def compile_reporting_plan(self):
+        '''
+        compile_reporting_plan: function that compiles the process variables
+                                into accumulators, grouped by the way in which
+                                they are updated and reset, and the reported
+                                intervals into outputs, so that the variable
+                                names, intervals and statistics are only parsed
+                                once.
+        '''
+        # create the accumulators from the keys of the process variables,
+        # which consist of the variable name, interval and statistic
+        self.accumulators = {}
+        for key in self.process_variables:
+            variablename, interval = key[:key.rfind('_')].rsplit('_', 1)
+            statistic = key[key.rfind('_') + 1:]
+            self.accumulators[key] = report_accumulator(variablename, interval, statistic)
+        
+        # group the accumulators: daily values are set every time step,
+        # weekly and monthly values are updated every time step and longer
+        # intervals at the end of the month from the monthly accumulator
+        self.daily_accumulators   = []
+        self.step_accumulators    = []
+        self.monthly_accumulators = []
+        self.reset_plan = dict((interval, []) for interval in intervals.keys())
+        for key in self.process_variables:
+            accumulator = self.accumulators[key]
+            if accumulator.interval == 'daily':
+                self.daily_accumulators.append(accumulator)
+            elif accumulator.interval in ['weekly', 'monthly']:
+                self.step_accumulators.append(accumulator)
+            else:
+                accumulator.source = self.accumulators['%s_%s_%s' % \
+                        (accumulator.variablename, 'monthly', accumulator.statistic)]
+                self.monthly_accumulators.append(accumulator)
+            if accumulator.interval in self.reset_plan.keys():
+                self.reset_plan[accumulator.interval].append(accumulator)
+        
+        # create the outputs per reported interval and variable with the
+        # accumulators of the statistics
+        self.outputs = []
+        for report_interval in self.report_intervals:
+            interval, statistic_key = report_interval.split('_')
+            for variablename in getattr(self, report_interval):
+                report_key = '%s_%s_%s' % (variablename, interval, statistic_key)
+                self.outputs.append({ \
+                        'report_interval': report_interval, \
+                        'variablename'   : variablename, \
+                        'statistic_key'  : statistic_key, \
+                        'ncfilename'     : os.path.join(self.model_configuration.netcdfpath, \
+                                                        str.join('', (report_key, '.nc'))), \
+                        'is_timed'       : variable_attr.netcdf_is_timed[variablename], \
+                        'accumulators'   : dict((statistic, accumulator) \
+                                                for statistic, accumulator in \
+                                                [(statistic, self.accumulators.get( \
+                                                  '%s_%s_%s' % (variablename, interval, statistic))) \
+                                                 for statistic in ['count', 'sum', 'ssq', 'min', 'max']] \
+                                                if not isinstance(accumulator, NoneType)), \
+                        })
+        
+        # the outputs per time flag are selected when first reported
+        self.output_plan = {}
+        
+        # log message
+        logger.debug('reporting plan compiled with %d accumulators and %d outputs' % \
+                     (len(self.accumulators), len(self.outputs)))
+        
+        # returns None
+        return None
+    
     def report(self, model_time, model):
         '''
         report: function of the module caleros_reporting which updates all the
@@ -329,72 +460,19 @@ class qualloc_reporting(object):
         # update the statistics first
         self.update_reportable_variables(model)
         
-        # iterate over the variables:
-        # update the weekly and monthly variables first
-        for key in self.process_variables:
-            
-            # process if daily or weekly or monthly
-            if 'daily' in key:
-                # get the variable name
-                ix = key.find('daily')
-                variablename = key[:ix - 1]
-                vars(self)[key] = pcr.scalar(vars(self)[variablename])
-            
-            elif 'weekly' in key or 'monthly' in key:
-                # get the variable name
-                if 'weekly' in key:
-                    ix = key.find('weekly')
-                elif 'monthly' in key:
-                    ix = key.find('monthly')
-                else:
-                    ix = None
-                variablename = key[:ix - 1]
-                
-                if 'count' in key:
-                    vars(self)[key] = vars(self)[key] + 1
-                
-                if 'sum' in key:
-                    vars(self)[key] = vars(self)[key] + pcr.scalar(vars(self)[variablename])
-                
-                if 'ssq' in key:
-                    vars(self)[key] = vars(self)[key] + pcr.scalar(vars(self)[variablename] ** 2)
-                
-                if 'min' in key:
-                    vars(self)[key] = pcr.min(vars(self)[key], pcr.scalar(vars(self)[variablename]))
-                
-                if 'max' in key:
-                    vars(self)[key] =  pcr.max(vars(self)[key], pcr.scalar(vars(self)[variablename]))
-            else:
-                pass
+        # update the accumulators following the compiled plan:
+        # daily values are set, weekly and monthly values are updated every
+        # time step and longer intervals from the monthly values
+        for accumulator in self.daily_accumulators:
+            accumulator.value = pcr.scalar(getattr(self, accumulator.variablename))
+        
+        for accumulator in self.step_accumulators:
+            accumulator.update(accumulator.get_increment( \
+                               getattr(self, accumulator.variablename)))
         
-        # update the other variables
         if model_time.report_flags['monthly']:
-            for key in self.process_variables:
-                if not 'daily' in key and not 'weekly' in key and not 'monthly' in key:
-                    
-                    # get the corresponding monthly key
-                    ix = key.rfind('_')
-                    statistic = key[ix+1:]
-                    monthly_key = key[:ix]
-                    ix = monthly_key.rfind('_')
-                    monthly_key = monthly_key[:ix]
-                    monthly_key = '%s_%s_%s' % \
-                        (monthly_key, 'monthly', statistic)
-                    # update the key
-                    if 'count' in key:
-                        vars(self)[key] = vars(self)[key] + vars(self)[monthly_key] 
-                    
-                    if 'sum' in key:
-                        vars(self)[key] = vars(self)[key] +vars(self)[monthly_key] 
-                    
-                    if 'ssq' in key:
-                        vars(self)[key] = vars(self)[key] + vars(self)[monthly_key] 
-                    
-                    if 'min' in key:
-                        vars(self)[key] = pcr.min(vars(self)[key], vars(self)[monthly_key])
-                    
-                    if 'max' in key:
-                        vars(self)[key] =  pcr.max(vars(self)[key], vars(self)[monthly_key])
+            for accumulator in self.monthly_accumulators:
+                accumulator.update(accumulator.source.value)
         
         # all updated, report the intervals
         for time_flag in model_time.report_flags.keys():
@@ -405,108 +483,63 @@ class qualloc_reporting(object):
                 # log message
                 logger.info('reporting any %s output for %s' % (time_flag, model_time.date))
                 
-                # get the reportable variables
-                for report_interval in self.report_intervals:
-                    if time_flag in report_interval:
-                        
-                        # get the interval and statistic
-                        interval, statistic_key = report_interval.split('_')
-                        
-                        # iterate over the variables
-                        for variablename in getattr(self, report_interval):
-                            
-                            # set the report key and the process key
-                            report_key = '%s_%s_%s' % (variablename, interval, statistic_key)
-                            
-                            # get the corresponding statistic: for the min, max and avg
-                            # no post-processing is required, for the average and the
-                            # standard deviation additional post-processing is needed
-                            if statistic_key == 'min':
-                                # get the minimum
-                                process_key = '%s_%s_%s' % (variablename, interval, statistic_key)
-                                
-                                # get the value field
-                                value_field = vars(self)[process_key]
-                            
-                            elif statistic_key == 'max':
-                                # get the maximum
-                                process_key = '%s_%s_%s' % (variablename, interval, statistic_key)
-                                
-                                # get the value field
-                                value_field = vars(self)[process_key]
-                            
-                            elif statistic_key == 'tot':
-                                # get the total
-                                process_key = '%s_%s_%s' % (variablename, interval, 'sum')
-                                
-                                # get the value field
-                                value_field = vars(self)[process_key]
-                            
-                            elif statistic_key == 'avg':
-                                # get the average
-                                process_key = '%s_%s_%s' % (variablename, interval, 'sum')
-                                
-                                # get the value field
-                                value_field = vars(self)[process_key]
-                                
-                                # get the average
-                                process_key = '%s_%s_%s' % (variablename, interval, 'count')
-                                
-                                # get the value field
-                                value_field = value_field / vars(self)[process_key] 
-                            
-                            elif statistic_key == 'std':
-                                # get the standard deviation
-                                process_key = '%s_%s_%s' % (variablename, interval, 'sum')
-                                
-                                # get the value field
-                                value_field = vars(self)[process_key] ** 2
-                                
-                                # get the number
-                                process_key = '%s_%s_%s' % (variablename, interval, 'count')
-                                
-                                # get the value field
-                                value_field = value_field / vars(self)[process_key] 
-                                
-                                # get the sum of squares
-                                process_key = '%s_%s_%s' % (variablename, interval, 'ssq')
-                                
-                                # get the value field
-                                value_field = vars(self)[process_key] - value_field
-                                
-                                # get the number
-                                process_key = '%s_%s_%s' % (variablename, interval, 'count')
-                                
-                                # get the value field
-                                value_field = value_field / vars(self)[process_key] 
-                                
-                                # get the square root
-                                value_field = value_field ** 0.5
-                            
-                            else:
-                                pass
-                            
-                            # call the function to add the variable for spatial data
-                            # get the file name
-                            ncfilename = os.path.join(self.model_configuration.netcdfpath, \
-                                          str.join('', (report_key, '.nc')))
-                            
-                            # get the dates for timed variables
-                            if variable_attr.netcdf_is_timed[variablename]:
-                                is_timed = True
-                                dates    = [model_time.date]
-                            else:
-                                is_timed = False
-                                dates    = None
-                            
-                            # add the data
-                            self.nc_handler.add_data_to_netCDF( \
-                                ncfilename     = ncfilename, \
-                                variablename   = variablename, \
-                                variable_array = pcr.pcr2numpy(value_field, \
-                                                                self.nc_handler.default_fill_value), \
-                                is_timed       = is_timed, \
-                                dates          = dates)
+                # get the compiled outputs of the reportable variables
+                if not time_flag in self.output_plan.keys():
+                    self.output_plan[time_flag] = [output for output in self.outputs \
+                                                   if time_flag in output['report_interval']]
+                
+                for output in self.output_plan[time_flag]:
+                    
+                    # get the corresponding statistic: for the min, max and avg
+                    # no post-processing is required, for the average and the
+                    # standard deviation additional post-processing is needed
+                    statistic_key = output['statistic_key']
+                    accumulators  = output['accumulators']
+                    
+                    if statistic_key == 'min' or statistic_key == 'max':
+                        # get the minimum or maximum
+                        value_field = accumulators[statistic_key].value
+                    
+                    elif statistic_key == 'tot':
+                        # get the total
+                        value_field = accumulators['sum'].value
+                    
+                    elif statistic_key == 'avg':
+                        # get the average
+                        value_field = accumulators['sum'].value / \
+                                      accumulators['count'].value
+                    
+                    elif statistic_key == 'std':
+                        # get the standard deviation from the sum of squares
+                        # and the squared sum
+                        value_field = accumulators['sum'].value ** 2 / \
+                                      accumulators['count'].value
+                        value_field = (accumulators['ssq'].value - value_field) / \
+                                      accumulators['count'].value
+                        value_field = value_field ** 0.5
+                    
+                    else:
+                        pass
+                    
+                    # get the dates for timed variables
+                    dates = None
+                    if output['is_timed']:
+                        dates = [model_time.date]
+                    
+                    # add the data
+                    self.nc_handler.add_data_to_netCDF( \
+                        ncfilename     = output['ncfilename'], \
+                        variablename   = output['variablename'], \
+                        variable_array = pcr.pcr2numpy(value_field, \
+                                                        self.nc_handler.default_fill_value), \
+                        is_timed       = output['is_timed'], \
+                        dates          = dates)
+        
+        # all written, synchronize the files to disk if due; the end of the
+        # year is the restart point at which the states are written
+        self.nc_handler.finalize_time_step( \
+                end_of_year   = model_time.report_flags['yearly'], \
+                restart_point = model_time.report_flags['yearly'])
         
         # all updated, reset the variables
         for time_flag, time_flag_condition in model_time.report_flags.items():
@@ -788,6 +821,9 @@ report: function to report recursively the initial conditions as netCDF files.
                     logger.debug('Information written for initial condition %s for %s' % \
                                  (variablename, module))   
 
+        # the states are the restart point and are synchronized at once
+        self.nc_handler.sync()
+        
         # log message
         logger.info('Reported initial conditions for %s' % date)
                         
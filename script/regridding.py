@@ -0,0 +1,661 @@
+# regridding module of the QUAlloc model
+
+# this module provides the in-process resampling of spatial data that do not
+# match the clone: the geometry of a regular source grid, given by the
+# coordinates of its cell centres, is compared once with that of the clone and
+# stored as the window of the source grid that covers the clone together with
+# the source cell, target cell and weight of each contribution, which is a
+# sparse matrix in coordinate form; the resampled values are then obtained
+# from the values read over the window only by a weighted sum per clone cell
+# that disregards any missing values.
+# The weights are computed once per source grid, clone and resample method and
+# can be stored on disk to be reused by subsequent runs.
+# Three resample methods are available: nearest neighbour, bilinear
+# interpolation and the block average of all source cells that have their
+# centre within a clone cell. Source grids with the resolution of the clone
+# and cells that are aligned with it, e.g., global input for a regional clone,
+# are not resampled but only read over the window of the clone.
+
+# modules
+import os
+import hashlib
+import logging
+
+import numpy as np
+
+# global variables
+
+# resample methods that are supported in-process; the window method applies
+# to aligned grids of the same resolution and does not resample the values
+resample_methods = ['window', 'nearest', 'bilinear', 'average']
+
+# relative precision used to test whether an axis is regular and whether the
+# source grid is finer than the clone
+resample_precision = 1.0e-3
+
+# regridders, identified by the signatures of the source grid and the clone
+# and by the resample method; the grids are fixed for the run and the regridders
+# are kept once computed; if the cache path is set, the weights are also stored
+# on disk to be reused by subsequent runs
+cached_regridders    = {}
+regridder_cache_path = None
+
+# type of None, compatible with python 2.6
+NoneType = type(None)
+
+logger = logging.getLogger(__name__)
+
+#############
+# functions #
+#############
+
+def get_axis_step(axis_values):
+
+    '''
+get_axis_step: returns the step between the cell centres of a regular axis; \
+None is returned if the axis holds less than two values or is not regular.
+
+'''
+
+    # get the axis and its increments
+    axis_values = np.asarray(axis_values, dtype = np.float64).ravel()
+    if axis_values.size < 2:
+        return None
+
+    increments = np.diff(axis_values)
+    step = (axis_values[-1] - axis_values[0]) / (axis_values.size - 1)
+
+    # test whether the axis is regular
+    if step == 0 or \
+            np.abs(increments - step).max() > resample_precision * abs(step):
+        return None
+
+    # return the step
+    return step
+
+def get_clone_coordinates(clone_attributes):
+
+    '''
+get_clone_coordinates: returns the coordinates of the cell centres and cell \
+edges of the clone along the x-axis from west to east and along the y-axis \
+from north to south.
+
+'''
+
+    # get the number of cells and the position of the cells
+    number_cols = clone_attributes.numberCols
+    number_rows = clone_attributes.numberRows
+
+    x_edges = clone_attributes.xLL + \
+              np.arange(number_cols + 1) * clone_attributes.xResolution
+    y_edges = clone_attributes.yUR - \
+              np.arange(number_rows + 1) * clone_attributes.yResolution
+
+    # return the centres and edges
+    return 0.5 * (x_edges[:-1] + x_edges[1:]), 0.5 * (y_edges[:-1] + y_edges[1:]), \
+           x_edges, y_edges
+
+def select_resample_method(resample_method, resample_ratio):
+
+    '''
+select_resample_method: returns the in-process resample method for the resample \
+method of the data type and the ratio of the resolution of the source grid over \
+that of the clone: continuous data are interpolated bilinearly if the source \
+grid is as coarse as the clone or coarser and are block averaged otherwise; all \
+other data are resampled by their nearest neighbour.
+
+'''
+
+    # continuous data
+    if resample_method in ['bilinear', 'bicubic', 'average']:
+        if resample_ratio < 1.0 - resample_precision:
+            return 'average'
+        else:
+            return 'bilinear'
+
+    # all other data
+    return 'nearest'
+
+def get_nearest_cells(positions, number_cells):
+
+    '''
+get_nearest_cells: returns the index of the nearest source cell for each of the \
+fractional positions on a source axis and a mask of the positions that lie \
+within the source extent.
+
+'''
+
+    # get the nearest index
+    cells = np.floor(positions + 0.5).astype(np.int64)
+    mask = (cells >= 0) & (cells < number_cells)
+
+    # return the cells and mask
+    return cells, mask
+
+def get_bilinear_cells(positions, number_cells):
+
+    '''
+get_bilinear_cells: returns the indices of the two neighbouring source cells \
+and their weights for each of the fractional positions on a source axis and \
+a mask of the positions that lie within the source extent; positions between \
+the outer cell centres and the edge of the source extent take the value of the \
+outer cell.
+
+'''
+
+    # get the mask and clamp the positions on the outer cell centres
+    mask = (positions >= -0.5) & (positions < number_cells - 0.5)
+    positions = np.clip(positions, 0, number_cells - 1)
+
+    # get the cells and weights
+    lower_cells = np.floor(positions).astype(np.int64)
+    upper_cells = np.minimum(lower_cells + 1, number_cells - 1)
+    upper_weights = positions - lower_cells
+
+    # return the cells, weights and mask
+    return (lower_cells, upper_cells), (1.0 - upper_weights, upper_weights), mask
+
+def get_covering_cells(source_centres, target_edges):
+
+    '''
+get_covering_cells: returns the index of the target cell that covers the centre \
+of each source cell along an axis, given the edges of the target cells in \
+increasing or decreasing order, and a mask of the source cells that are covered.
+
+'''
+
+    # get the position of the source centres relative to the target edges
+    step = target_edges[1] - target_edges[0]
+    cells = np.floor((source_centres - target_edges[0]) / step).astype(np.int64)
+    mask = (cells >= 0) & (cells < target_edges.size - 1)
+
+    # return the cells and mask
+    return cells, mask
+
+def get_window(*cells):
+
+    '''
+get_window: returns the first and last index plus one of all source cells that \
+are used along an axis; None is returned if no cells are used.
+
+'''
+
+    # get all cells used
+    cells = np.concatenate([np.asarray(entry).ravel() for entry in cells])
+    if cells.size == 0:
+        return None
+
+    # return the window
+    return int(cells.min()), int(cells.max()) + 1
+
+def get_aligned_window(x_values, y_values, x_step, y_step, clone_attributes):
+
+    '''
+get_aligned_window: returns the window of the source grid that coincides with \
+the clone if the source grid has the same resolution as the clone, its cells \
+are aligned with those of the clone and it covers the clone entirely, and \
+whether the rows of the window have to be flipped as the y-coordinates \
+increase; None is returned otherwise.
+
+'''
+
+    # test the resolution
+    if abs(abs(x_step) / clone_attributes.xResolution - 1) > resample_precision or \
+       abs(abs(y_step) / clone_attributes.yResolution - 1) > resample_precision:
+        return None
+
+    # get the fractional position of the outer cells of the clone on the axes
+    # of the source grid and test whether these are aligned
+    x_centres, y_centres = get_clone_coordinates(clone_attributes)[:2]
+    positions = np.array([(x_centres[0]  - x_values[0]) / x_step, \
+                          (x_centres[-1] - x_values[0]) / x_step, \
+                          (y_centres[0]  - y_values[0]) / y_step, \
+                          (y_centres[-1] - y_values[0]) / y_step])
+    cells = np.round(positions).astype(np.int64)
+    if np.abs(positions - cells).max() > resample_precision:
+        return None
+
+    # get the window, which is read from the north if the y-coordinates
+    # decrease and from the south otherwise
+    flip_rows = y_step > 0
+    x_window = (cells[0], cells[1] + 1)
+    if flip_rows:
+        y_window = (cells[3], cells[2] + 1)
+    else:
+        y_window = (cells[2], cells[3] + 1)
+
+    # test whether the clone is covered
+    if x_window[0] < 0 or x_window[1] > x_values.size or \
+       y_window[0] < 0 or y_window[1] > y_values.size:
+        return None
+
+    # return the window and the orientation
+    return y_window + x_window, flip_rows
+
+def get_nearest_contributions(positions, number_cells):
+
+    '''
+get_nearest_contributions: returns the source cells, target cells and weights \
+along an axis for the nearest neighbour.
+
+'''
+
+    # get the nearest cells of the target cells within the extent
+    cells, mask = get_nearest_cells(positions, number_cells)
+    target_cells = np.flatnonzero(mask)
+
+    # return the contributions
+    return cells[mask], target_cells, np.ones(target_cells.size)
+
+def get_bilinear_contributions(positions, number_cells):
+
+    '''
+get_bilinear_contributions: returns the source cells, target cells and weights \
+along an axis for the bilinear interpolation.
+
+'''
+
+    # get the two neighbouring cells of the target cells within the extent
+    cells, weights, mask = get_bilinear_cells(positions, number_cells)
+    target_cells = np.flatnonzero(mask)
+
+    # return the contributions
+    return np.concatenate([entry[mask] for entry in cells]), \
+           np.concatenate((target_cells, target_cells)), \
+           np.concatenate([entry[mask] for entry in weights])
+
+def get_covering_contributions(source_centres, target_edges):
+
+    '''
+get_covering_contributions: returns the source cells, target cells and weights \
+along an axis for the block average.
+
+'''
+
+    # get the target cells of all covered source cells
+    cells, mask = get_covering_cells(source_centres, target_edges)
+    source_cells = np.flatnonzero(mask)
+
+    # return the contributions
+    return source_cells, cells[mask], np.ones(source_cells.size)
+
+def get_regridder_weights(x_values, y_values, x_step, y_step, \
+                          clone_attributes, resample_method):
+
+    '''
+get_regridder_weights: returns the window of the source grid that covers the \
+clone and the source cells, target cells and weights of all contributions for \
+the in-process resample method specified; the contributions are obtained per \
+axis and combined as their outer product.
+
+'''
+
+    # get the shape and the coordinates of the clone
+    shape = clone_attributes.numberRows, clone_attributes.numberCols
+    x_centres, y_centres, x_edges, y_edges = \
+               get_clone_coordinates(clone_attributes)
+
+    # get the contributions along each axis as a tuple of the source
+    # cells, target cells and weights
+    if resample_method == 'average':
+
+        # all source cells with their centre in a target cell
+        x_axis = get_covering_contributions(x_values, x_edges)
+        y_axis = get_covering_contributions(y_values, y_edges)
+
+    else:
+
+        # get the fractional position of the target cells on the axes of
+        # the source grid
+        x_positions = (x_centres - x_values[0]) / x_step
+        y_positions = (y_centres - y_values[0]) / y_step
+
+        if resample_method == 'bilinear':
+            x_axis = get_bilinear_contributions(x_positions, x_values.size)
+            y_axis = get_bilinear_contributions(y_positions, y_values.size)
+        else:
+            x_axis = get_nearest_contributions(x_positions, x_values.size)
+            y_axis = get_nearest_contributions(y_positions, y_values.size)
+
+    # set the window
+    x_window = get_window(x_axis[0])
+    y_window = get_window(y_axis[0])
+    if isinstance(x_window, NoneType) or isinstance(y_window, NoneType):
+        x_window = (0, 0); y_window = (0, 0)
+    window = y_window + x_window
+
+    # combine the contributions along both axes: the source cells are
+    # relative to the window, the target cells are flat indices in the clone
+    window_cols = x_window[1] - x_window[0]
+    source_cells = ((y_axis[0][:, None] - y_window[0]) * window_cols + \
+                    (x_axis[0][None, :] - x_window[0])).ravel()
+    target_cells = (y_axis[1][:, None] * shape[1] + \
+                    x_axis[1][None, :]).ravel()
+    weights = (y_axis[2][:, None] * x_axis[2][None, :]).ravel()
+
+    # return the window and contributions
+    return window, source_cells, target_cells, weights
+
+def get_grid_signature(x_values, y_values):
+
+    '''
+get_grid_signature: returns the signature of a source grid as the number of \
+cells and the first and last coordinate along the x- and y-axis.
+
+'''
+
+    # get the signature per axis
+    signature = ()
+    for axis_values in (x_values, y_values):
+        axis_values = np.asarray(axis_values, dtype = np.float64).ravel()
+        signature += (axis_values.size, \
+                      '%.10g' % axis_values[0], \
+                      '%.10g' % axis_values[-1])
+
+    # return the signature
+    return signature
+
+def get_clone_signature(clone_attributes):
+
+    '''
+get_clone_signature: returns the signature of the clone as its number of rows \
+and columns, the coordinates of its upper left corner and its resolution.
+
+'''
+
+    # return the signature
+    return (clone_attributes.numberRows, clone_attributes.numberCols, \
+            '%.10g' % clone_attributes.xLL, '%.10g' % clone_attributes.yUR, \
+            '%.10g' % clone_attributes.xResolution, \
+            '%.10g' % clone_attributes.yResolution)
+
+def set_regridder_cache_path(path):
+
+    '''
+set_regridder_cache_path: sets the path where the weights of the regridders \
+are stored to be reused by subsequent runs; if None, the weights are only \
+kept in memory for the duration of the run.
+
+'''
+
+    # set the global path and create it if needed
+    global regridder_cache_path
+    regridder_cache_path = path
+    if not isinstance(path, NoneType) and not os.path.isdir(path):
+        os.makedirs(path)
+
+    # log the setting
+    logger.debug('regridding weights are stored in %s' % path)
+
+    # returns None
+    return None
+
+def get_regridder_filename(key):
+
+    '''
+get_regridder_filename: returns the name of the file in the regridder cache \
+path that holds the weights of the regridder identified by its key.
+
+'''
+
+    # return the file name
+    return os.path.join(regridder_cache_path, 'regridder_%s.npz' % \
+                        hashlib.md5(repr(key).encode('utf-8')).hexdigest())
+
+def read_regridder(key):
+
+    '''
+read_regridder: returns the regridder identified by its key from the regridder \
+cache path or None if it is not available.
+
+'''
+
+    # set the default output
+    regridder = None
+
+    # read the weights if the file exists and holds the same key
+    if not isinstance(regridder_cache_path, NoneType):
+
+        filename = get_regridder_filename(key)
+        if os.path.isfile(filename):
+            try:
+                with np.load(filename) as entries:
+                    if str(entries['key']) == repr(key):
+                        regridder = regridder_weights( \
+                                        tuple(entries['shape']), \
+                                        str(entries['resample_method']), \
+                                        tuple(entries['window']), \
+                                        entries['source_cells'], \
+                                        entries['target_cells'], \
+                                        entries['weights'])
+            except Exception:
+                logger.warning('regridding weights could not be read from %s' % \
+                               filename)
+
+    # return the regridder
+    return regridder
+
+def write_regridder(key, regridder):
+
+    '''
+write_regridder: writes the weights of the regridder identified by its key to \
+the regridder cache path, if set, by way of a temporary file that is renamed \
+once complete, so that concurrent runs only find complete weights.
+
+'''
+
+    # write the weights
+    if not isinstance(regridder_cache_path, NoneType):
+
+        filename = get_regridder_filename(key)
+        temporary_filename = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            # the file is passed as an object, else .npz is appended to its name
+            with open(temporary_filename, 'wb') as regridder_file:
+                np.savez(regridder_file, \
+                         key             = repr(key), \
+                         shape           = regridder.shape, \
+                         resample_method = regridder.resample_method, \
+                         window          = regridder.window, \
+                         source_cells    = regridder.source_cells, \
+                         target_cells    = regridder.target_cells, \
+                         weights         = regridder.weights)
+            os.replace(temporary_filename, filename)
+        except Exception:
+            logger.warning('regridding weights could not be written to %s' % \
+                           filename)
+            if os.path.isfile(temporary_filename):
+                os.remove(temporary_filename)
+
+    # returns None
+    return None
+
+def get_regridder(x_values, y_values, clone_attributes, resample_method):
+
+    '''
+get_regridder: returns the regridder that resamples data on the regular source \
+grid, defined by the coordinates of its cell centres, to the clone, or None if \
+the source grid is not regular or does not overlap with the clone. Regridders \
+are identified by the signatures of the source grid and the clone and the \
+resample method; they are computed on first use and cached for the duration of \
+the run and, if a regridder cache path is set, read from or written to disk.
+
+    Input:
+    ======
+    x_values:               coordinates of the cell centres of the source grid
+                            along the x-axis in increasing order;
+    y_values:               coordinates of the cell centres of the source grid
+                            along the y-axis in increasing or decreasing order;
+    clone_attributes:       spatial attributes of the clone;
+    resample_method:        resample method of the data type, which is
+                            translated into an in-process resample method.
+
+    Output:
+    =======
+    regridder:              regridder instance or None.
+
+'''
+
+    # get the key and return the cached regridder if available
+    key = get_grid_signature(x_values, y_values) + \
+          get_clone_signature(clone_attributes) + (resample_method,)
+    if key in cached_regridders:
+        return cached_regridders[key]
+
+    # set the default output
+    regridder = read_regridder(key)
+
+    # get the steps of the axes
+    x_step = get_axis_step(x_values)
+    y_step = get_axis_step(y_values)
+
+    # read the window only if the source grid is aligned with the clone
+    aligned_window = None
+    if isinstance(regridder, NoneType) and \
+            not isinstance(x_step, NoneType) and \
+            not isinstance(y_step, NoneType) and x_step > 0:
+        aligned_window = get_aligned_window( \
+                               np.asarray(x_values, dtype = np.float64).ravel(), \
+                               np.asarray(y_values, dtype = np.float64).ravel(), \
+                               x_step, y_step, clone_attributes)
+
+    if not isinstance(aligned_window, NoneType):
+
+        # set the regridder without contributions
+        window, flip_rows = aligned_window
+        regridder = regridder_weights( \
+                        (clone_attributes.numberRows, clone_attributes.numberCols), \
+                        'window', window, [], [], [], flip_rows = flip_rows)
+
+        # log the message
+        logger.debug('input for %s is read over the window %s of the clone' % \
+                     (str(key), str(window)))
+
+    elif isinstance(regridder, NoneType) and \
+            not isinstance(x_step, NoneType) and \
+            not isinstance(y_step, NoneType) and x_step > 0:
+
+        # get the resample method
+        resample_ratio = max(abs(x_step) / clone_attributes.xResolution, \
+                             abs(y_step) / clone_attributes.yResolution)
+        selected_method = select_resample_method(resample_method, resample_ratio)
+
+        # get the weights
+        window, source_cells, target_cells, weights = \
+                get_regridder_weights(np.asarray(x_values, dtype = np.float64).ravel(), \
+                                      np.asarray(y_values, dtype = np.float64).ravel(), \
+                                      x_step, y_step, clone_attributes, \
+                                      selected_method)
+
+        if weights.size > 0:
+            regridder = regridder_weights( \
+                            (clone_attributes.numberRows, clone_attributes.numberCols), \
+                            selected_method, window, \
+                            source_cells, target_cells, weights)
+            write_regridder(key, regridder)
+
+        # log the message
+        logger.debug('regridding weights computed for %s by %s resampling' % \
+                     (str(key), selected_method))
+
+    # cache and return the regridder
+    cached_regridders[key] = regridder
+    return regridder
+
+###################
+# class definition #
+###################
+
+class regridder_weights(object):
+
+    '''
+regridder_weights: weights to resample data on a regular source grid to the \
+clone, stored as the window of the source grid that covers the clone and, per \
+contribution, the source cell in the window, the target cell in the clone and \
+the weight; this is a sparse matrix in coordinate form that is applied to the \
+values of the window as a single weighted sum per target cell.
+
+    Attributes:
+    ===========
+    shape:                  number of rows and columns of the clone;
+    resample_method:        in-process resample method;
+    window:                 first and last row plus one and first and last
+                            column plus one of the window in the source grid;
+    source_cells:           flat index of the source cell in the window per
+                            contribution;
+    target_cells:           flat index of the target cell in the clone per
+                            contribution;
+    weights:                weight per contribution;
+    number_weights:         number of contributions;
+    flip_rows:              flag whether the rows of the window are flipped
+                            to match the clone if the window is not resampled.
+
+'''
+
+    def __init__(self, shape, resample_method, window, \
+                 source_cells, target_cells, weights, flip_rows = False):
+
+        # init object
+        object.__init__(self)
+
+        # set the shape, resample method and window
+        self.shape = tuple(int(entry) for entry in shape)
+        self.resample_method = resample_method
+        self.window = tuple(int(entry) for entry in window)
+
+        # set the contributions
+        self.source_cells = np.asarray(source_cells, dtype = np.int64)
+        self.target_cells = np.asarray(target_cells, dtype = np.int64)
+        self.weights      = np.asarray(weights, dtype = np.float64)
+        self.number_weights = self.weights.size
+        self.flip_rows = flip_rows
+
+    def resample(self, values, missing_value):
+
+        '''
+resample: returns the values on the clone as a two-dimensional array for the \
+values read over the window of the source grid; missing values and values \
+outside the source extent are set to the missing value specified.
+
+'''
+
+        # window: the values are returned as read with missing values set to
+        # the missing value
+        if self.resample_method == 'window':
+            values = np.ma.filled(values, missing_value).reshape(self.shape)
+            if self.flip_rows:
+                values = values[::-1, :]
+            return values
+
+        # get the values of the window as a flat array with missing values
+        # set to the missing value
+        values = np.ma.filled(values, missing_value).reshape(-1)
+
+        # nearest neighbour: copy the values and retain the data type
+        if self.resample_method == 'nearest':
+            resampled_values = np.full(self.shape[0] * self.shape[1], \
+                                       missing_value, \
+                                       dtype = np.result_type(values, missing_value))
+            resampled_values[self.target_cells] = values[self.source_cells]
+
+        # weighted average over all valid source cells
+        else:
+            source_values = values[self.source_cells].astype(np.float64)
+            valid = ~np.isnan(source_values) & (source_values != missing_value)
+            weights = np.where(valid, self.weights, 0.0)
+
+            number_cells = self.shape[0] * self.shape[1]
+            total_weights = np.bincount(self.target_cells, weights, \
+                                        minlength = number_cells)
+            total_values  = np.bincount(self.target_cells, \
+                                        weights * np.where(valid, source_values, 0.0), \
+                                        minlength = number_cells)
+
+            resampled_values = np.full(number_cells, missing_value, dtype = np.float64)
+            mask = total_weights > 0
+            resampled_values[mask] = total_values[mask] / total_weights[mask]
+
+        # return the resampled values
+        return resampled_values.reshape(self.shape)
+
+# end of the regridding module
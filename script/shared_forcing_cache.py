@@ -0,0 +1,240 @@
+# shared forcing cache module of the QUAlloc model
+
+# this module provides a cache of netCDF input on disk that is shared by the
+# clones of a parallel run, which run as separate processes on the same node:
+# the full field of a variable at a time step, the slab, is read from the
+# netCDF file by the first process that requests it and is stored as a numpy
+# file from which all processes map the window of their clone; the slabs are
+# identified by the netCDF file, its time of modification and size, the
+# variable and the index of the time step.
+# A process that finds another process reading the same slab waits for it
+# and reads the slab itself if it is not written within the time-out; locks
+# that are older than the time-out are left by a process that has failed and
+# are removed, after which the slab is read by the next process.
+# The cache is best placed on a memory-backed file system, e.g., /dev/shm, so
+# that the slabs are shared in memory; slabs that are older than the lifetime
+# and locks and temporary files that are older than the time-out are removed
+# when new slabs are written.
+
+# modules
+import os
+import time
+import hashlib
+import logging
+
+import numpy as np
+
+# global variables
+
+# path of the shared cache, which is not used if None, the lifetime of the
+# slabs [s] and the time-out [s] and interval [s] to wait for a slab that is
+# read by another process
+shared_cache_path     = None
+shared_cache_lifetime = 3600.0
+shared_cache_timeout  = 600.0
+shared_cache_interval = 0.1
+
+# type of None, compatible with python 2.6
+NoneType = type(None)
+
+logger = logging.getLogger(__name__)
+
+#############
+# functions #
+#############
+
+def set_shared_cache_path(path, lifetime = None):
+
+    '''
+set_shared_cache_path: sets the path of the forcing cache that is shared by \
+the clones of a parallel run and, optionally, the lifetime of the slabs in \
+seconds; if the path is None, the shared cache is not used.
+
+'''
+
+    # set the global path and lifetime and create the path if needed; the
+    # path may be created at the same time by other processes
+    global shared_cache_path, shared_cache_lifetime
+    shared_cache_path = path
+    if not isinstance(lifetime, NoneType):
+        shared_cache_lifetime = lifetime
+    if not isinstance(path, NoneType) and not os.path.isdir(path):
+        os.makedirs(path, exist_ok = True)
+
+    # log the setting
+    logger.debug('netCDF input is shared through %s' % path)
+
+    # returns None
+    return None
+
+def use_shared_cache():
+
+    '''returns True if the shared forcing cache is used'''
+
+    return not isinstance(shared_cache_path, NoneType)
+
+def get_slab_filename(key):
+
+    '''
+get_slab_filename: returns the name of the file in the shared cache that holds \
+the slab identified by its key.
+
+'''
+
+    # return the file name
+    return os.path.join(shared_cache_path, 'slab_%s.npy' % \
+                        hashlib.md5(repr(key).encode('utf-8')).hexdigest())
+
+def load_slab(filename):
+
+    '''returns the slab stored in the file name specified, mapped in memory, or None if it cannot be read'''
+
+    try:
+        return np.load(filename, mmap_mode = 'r')
+    except Exception:
+        return None
+
+def write_slab(filename, slab):
+
+    '''
+write_slab: writes the slab to the file name specified by way of a temporary \
+file that is renamed once complete, so that other processes only find \
+complete slabs.
+
+'''
+
+    # write the slab
+    temporary_filename = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        with open(temporary_filename, 'wb') as slab_file:
+            np.save(slab_file, slab)
+        os.replace(temporary_filename, filename)
+    except Exception:
+        logger.warning('slab could not be written to %s' % filename)
+        if os.path.isfile(temporary_filename):
+            os.remove(temporary_filename)
+
+    # returns None
+    return None
+
+def remove_expired_file(filename, time_limit):
+
+    '''
+remove_expired_file: removes the file specified if it was last modified before \
+the time limit; returns True if the file was removed and False otherwise, \
+including when it was removed by another process.
+
+'''
+
+    # remove the file
+    try:
+        if os.path.getmtime(filename) < time_limit:
+            os.remove(filename)
+            return True
+    except OSError:
+        pass
+    return False
+
+def prune_shared_cache():
+
+    '''
+prune_shared_cache: removes all slabs from the shared cache that are older \
+than their lifetime and all locks and temporary files that are older than the \
+time-out, which are left by processes that have failed.
+
+'''
+
+    # get the time limits
+    current_time = time.time()
+    time_limit = current_time - shared_cache_lifetime
+    lock_time_limit = current_time - shared_cache_timeout
+
+    # remove the files; these may be removed by other processes as well and
+    # any processes that have mapped a slab keep access to it
+    for filename in os.listdir(shared_cache_path):
+        if filename.startswith('slab_'):
+            if filename.endswith('.npy'):
+                remove_expired_file(os.path.join(shared_cache_path, filename), \
+                                    time_limit)
+            elif filename.endswith('.lock') or filename.endswith('.tmp'):
+                remove_expired_file(os.path.join(shared_cache_path, filename), \
+                                    lock_time_limit)
+
+    # returns None
+    return None
+
+def get_shared_slab(key, reader, *args):
+
+    '''
+get_shared_slab: returns the slab identified by its key from the shared cache; \
+if it is not available, the slab is read by the function specified and written \
+to the shared cache unless another process is reading it, in which case it is \
+awaited.
+
+    Input:
+    ======
+    key:                    tuple identifying the slab, consisting of the key
+                            of the netCDF file, the variable name and the index
+                            of the time step;
+    reader:                 function that returns the slab as a numpy array
+                            when called with the remaining arguments.
+
+    Output:
+    =======
+    slab:                   numpy array of the slab, mapped in memory if it was
+                            read from the shared cache.
+
+'''
+
+    # get the file names of the slab and of the lock of the process reading it
+    filename = get_slab_filename(key)
+    lock_filename = '%s.lock' % filename
+
+    # wait for the slab as long as another process is reading it
+    waiting_time = 0.0
+    while True:
+
+        # return the slab if available
+        if os.path.isfile(filename):
+            slab = load_slab(filename)
+            if not isinstance(slab, NoneType):
+                return slab
+
+        # try to obtain the lock and read and write the slab
+        try:
+            lock_file = os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            lock_file = None
+
+        if not isinstance(lock_file, NoneType):
+            try:
+                slab = reader(*args)
+                write_slab(filename, slab)
+            finally:
+                os.close(lock_file)
+                try:
+                    os.remove(lock_filename)
+                except OSError:
+                    pass
+
+            # remove expired slabs and return the slab
+            prune_shared_cache()
+            return slab
+
+        # remove the lock if it is older than the time-out as the process
+        # that created it has failed, and try to obtain the lock again
+        if remove_expired_file(lock_filename, time.time() - shared_cache_timeout):
+            logger.warning('expired lock %s of another process is removed' % \
+                           lock_filename)
+            continue
+
+        # wait for the other process or read the slab directly if it takes
+        # too long, e.g., if the other process has failed
+        if waiting_time >= shared_cache_timeout:
+            logger.warning('slab %s was not written in time by another process and is read directly' % \
+                           filename)
+            return reader(*args)
+        time.sleep(shared_cache_interval)
+        waiting_time += shared_cache_interval
+
+# end of the shared forcing cache module
@@ -5,13 +5,14 @@ import sys
 import logging
 import pcraster as pcr
 
-from copy            import deepcopy
-from basic_functions import pcr_return_val_div_zero, sum_list, pcr_get_statistics, max_dicts
+from basic_functions import pcr_return_val_div_zero, sum_list, pcr_get_statistics, max_dicts, \
+                            copy_dicts
 from model_time      import match_date_by_julian_number, get_weights_from_dates
 from allocation      import get_key, get_zonal_fraction, get_zonal_total, \
+                            get_zonal_minimum, \
                             obtain_allocation_ratio, \
                             allocate_demand_to_availability_with_options, \
-                            allocate_demand_to_withdrawals
+                            allocate_demand_to_withdrawals, allocation_modes
 from water_quality   import water_quality
 #from estimate_waterdepth import estimate_waterdepth_from_discharge
 
@@ -257,6 +258,9 @@ total_return_flow_ini                      : total return flow [m3/day]
         desalinated_water_use_flag         = False, \
         groundwater_pumping_capacity_flag  = False, \
         surfacewater_pumping_capacity_flag = False, \
+        use_local_first_flag               = True, \
+        reallocate_surplus                 = True, \
+        allocation_mode                    = 'iterative', \
         ):
 
         '''
@@ -285,6 +289,9 @@ water management class requires the following input for its initialization:
         desalinated_water_use_flag         = False
         groundwater_pumping_capacity_flag  = False
         surfacewater_pumping_capacity_flag = False
+        use_local_first_flag               = True
+        reallocate_surplus                 = True
+        allocation_mode                    = 'iterative'
 See doc string of class for detailed info.
   
 '''
@@ -318,13 +325,30 @@ See doc string of class for detailed info.
         # use_local_first is a boolean PCRaster map that indicates if the local
         # availability should be used first; the flag is a boolean identifying
         # its overall setting to True or False for logging purposes
-        self.use_local_first    = pcr.spatial(pcr.boolean(1))
+        self.use_local_first    = pcr.spatial(pcr.boolean(int(use_local_first_flag)))
         self.use_local_first_flag = pcr.cellvalue(pcr.mapmaximum(pcr.scalar( \
                                                   self.use_local_first)), 1)[0] == 1
         
         # reallocate_surplus is a boolean variable (True, False) indicating
         # that any surplus will be used to satisfy any local demand.
-        self.reallocate_surplus = True
+        self.reallocate_surplus = reallocate_surplus
+        
+        # allocation_mode is the mode of the allocation of the demand to the
+        # availability, either iterative or proportional; the closed-form
+        # proportional allocation does not use the local availability first
+        # nor does it reallocate any surplus, which should be switched off
+        if allocation_mode not in allocation_modes:
+            message_str = 'allocation mode %s is not one of %s' % \
+                          (allocation_mode, str.join(', ', allocation_modes))
+            logger.error(message_str)
+            sys.exit('error: %s' % message_str)
+        self.allocation_mode = allocation_mode
+        if self.allocation_mode == 'proportional' and \
+                (self.use_local_first_flag or self.reallocate_surplus):
+            message_str = 'the proportional allocation mode requires use_local_first_flag ' + \
+                          'and reallocate_surplus to be set to False'
+            logger.error(message_str)
+            sys.exit('error: %s' % message_str)
         
         # source_unmet_demand: either any or all of the available sources;
         # formerly, by default set to both surface water and groundwater that
@@ -414,7 +438,7 @@ See doc string of class for detailed info.
         # set to an equal weight; otherwise, priorities are given in ascending
         # order, the lowest value having the highest priority; priorities can be 
         # defined locally as maps but are spatially compared
-        source_names_prioritization = deepcopy(self.source_names)
+        source_names_prioritization = self.source_names[:]
         if desalinated_water_use_flag and 'desalwater' not in source_names:
             source_names_prioritization.append('desalwater')
         
@@ -606,7 +630,7 @@ See doc string of class for detailed info.
         # [ reporting ]
         # create message string on the selected processing
         message_str = 'water demand options are processed with the following options:'
-        for option_str in ['time_increment', 'use_local_first_flag', 'reallocate_surplus']:
+        for option_str in ['time_increment', 'allocation_mode', 'use_local_first_flag', 'reallocate_surplus']:
             message_str = str.join('\n\t', \
                                    (message_str, \
                                     '%-20s: %s' % (option_str, \
@@ -729,12 +753,13 @@ See doc string of class for detailed info.
         # (units: m3/year)
         regional_pumping_limit = regional_pumping_limit * region_ratios * 1000000000
         
-        # define the long-term potential withdrawal per source
+        # define the long-term potential withdrawal per source; this is only
+        # read and therefore not copied
         # (units: m3/day)
         if source_name == 'groundwater':
-            longterm_potential_withdrawal = deepcopy(self.groundwater_longterm_potential_withdrawal)
+            longterm_potential_withdrawal = self.groundwater_longterm_potential_withdrawal
         if source_name == 'surfacewater':
-            longterm_potential_withdrawal = deepcopy(self.surfacewater_longterm_potential_withdrawal)
+            longterm_potential_withdrawal = self.surfacewater_longterm_potential_withdrawal
         
         # calculate the rate of water available during the specified month
         # (units: m3/m3)
@@ -833,9 +858,10 @@ See doc string of class for detailed info.
         self.total_gross_demand = sum_list(list(self.gross_demand.values()))
         self.total_net_demand   = sum_list(list(self.net_demand.values()))
         
-        # create an updateable gross demand variable
+        # create an updateable gross demand variable; the fields are replaced
+        # when updated so only the dictionary is copied
         # (units: m3/day)
-        self.gross_demand_remaining = deepcopy(self.gross_demand)
+        self.gross_demand_remaining = copy_dicts(self.gross_demand)
         
         # [ DELETEME ] verbose <----------------------------------------------------------------------------------------------------------------------
         if verbose:
@@ -1102,7 +1128,7 @@ See doc string of class for detailed info.
         # get the volume of environmental flow to be storaged
         # during the time-step and update the variable (units: m3/day)
         self.gross_demand['environment'] = channel_depth_environment * channel_width * channel_length
-        self.net_demand['environment'] = deepcopy(self.gross_demand['environment'])
+        self.net_demand['environment'] = self.gross_demand['environment']
         
         # [ surface water long-term availability ]
         # get the water depth correspondent to the surface water long-term availability 
@@ -1111,7 +1137,7 @@ See doc string of class for detailed info.
         
         # update the environmental flow prioritization based on the possibility
         # of supplying this demand
-        prioritization = deepcopy(self.prioritization)
+        prioritization = copy_dicts(self.prioritization)
         prioritization['surfacewater']['environment'] = \
                             self.prioritization['surfacewater']['environment'] * \
                             pcr.max(0.1, \
@@ -1155,9 +1181,9 @@ See doc string of class for detailed info.
         
         # [ set up input data ] .............................................................................................
         # define starting conditions
-        remaining_availability      = deepcopy(availability)
+        remaining_availability      = availability
         
-        unmet_demand_per_sector     = deepcopy(self.gross_demand)
+        unmet_demand_per_sector     = copy_dicts(self.gross_demand)
         sector_names_no_desalwater  = [sector_name for sector_name in self.sector_names \
                                        if sector_name not in self.sector_names_desalwater]
         for sector_name in sector_names_no_desalwater:
@@ -1208,8 +1234,8 @@ See doc string of class for detailed info.
                                       local_values = remaining_availability, \
                                       zones        = zones)
             else:
-                totz_demand_old = deepcopy(total_zonal_demand)
-                totz_supply_old = deepcopy(total_zonal_supply)
+                totz_demand_old = total_zonal_demand
+                totz_supply_old = total_zonal_supply
             
             # define water availability weights per sector accounting for water quality
             source_name = 'desalwater'
@@ -1241,7 +1267,8 @@ See doc string of class for detailed info.
                         zones              = {'desalwater' : zones_per_sector[sector_name]}, \
                         source_names       = ['desalwater'], \
                         use_local_first     = self.use_local_first, \
-                        reallocate_surplus = self.reallocate_surplus)
+                        reallocate_surplus = self.reallocate_surplus, \
+                        allocation_mode    = self.allocation_mode)
                 
                 # update water withdrawal and demand values
                 met_demand_per_sector[sector_name]   = \
@@ -1521,7 +1548,7 @@ See doc string of class for detailed info.
         #      allocated_unmet_demand_to_nonrenewable_sources
         # (units: m3/day)
         self.surfacewater_potential_estimated_withdrawal = \
-                             deepcopy(self.potential_renewable_withdrawal['surfacewater'])
+                             self.potential_renewable_withdrawal['surfacewater']
         self.groundwater_potential_estimated_withdrawal  = \
                              self.potential_renewable_withdrawal['groundwater'] + \
                              sum_list(list(unmet_demand_per_sector.values()))
@@ -1595,8 +1622,8 @@ See doc string of class for detailed info.
         
         # [ set up input data ] .............................................................................................
         # define starting conditions
-        remaining_availability      = deepcopy(availability)
-        unmet_demand_per_sector     = deepcopy(demand_per_sector)
+        remaining_availability      = copy_dicts(availability)
+        unmet_demand_per_sector     = copy_dicts(demand_per_sector)
         
         met_demand_per_sector       = dict((sector_name, \
                                             pcr.ifthen(demand_per_sector[sector_name] >= 0.0, \
@@ -1682,15 +1709,15 @@ See doc string of class for detailed info.
                                                        local_values = remaining_availability[source_name], \
                                                        zones        = zones[source_name])
                 else:
-                    totz_demand_old[source_name] = deepcopy(total_zonal_demand[source_name])
-                    totz_supply_old[source_name] = deepcopy(total_zonal_supply[source_name])
+                    totz_demand_old[source_name] = total_zonal_demand[source_name]
+                    totz_supply_old[source_name] = total_zonal_supply[source_name]
             
             # evaluate potential water withdrawal
             # define water availability weights per sector accounting for water quality
             
             # [ surfacewater ]
             source_name = 'surfacewater'
-            unmet_demand_per_sector_surfacewater = deepcopy(unmet_demand_per_sector)
+            unmet_demand_per_sector_surfacewater = copy_dicts(unmet_demand_per_sector)
             weights_surfacewater_per_sector = \
                 self.water_quality.get_weights_availability_per_sector( \
                          source_name               = source_name, \
@@ -1704,7 +1731,7 @@ See doc string of class for detailed info.
             
             # [ groundwater ]
             source_name = 'groundwater'
-            unmet_demand_per_sector_groundwater = deepcopy(unmet_demand_per_sector)
+            unmet_demand_per_sector_groundwater = copy_dicts(unmet_demand_per_sector)
             
             # if thermoelectric sector or environmental flow requirements are evaluated
             for sector_name in self.sectors_local_surfacewater:
@@ -1750,7 +1777,8 @@ See doc string of class for detailed info.
                                               'groundwater'  : zones_per_sector['groundwater'][sector_name]}, \
                         source_names       = self.source_names, \
                         use_local_first     = use_local_first, \
-                        reallocate_surplus = reallocate_surplus)
+                        reallocate_surplus = reallocate_surplus, \
+                        allocation_mode    = self.allocation_mode)
                 
                 # [ DELETEME ] verbose <--------------------------------------------------------------------------------------------------------------
                 if verbose:
@@ -1864,16 +1892,17 @@ See doc string of class for detailed info.
         
         message_str = 'Non-renewable withdrawals are assigned to the following sources'
         
-        # set variables
+        # set variables; these are only read and not copied, the zones are
+        # static so their indices are reused
         source_name         = 'groundwater'
-        availability        = deepcopy(self.potential_renewable_withdrawal[source_name])
-        suitability         = deepcopy(self.suitability_per_sector[source_name])
-        zones               = deepcopy(zones_per_sector[source_name])
-        withdrawal_capacity = deepcopy(withdrawal_capacity[source_name])
+        availability        = self.potential_renewable_withdrawal[source_name]
+        suitability         = self.suitability_per_sector[source_name]
+        zones               = zones_per_sector[source_name]
+        withdrawal_capacity = withdrawal_capacity[source_name]
         
         # filter sectors that can withdraw water also from groundwater
         # and unmet demands from these sectors
-        sector_names = deepcopy(self.sector_names)
+        sector_names = self.sector_names[:]
         for sector_name in self.sectors_local_surfacewater:
             if sector_name in self.sector_names:
                 sector_names.remove(sector_name)
@@ -1914,7 +1943,7 @@ See doc string of class for detailed info.
                 capacity = withdrawal_capacity_remaining
                 availability_per_sector = capacity * suitability[sector_name]
             else:
-                capacity = pcr.areaminimum(availability, zones[sector_name])
+                capacity = get_zonal_minimum(availability, zones[sector_name])
                 capacity = pcr.ifthenelse(capacity > 0, capacity, pcr.scalar(1))
                 
                 availability_per_sector = pcr.ifthenelse(availability > 0, \
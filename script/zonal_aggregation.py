@@ -0,0 +1,503 @@
+# zonal aggregation module of the QUAlloc model
+
+# this module provides a numpy-based alternative to the PCRaster area
+# functions that are used in the allocation: each zone map is indexed once
+# with compact integer labels over its defined (land) cells, which are stored
+# sorted per zone together with the offsets and counts of the zones; the zonal
+# totals, minima and maxima are then obtained as segmented reductions over the
+# sorted cells. Values are exchanged as flat arrays and only converted back to
+# PCRaster fields at the module boundaries.
+# The allocation zones are static during a run and their indices are
+# registered once at the initialization of the model; zone maps that are
+# created on the fly are indexed on first use and kept in a bounded cache.
+
+# modules
+import numpy as np
+import pcraster as pcr
+
+try:
+    from .basic_functions import np_return_val_div_zero
+except:
+    from basic_functions import np_return_val_div_zero
+
+# global variables
+
+# small number to avoid zero divisions
+very_small_number = 1.0e-12
+
+# maximum number of zone indices of zone maps that are not registered; zone
+# maps that are created on the fly or read again, e.g., the region ids of the
+# pumping capacity that are read every year, will otherwise fill the cache;
+# each cached index keeps its zone map alive together with several arrays of
+# the size of the zoned cells, so the bound is kept small
+max_number_cached_zones = 8
+
+# zone indices, identified by the id of the zone map: registered zone indices
+# are kept for the duration of the run, others are cached temporarily;
+# the zone map itself is stored with the index to verify the identity
+registered_zone_indices = {}
+cached_zone_indices     = {}
+
+# type of None, compatible with python 2.6
+NoneType = type(None)
+
+#############
+# functions #
+#############
+
+def get_clone_shape():
+
+    '''
+get_clone_shape: returns the number of rows and columns of the current clone.
+
+'''
+
+    # return the shape
+    return pcr.clone().nrRows(), pcr.clone().nrCols()
+
+def pcr_to_array(pcrfield):
+
+    '''
+pcr_to_array: converts a PCRaster field into a flat array of 64-bit floats \
+with missing values set to NaN.
+
+'''
+
+    # return the flat array
+    return pcr.pcr2numpy(pcr.scalar(pcrfield), np.nan).astype(np.float64).ravel()
+
+def array_to_pcr(values, shape = None):
+
+    '''
+array_to_pcr: converts a flat array with missing values set to NaN into \
+a scalar PCRaster field of the current clone.
+
+'''
+
+    # get the shape
+    if isinstance(shape, NoneType):
+        shape = get_clone_shape()
+
+    # return the PCRaster field
+    return pcr.numpy2pcr(pcr.Scalar, \
+                         np.asarray(values, dtype = np.float64).reshape(shape), \
+                         np.nan)
+
+###################
+# class definition #
+###################
+
+class zone_index(object):
+
+    '''
+zone_index: index of the cells per zone of a nominal PCRaster field that is \
+used to compute zonal totals, fractions, minima and maxima as segmented \
+reductions over flat arrays of cell values. The index can also be set directly \
+from the cells and zone ids, which is used for subsets of the zones.
+
+    Attributes:
+    ===========
+    zones:                  zones as a nominal PCRaster field; cells with
+                            missing values are not part of any zone; None for
+                            a subset;
+    shape:                  number of rows and columns of the clone or, for a
+                            subset, of the array of values;
+    number_zones:           number of zones;
+    zone_ids:               original identifiers of the zones;
+    cells:                  positions of all cells in a zone in the array of
+                            values, in map order;
+    flat_cells:             flat indices of all cells in a zone in the clone;
+                            these are equal to the positions for a full index;
+    labels:                 compact label per cell in a zone in map order;
+    sorted_cells:           positions of all cells sorted by zone;
+    offsets:                offset of each zone in the sorted cells;
+    counts:                 number of cells per zone.
+
+'''
+
+    def __init__(self, zones, shape = None, cells = None, zone_ids = None, \
+                 flat_cells = None):
+
+        # init object
+        object.__init__(self)
+
+        # set the zones
+        self.zones = zones
+
+        if isinstance(cells, NoneType):
+            # get the shape of the clone, the cells that are part of a zone
+            # and their zone id
+            self.shape = get_clone_shape()
+            mask = pcr.pcr2numpy(pcr.defined(zones), 0).astype(bool).ravel()
+            self.cells      = np.flatnonzero(mask)
+            self.flat_cells = self.cells
+            zone_ids = pcr.pcr2numpy(pcr.nominal(zones), 0).ravel()[self.cells]
+        else:
+            # set the index directly
+            self.shape      = shape
+            self.cells      = cells
+            self.flat_cells = flat_cells
+
+        # get the compact labels
+        self.zone_ids, labels = np.unique(zone_ids, return_inverse = True)
+        self.labels       = labels.ravel().astype(np.intp)
+        self.number_zones = self.zone_ids.size
+
+        # sort the cells by zone and get the counts and offsets per zone
+        order = np.argsort(self.labels, kind = 'stable')
+        self.sorted_cells = self.cells[order]
+        self.counts  = np.bincount(self.labels, minlength = self.number_zones)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)[:-1])).astype(np.intp)
+
+        # returns None
+        return None
+
+    def get_subset(self, active_zones, active_cells):
+
+        '''
+get_subset: returns the zone index restricted to the active zones, of which the \
+cells are given as positions in the array of the active cells; the active \
+cells are flat indices of the clone in ascending order and should include all \
+cells of the active zones. The cost is proportional to the number of cells of \
+the present index.
+
+    Input:
+    ======
+    active_zones:           boolean array with one entry per zone that is True
+                            for the zones that are kept;
+    active_cells:           flat indices of the active cells in ascending order.
+
+'''
+
+        # get the cells of the active zones and return the subset
+        selection  = active_zones[self.labels]
+        flat_cells = self.flat_cells[selection]
+
+        return zone_index(zones      = None, \
+                          shape      = (1, active_cells.size), \
+                          cells      = np.searchsorted(active_cells, flat_cells), \
+                          zone_ids   = self.zone_ids[self.labels[selection]], \
+                          flat_cells = flat_cells)
+
+    def has_same_zones(self, other):
+
+        '''
+has_same_zones: returns True if the other zone index has the same cells and \
+zones as the present one.
+
+'''
+
+        # return the comparison
+        return other is self or \
+               (isinstance(other, zone_index) and \
+                self.shape == other.shape and \
+                np.array_equal(self.cells, other.cells) and \
+                np.array_equal(self.zone_ids, other.zone_ids) and \
+                np.array_equal(self.labels, other.labels))
+
+    def get_zonal_values(self, values, ufunc, fill_value):
+
+        '''
+get_zonal_values: returns the reduction of the values per zone as an array \
+with one entry per zone; missing values, set to NaN, are replaced by the fill \
+value and zones without any valid value are set to NaN. The values can be \
+stacked along leading dimensions (e.g., one row per sector), in which case \
+all rows are reduced in a single pass.
+
+    Input:
+    ======
+    values:                 flat array of local cell values, with missing
+                            values set to NaN, or a stack of these arrays with
+                            the cells along the last axis;
+    ufunc:                  numpy ufunc used for the reduction (e.g. np.add,
+                            np.minimum, np.maximum);
+    fill_value:             neutral value of the reduction that replaces the
+                            missing values.
+
+'''
+
+        # no zones, return an empty array
+        if self.number_zones == 0:
+            return np.zeros(values.shape[:-1] + (0, ))
+
+        # get the values sorted by zone and replace missing values
+        sorted_values = values[..., self.sorted_cells]
+        valid_mask    = ~np.isnan(sorted_values)
+        sorted_values[~valid_mask] = fill_value
+
+        # get the values per zone as a segmented reduction
+        zonal_values = ufunc.reduceat(sorted_values, self.offsets, axis = -1)
+        zonal_values = np.where(np.add.reduceat(valid_mask.astype(np.intp), \
+                                                self.offsets, axis = -1) > 0, \
+                                zonal_values, np.nan)
+
+        # return the zonal values
+        return zonal_values
+
+    def broadcast(self, zonal_values, values = None, out = None):
+
+        '''
+broadcast: assigns the values per zone to all cells in the zones and returns \
+the result as a flat array, or a stack of these if the zonal values are \
+stacked; cells outside the zones are set to NaN as are the cells with missing \
+values in the optional local values. The result is written to the optional \
+output array if provided.
+
+'''
+
+        # assign the zonal values to the cells
+        if isinstance(out, NoneType):
+            cell_values = np.full(zonal_values.shape[:-1] + \
+                                  (self.shape[0] * self.shape[1], ), np.nan)
+        else:
+            cell_values = out
+            cell_values.fill(np.nan)
+        cell_values[..., self.cells] = zonal_values[..., self.labels]
+        if not isinstance(values, NoneType):
+            cell_values[np.isnan(values)] = np.nan
+
+        # return the cell values
+        return cell_values
+
+    def get_total(self, values, out = None):
+
+        '''
+get_total: returns the total over the zones per cell as a flat array; the \
+result is written to the optional output array if provided.
+
+'''
+
+        # return the totals
+        return self.broadcast(self.get_zonal_values(values, np.add, 0.0), \
+                              values, out)
+
+    def get_minimum(self, values, out = None):
+
+        '''
+get_minimum: returns the minimum over the zones per cell as a flat array; the \
+result is written to the optional output array if provided.
+
+'''
+
+        # return the minima
+        return self.broadcast(self.get_zonal_values(values, np.minimum, np.inf), \
+                              values, out)
+
+    def get_maximum(self, values, out = None):
+
+        '''
+get_maximum: returns the maximum over the zones per cell as a flat array; the \
+result is written to the optional output array if provided.
+
+'''
+
+        # return the maxima
+        return self.broadcast(self.get_zonal_values(values, np.maximum, -np.inf), \
+                              values, out)
+
+    def get_fraction(self, values, out = None):
+
+        '''
+get_fraction: returns the fractional value per cell over the total of the zone \
+as a flat array; the fractional values sum to unity over the zone and the \
+result is written to the optional output array if provided.
+
+'''
+
+        # return the fractional values
+        return np_return_val_div_zero(values, self.get_total(values, out), \
+                                      very_small_number, out = out)
+
+#== end of zone_index class ===================================================
+
+class local_index(object):
+
+    '''
+local_index: index of the local cells of a boolean PCRaster field in which \
+each cell is a zone of its own, as obtained with uniqueid; it provides the \
+totals, minima, maxima and fractions of the zone index, which reduce to \
+elementwise operations. Cells that are not local are missing. The index has \
+the same interface as the zone index, so it can be used by all allocation \
+kernels.
+
+    Attributes:
+    ===========
+    shape:                  number of rows and columns of the clone;
+    mask:                   flat boolean array that is True for the local cells;
+    number_zones:           number of zones, being the number of local cells;
+    zone_ids:               identifiers of the zones, being the flat indices of
+                            the local cells;
+    cells, flat_cells:      flat indices of the local cells;
+    labels:                 compact label per local cell.
+
+'''
+
+    def __init__(self, local_mask):
+
+        # init object
+        object.__init__(self)
+
+        # set the shape and the mask of the local cells
+        self.shape = get_clone_shape()
+        self.mask  = pcr.pcr2numpy(pcr.boolean(local_mask), 0).astype(bool).ravel()
+
+        # set the cells and zones, each local cell being a zone of its own
+        self.cells        = np.flatnonzero(self.mask)
+        self.flat_cells   = self.cells
+        self.zone_ids     = self.cells
+        self.labels       = np.arange(self.cells.size, dtype = np.intp)
+        self.number_zones = self.cells.size
+
+        # returns None
+        return None
+
+    def get_subset(self, active_zones, active_cells):
+
+        '''
+get_subset: returns the zone index restricted to the active local cells; see \
+zone_index.get_subset.
+
+'''
+
+        # get the active local cells and return the subset as a zone index
+        flat_cells = self.flat_cells[active_zones]
+
+        return zone_index(zones      = None, \
+                          shape      = (1, active_cells.size), \
+                          cells      = np.searchsorted(active_cells, flat_cells), \
+                          zone_ids   = flat_cells, \
+                          flat_cells = flat_cells)
+
+    def get_zonal_values(self, values, ufunc, fill_value):
+
+        '''
+get_zonal_values: returns the values of the local cells as an array with one \
+entry per zone, being the reduction over a single cell; see \
+zone_index.get_zonal_values.
+
+'''
+
+        # return the values of the local cells
+        return np.array(values[..., self.cells], dtype = np.float64)
+
+    def has_same_zones(self, other):
+
+        '''
+has_same_zones: returns True if the other index has the same local cells.
+
+'''
+
+        # return the comparison
+        return other is self or \
+               (isinstance(other, local_index) and \
+                np.array_equal(self.mask, other.mask))
+
+    def get_local_values(self, values, out = None):
+
+        '''
+get_local_values: returns the values of the local cells, being their own \
+zonal total, minimum or maximum, as a flat array or a stack of these; the \
+result is written to the optional output array if provided.
+
+'''
+
+        # get the values and set the cells that are not local to missing
+        if isinstance(out, NoneType):
+            cell_values = np.array(values, dtype = np.float64)
+        else:
+            cell_values = out
+            np.copyto(cell_values, values)
+        cell_values[..., ~self.mask] = np.nan
+
+        # return the cell values
+        return cell_values
+
+    # the zonal totals, minima and maxima are the local values
+    get_total   = get_local_values
+    get_minimum = get_local_values
+    get_maximum = get_local_values
+
+    def get_fraction(self, values, out = None):
+
+        '''
+get_fraction: returns the fractional value per local cell, which is unity if \
+the value is positive and zero otherwise.
+
+'''
+
+        # return the fractional values
+        return np_return_val_div_zero(values, self.get_total(values, out), \
+                                      very_small_number, out = out)
+
+#== end of local_index class ==================================================
+
+def get_zone_index(zones):
+
+    '''
+get_zone_index: returns the zone index of a nominal PCRaster field; the \
+registered zone indices are used if available, otherwise the zone index is \
+taken from or added to the bounded cache. Zone and local indices are returned \
+as they are.
+
+'''
+
+    # return an index as it is
+    if isinstance(zones, (zone_index, local_index)):
+        return zones
+
+    # return the registered or cached zone index if available
+    key = id(zones)
+    for zone_indices in [registered_zone_indices, cached_zone_indices]:
+        if key in zone_indices and zone_indices[key].zones is zones:
+            return zone_indices[key]
+
+    # create the zone index and update the cache, removing the oldest entry
+    # if necessary
+    if len(cached_zone_indices) >= max_number_cached_zones:
+        del cached_zone_indices[next(iter(cached_zone_indices))]
+    cached_zone_indices[key] = zone_index(zones)
+
+    # return the zone index
+    return cached_zone_indices[key]
+
+def register_zone_indices(zones):
+
+    '''
+register_zone_indices: creates and registers the zone indices of the static \
+zone maps so these are kept for the duration of the run; zones can be a \
+nominal PCRaster field or a (nested) dictionary of these, as used for the \
+allocation zones per source and sector. Zone maps that are shared by several \
+entries are indexed only once.
+
+'''
+
+    # process dictionaries recursively
+    if isinstance(zones, dict):
+        for value in zones.values():
+            register_zone_indices(value)
+
+    elif not isinstance(zones, NoneType):
+        # register the zone index, moving it from the cache if present
+        key = id(zones)
+        if key in cached_zone_indices and cached_zone_indices[key].zones is zones:
+            registered_zone_indices[key] = cached_zone_indices.pop(key)
+        elif not (key in registered_zone_indices and \
+                  registered_zone_indices[key].zones is zones):
+            registered_zone_indices[key] = zone_index(zones)
+
+    # returns None
+    return None
+
+def clear_zone_indices():
+
+    '''
+clear_zone_indices: removes all registered and cached zone indices.
+
+'''
+
+    # clear the zone indices
+    registered_zone_indices.clear()
+    cached_zone_indices.clear()
+
+    # returns None
+    return None
@@ -0,0 +1,12 @@
+# configuration of the tests of the QUAlloc model
+
+# the modules of the model are imported from the script directory, as when
+# the model is run; the tests that require PCRaster or the netCDF and GDAL
+# libraries are skipped if these are not available
+
+# modules
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+                                os.pardir, 'script'))
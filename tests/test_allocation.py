@@ -0,0 +1,326 @@
+# tests of the allocation module of the QUAlloc model
+
+# the vectorized kernels are compared with the allocation with PCRaster fields
+# on the synthetic clones of the allocation benchmark
+
+# modules
+import pytest
+import numpy as np
+
+pcr = pytest.importorskip('pcraster')
+
+import allocation
+
+from allocation import allocate_demand_to_availability_np, \
+                       allocate_demand_to_availability_pcr, \
+                       allocate_arrays, \
+                       allocate_arrays_proportional, \
+                       allocate_withdrawal_to_sectors, \
+                       allocate_withdrawal_arrays, \
+                       allocate_withdrawal_to_sectors_np, \
+                       allocate_withdrawal_to_sectors_pcr, \
+                       set_allocation_kernel
+from allocation_benchmark import create_synthetic_clone
+from basic_functions import np_return_val_div_zero
+from zonal_aggregation import clear_zone_indices, zone_index, local_index
+
+# global variables
+
+# names of the sources and sectors of the synthetic clones
+source_names = ['groundwater', 'surfacewater']
+sector_names = ['irrigation', 'domestic', 'livestock']
+
+#############
+# functions #
+#############
+
+def get_clone_maps(seed, availability_ratio, distinct_zones, \
+                   number_rows = 30, number_cols = 40, number_zones = 12):
+
+    '''returns the maps of a synthetic clone'''
+
+    clear_zone_indices()
+    return create_synthetic_clone(number_rows        = number_rows, \
+                                  number_cols        = number_cols, \
+                                  number_zones       = number_zones, \
+                                  source_names       = source_names, \
+                                  sector_names       = sector_names, \
+                                  distribution       = 'lognormal', \
+                                  availability_ratio = availability_ratio, \
+                                  land_fraction      = 0.5, \
+                                  zero_fraction      = 0.2, \
+                                  distinct_zones     = distinct_zones, \
+                                  seed               = seed)
+
+def to_array(fields):
+
+    '''returns a PCRaster field, or a dictionary of these, as a stack of arrays with NaN as missing value'''
+
+    if isinstance(fields, dict):
+        return np.stack([pcr.pcr2numpy(fields[key], np.nan) for key in sorted(fields)])
+    return pcr.pcr2numpy(fields, np.nan)
+
+def assert_allclose(fields, reference_fields):
+
+    '''asserts that the fields agree with the reference fields'''
+
+    assert np.allclose(to_array(fields), to_array(reference_fields), \
+                       rtol = 1.0e-6, atol = 1.0e-9, equal_nan = True)
+
+def get_zone_index(zone_ids):
+
+    '''returns the zone index of an array of zone ids in which negative ids are outside the zones'''
+
+    cells = np.flatnonzero(zone_ids >= 0)
+    return zone_index(zones      = None, \
+                      shape      = (1, zone_ids.size), \
+                      cells      = cells, \
+                      zone_ids   = zone_ids[cells], \
+                      flat_cells = cells)
+
+def allocate_arrays_reference(demand, availability, zone_indices):
+
+    '''
+allocate_arrays_reference: iterative allocation over all cells in every \
+iteration, following the allocation with PCRaster fields, as reference for the \
+vectorized kernel that only processes the active cells.
+
+'''
+
+    availability     = np.array(availability, dtype = np.float64)
+    withdrawal       = np.where(demand >= 0, 0.0, np.nan) * np.ones(availability.shape)
+    allocated_demand = withdrawal.copy()
+    met_demand       = np.where(demand >= 0, 0.0, np.nan)
+    unmet_demand     = np.maximum(0, demand - met_demand)
+    min_number_cells = np.count_nonzero(demand >= 0)
+    iterations       = []
+    while True:
+        zonal_availability = np.stack([zones.get_total(availability[ix]) \
+                                       for ix, zones in enumerate(zone_indices)])
+        zonal_potential_allocation = zonal_availability * \
+                                     np.stack([zones.get_fraction(unmet_demand) \
+                                               for zones in zone_indices])
+        allocation_ratio = np_return_val_div_zero(zonal_potential_allocation, \
+                                                  zonal_potential_allocation.sum(axis = 0), \
+                                                  1.0e-12)
+        allocation = np.minimum(zonal_potential_allocation, allocation_ratio * unmet_demand)
+        increment  = availability * \
+                     np_return_val_div_zero(np.stack([zones.get_total(allocation[ix]) \
+                                                      for ix, zones in enumerate(zone_indices)]), \
+                                            zonal_availability, 1.0e-12)
+        allocated_demand += allocation
+        withdrawal       += increment
+        availability      = np.maximum(0, availability - increment)
+        met_demand   = allocated_demand.sum(axis = 0)
+        unmet_demand = np.maximum(0, demand - met_demand)
+        with np.errstate(invalid = 'ignore'):
+            number_cells = np.count_nonzero((unmet_demand > 0) & \
+                                            (availability.sum(axis = 0) - \
+                                             withdrawal.sum(axis = 0) > 0))
+        iterations.append(number_cells)
+        if number_cells == 0 or number_cells == min_number_cells:
+            break
+        min_number_cells = min(min_number_cells, number_cells)
+    return withdrawal, allocated_demand, met_demand, unmet_demand, iterations
+
+def get_synthetic_arrays(seed, number_sources = 3, number_cells = 400):
+
+    '''returns random demand, availability and zone indices per source as arrays'''
+
+    rng = np.random.default_rng(seed)
+    demand = rng.lognormal(0.0, 1.0, number_cells)
+    demand[rng.random(number_cells) < 0.2] = 0.0
+    demand[rng.random(number_cells) < 0.1] = np.nan
+    availability = rng.lognormal(0.0, 1.5, (number_sources, number_cells)) * \
+                   rng.uniform(0.5, 3.0) / number_sources
+    availability[:, np.isnan(demand)] = np.nan
+    zone_indices = []
+    for ix in range(number_sources):
+        zone_ids = (np.arange(number_cells) + 7 * ix) // rng.integers(5, 40)
+        zone_ids[np.isnan(demand)] = -1
+        zone_indices.append(get_zone_index(zone_ids))
+    return demand, availability, zone_indices
+
+#########
+# tests #
+#########
+
+@pytest.mark.parametrize('seed', [1, 2])
+@pytest.mark.parametrize('availability_ratio', [0.5, 2.0])
+@pytest.mark.parametrize('distinct_zones', [False, True])
+def test_allocate_demand_to_availability(seed, availability_ratio, distinct_zones):
+
+    # the vectorized kernel gives the same withdrawal, allocated demand and
+    # met demand as the allocation with PCRaster fields
+    clone_maps = get_clone_maps(seed, availability_ratio, distinct_zones)
+    keywords = {'demand'       : clone_maps['demand'], \
+                'availability' : clone_maps['availability'], \
+                'zones'        : clone_maps['zones'], \
+                'source_names' : source_names}
+
+    withdrawal, allocated_demand, met_demand, unmet_demand, iterations = \
+        allocate_demand_to_availability_np(**keywords)
+    reference_withdrawal, reference_allocated_demand, reference_met_demand, \
+        reference_unmet_demand, reference_iterations = \
+        allocate_demand_to_availability_pcr(**keywords)
+
+    assert_allclose(withdrawal, reference_withdrawal)
+    assert_allclose(allocated_demand, reference_allocated_demand)
+    assert_allclose(met_demand, reference_met_demand)
+    assert_allclose(unmet_demand, reference_unmet_demand)
+    assert list(iterations) == list(reference_iterations)
+
+@pytest.mark.parametrize('seed', [1, 2])
+@pytest.mark.parametrize('availability_ratio', [0.5, 2.0])
+def test_allocate_demand_to_availability_balance(seed, availability_ratio):
+
+    # the met demand is the sum of the allocated demand, does not exceed the
+    # demand and the withdrawal does not exceed the availability
+    clone_maps = get_clone_maps(seed, availability_ratio, True)
+    withdrawal, allocated_demand, met_demand, unmet_demand, iterations = \
+        allocate_demand_to_availability_np(demand       = clone_maps['demand'], \
+                                           availability = clone_maps['availability'], \
+                                           zones        = clone_maps['zones'], \
+                                           source_names = source_names)
+
+    demand = to_array(clone_maps['demand'])
+    mask = ~np.isnan(demand)
+    assert np.allclose(to_array(allocated_demand).sum(axis = 0)[mask], \
+                       to_array(met_demand)[mask])
+    assert np.all(to_array(met_demand)[mask] <= demand[mask] + 1.0e-9)
+    assert np.allclose((to_array(met_demand) + to_array(unmet_demand))[mask], demand[mask])
+    assert np.all(to_array(withdrawal)[:, mask] <= \
+                  to_array(clone_maps['availability'])[:, mask] + 1.0e-9)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_allocate_arrays_active_cells(seed):
+
+    # the vectorized kernel, which only processes the active cells after the
+    # first iteration, gives the same output as the allocation over all cells
+    demand, availability, zone_indices = get_synthetic_arrays(seed)
+
+    output = allocate_arrays(demand, availability, zone_indices)
+    reference_output = allocate_arrays_reference(demand, availability, zone_indices)
+
+    for values, reference_values in zip(output[:4], reference_output[:4]):
+        assert np.allclose(values, reference_values, rtol = 1.0e-9, atol = 1.0e-12, \
+                           equal_nan = True)
+    assert list(output[4]) == list(reference_output[4])
+
+@pytest.mark.parametrize('seed', [1, 2])
+@pytest.mark.parametrize('availability_ratio', [0.5, 2.0])
+def test_allocate_withdrawal_to_sectors(seed, availability_ratio):
+
+    # the batched sectors give the same allocated demand and required
+    # withdrawal as the sectors processed one by one with PCRaster fields
+    clone_maps = get_clone_maps(seed, availability_ratio, False)
+    keywords = {'withdrawal'   : clone_maps['withdrawal_per_sector']['renewable']['groundwater'], \
+                'demand'       : clone_maps['demand_per_sector'], \
+                'zones'        : clone_maps['zones_per_sector']['groundwater'], \
+                'sector_names' : sector_names}
+
+    allocated_demand, required_withdrawal = allocate_withdrawal_to_sectors_np(**keywords)
+    reference_allocated_demand, reference_required_withdrawal = \
+        allocate_withdrawal_to_sectors_pcr(**keywords)
+
+    assert_allclose(allocated_demand, reference_allocated_demand)
+    assert_allclose(required_withdrawal, reference_required_withdrawal)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_allocate_withdrawal_arrays(seed):
+
+    # the stacked sectors give the same output as the sectors one by one
+    demand, availability, zone_indices = get_synthetic_arrays(seed, number_sources = 4)
+    demand = np.stack([demand * factor for factor in [0.5, 1.0, 2.0, 0.0]])
+
+    allocated_demand, required_withdrawal = \
+        allocate_withdrawal_arrays(availability, demand, zone_indices[0])
+    for ix in range(demand.shape[0]):
+        reference_allocated_demand, reference_required_withdrawal = \
+            allocate_withdrawal_arrays(availability[ix], demand[ix], zone_indices[0])
+        assert np.allclose(allocated_demand[ix], reference_allocated_demand, equal_nan = True)
+        assert np.allclose(required_withdrawal[ix], reference_required_withdrawal, equal_nan = True)
+    assert np.all(allocated_demand[3][~np.isnan(allocated_demand[3])] == 0)
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('same_zones', [True, False])
+def test_allocate_arrays_proportional(seed, same_zones):
+
+    # the closed-form proportional allocation gives the same output as the
+    # iterative allocation if the zones are the same and falls back to the
+    # iterative allocation otherwise
+    demand, availability, zone_indices = get_synthetic_arrays(seed)
+    if same_zones:
+        zone_indices = [zone_indices[0] for zones in zone_indices]
+
+    output = allocate_arrays_proportional(demand, availability, zone_indices)
+    reference_output = allocate_arrays(demand, availability, zone_indices)
+
+    for values, reference_values in zip(output[:4], reference_output[:4]):
+        assert np.allclose(values, reference_values, rtol = 1.0e-9, atol = 1.0e-12, \
+                           equal_nan = True)
+    if same_zones:
+        assert len(output[4]) == 1
+
+@pytest.mark.parametrize('seed', range(5))
+def test_allocate_arrays_local_index(seed):
+
+    # the local index gives the same output in the iterative and closed-form
+    # kernels as the zone index in which each local cell is a zone
+    number_rows, number_cols = 20, 20
+    pcr.setclone(number_rows, number_cols, 1.0, 0.0, 0.0)
+    demand, availability, zone_indices = get_synthetic_arrays(seed, number_cells = number_rows * number_cols)
+    local_mask = np.random.default_rng(seed).random(demand.size) < 0.6
+
+    local_zones = local_index(pcr.numpy2pcr(pcr.Boolean, \
+                                            local_mask.reshape(number_rows, number_cols).astype(np.uint8), \
+                                            255))
+    zones = get_zone_index(np.where(local_mask, np.arange(demand.size), -1))
+
+    for kernel in [allocate_arrays, allocate_arrays_proportional]:
+        output = kernel(demand, availability, [local_zones] * availability.shape[0])
+        reference_output = kernel(demand, availability, [zones] * availability.shape[0])
+        for values, reference_values in zip(output[:4], reference_output[:4]):
+            assert np.allclose(values, reference_values, equal_nan = True)
+        assert list(output[4]) == list(reference_output[4])
+
+def test_set_allocation_kernel(monkeypatch):
+
+    # the kernel is set by its name and any other name halts the model
+    monkeypatch.setattr(allocation, 'use_numpy_kernel', False)
+    set_allocation_kernel('numpy')
+    assert allocation.use_numpy_kernel
+    set_allocation_kernel('pcraster')
+    assert not allocation.use_numpy_kernel
+    with pytest.raises(SystemExit):
+        set_allocation_kernel('fortran')
+
+@pytest.mark.parametrize('kernel', ['pcraster', 'numpy'])
+def test_allocate_withdrawal_to_sectors_kernel(monkeypatch, kernel):
+
+    # the allocation to the sectors uses the kernel that is set
+    monkeypatch.setattr(allocation, 'use_numpy_kernel', False)
+    set_allocation_kernel(kernel)
+    clone_maps = get_clone_maps(1, 0.5, False)
+    keywords = {'withdrawal'   : clone_maps['withdrawal_per_sector']['renewable']['groundwater'], \
+                'demand'       : clone_maps['demand_per_sector'], \
+                'zones'        : clone_maps['zones_per_sector']['groundwater'], \
+                'sector_names' : sector_names}
+
+    calls = []
+    for function_name in ['allocate_withdrawal_to_sectors_np', 'allocate_withdrawal_to_sectors_pcr']:
+        def allocation_function(function_name = function_name, \
+                                allocation_function = getattr(allocation, function_name), \
+                                **kwargs):
+            calls.append(function_name)
+            return allocation_function(**kwargs)
+        monkeypatch.setattr(allocation, function_name, allocation_function)
+
+    allocated_demand, required_withdrawal = allocate_withdrawal_to_sectors(**keywords)
+    reference_allocated_demand, reference_required_withdrawal = \
+        allocate_withdrawal_to_sectors_pcr(**keywords)
+
+    assert calls[0] == {'pcraster': 'allocate_withdrawal_to_sectors_pcr', \
+                        'numpy'   : 'allocate_withdrawal_to_sectors_np'}[kernel]
+    assert_allclose(allocated_demand, reference_allocated_demand)
+    assert_allclose(required_withdrawal, reference_required_withdrawal)
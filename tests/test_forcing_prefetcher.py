@@ -0,0 +1,85 @@
+# tests of the forcing prefetcher module of the QUAlloc model
+
+# the prefetcher is tested with a reader and a converter that record the
+# thread by which they are called
+
+# modules
+import threading
+
+from forcing_prefetcher import forcing_prefetcher
+
+#############
+# functions #
+#############
+
+def get_prefetcher(calls, enabled = True):
+
+    '''returns a prefetcher that records the reads and conversions in calls'''
+
+    def reader(value):
+        calls.append(('read', value, threading.current_thread().name))
+        return value
+
+    def converter(output, value):
+        calls.append(('convert', value, threading.current_thread().name))
+        return 10 * output
+
+    return forcing_prefetcher(reader, converter, enabled = enabled)
+
+def test_prefetched_request_is_converted_on_main_thread():
+
+    calls = []
+    prefetcher = get_prefetcher(calls)
+    prefetcher.prefetch(1, {'a': {'value': 2}})
+
+    assert prefetcher.read(1, 'a', value = 2) == 20
+    assert len(prefetcher.pending) == 0
+    assert calls[0][:2] == ('read', 2)
+    assert calls[0][2] != threading.main_thread().name
+    assert calls[1] == ('convert', 2, threading.main_thread().name)
+    prefetcher.shutdown()
+
+def test_request_with_other_arguments_is_read_directly():
+
+    calls = []
+    prefetcher = get_prefetcher(calls)
+    prefetcher.prefetch(1, {'a': {'value': 2}})
+
+    assert prefetcher.read(1, 'a', value = 3) == 30
+    assert ('read', 3, threading.main_thread().name) in calls
+    prefetcher.shutdown()
+
+def test_uncollected_requests_do_not_block_prefetching():
+
+    calls = []
+    prefetcher = get_prefetcher(calls)
+
+    # the request b of the first time step is never collected
+    prefetcher.prefetch(1, {'a': {'value': 1}, 'b': {'value': 0}})
+    assert prefetcher.read(1, 'a', value = 1) == 10
+    assert list(prefetcher.pending.keys()) == [1]
+
+    # the next time steps are still prefetched
+    for step_key in range(2, 5):
+        prefetcher.prefetch(step_key, {'a': {'value': step_key}})
+        assert list(prefetcher.pending.keys()) == [step_key]
+        assert prefetcher.read(step_key, 'a', value = step_key) == 10 * step_key
+    prefetcher.shutdown()
+
+    # all collected requests were read by the worker thread; the discarded
+    # request b may or may not have been read before it was cancelled
+    worker_reads = [call[1] for call in calls \
+                    if call[0] == 'read' and call[2] != threading.main_thread().name]
+    assert [value for value in worker_reads if value != 0] == [1, 2, 3, 4]
+
+def test_disabled_prefetcher_reads_directly():
+
+    calls = []
+    prefetcher = get_prefetcher(calls, enabled = False)
+    prefetcher.prefetch(1, {'a': {'value': 2}})
+
+    assert len(prefetcher.pending) == 0
+    assert prefetcher.read(1, 'a', value = 2) == 20
+    assert calls == [('read', 2, threading.main_thread().name), \
+                     ('convert', 2, threading.main_thread().name)]
+    prefetcher.shutdown()
@@ -0,0 +1,156 @@
+# tests of the netCDF output handler of the QUAlloc model
+
+# the output that is written by the writer thread from the queue is compared
+# with the output that is written directly
+
+# modules
+import datetime
+
+import numpy as np
+import pytest
+
+pcr = pytest.importorskip('pcraster')
+nc = pytest.importorskip('netCDF4')
+
+import netCDF_recipes
+
+from model_configuration import configuration_parser
+from netCDF_recipes import netCDF_output_handler, read_nc_metadata, write_nc_metadata
+
+# global variables
+
+# size of the clone, the variables, each written to its own file as by the
+# model, and the dates of the output
+variablenames = ['withdrawal', 'demand', 'consumption']
+number_rows = 6
+number_cols = 8
+dates = [datetime.datetime(2000, 1, 1) + datetime.timedelta(days = day) \
+         for day in range(10)]
+
+###################
+# class definition #
+###################
+
+class test_configuration(object):
+
+    '''configuration with the entries that are used by the output handler'''
+
+    # the conversion of the entries of the configuration parser
+    convert_string_to_input = configuration_parser.convert_string_to_input
+
+    def __init__(self, reporting):
+
+        # init object
+        object.__init__(self)
+
+        # set the entries
+        self.general = {'scenarioname': 'test'}
+        self.netcdfattrs = {}
+        self.reporting = reporting
+        self._timestamp_str = '2000-01-01T00.00.00'
+
+#############
+# functions #
+#############
+
+def get_ncfilenames(path, prefix):
+
+    '''returns the netCDF file names of the variables with the prefix specified'''
+
+    return dict((variablename, str(path / ('%s_%s.nc' % (prefix, variablename)))) \
+                for variablename in variablenames)
+
+def write_output(ncfilenames, reporting):
+
+    '''writes the variables to their files for all dates and returns the values written'''
+
+    pcr.setclone(number_rows, number_cols, 1.0, 0.0, float(number_rows))
+    nc_handler = netCDF_output_handler(test_configuration(reporting))
+
+    for variablename, ncfilename in ncfilenames.items():
+        nc_handler.initialize_nc_variable( \
+                ncfilename     = ncfilename, \
+                variablename   = variablename, \
+                variable_units = 'm/day', \
+                is_spatial     = True, \
+                is_temporal    = True, \
+                long_name      = variablename, \
+                standard_name  = variablename, \
+                datatype       = 'f4')
+
+    values = {}
+    random_generator = np.random.default_rng(23)
+    for date in dates:
+        for variablename, ncfilename in ncfilenames.items():
+            variable_array = random_generator.random( \
+                    (number_rows, number_cols)).astype(np.float32)
+            values.setdefault(variablename, []).append(variable_array)
+            nc_handler.add_data_to_netCDF( \
+                    ncfilename     = ncfilename, \
+                    variablename   = variablename, \
+                    variable_array = variable_array, \
+                    is_timed       = True, \
+                    dates          = [date])
+        nc_handler.finalize_time_step(end_of_year = date == dates[-1], \
+                                      restart_point = False)
+
+    nc_handler.close_cache()
+    return values
+
+def read_output(ncfilename):
+
+    '''returns the values and the attributes of all variables in the file'''
+
+    with nc.Dataset(ncfilename) as rootgrp:
+        return dict((variablename, (np.array(variable[:]), \
+                                    dict((name, variable.getncattr(name)) \
+                                         for name in variable.ncattrs()))) \
+                    for variablename, variable in rootgrp.variables.items())
+
+@pytest.mark.parametrize('sync_interval', ['write', '3', 'year', 'run'])
+def test_queued_output_equals_direct_output(tmp_path, sync_interval):
+
+    direct_filenames = get_ncfilenames(tmp_path, 'direct')
+    queued_filenames = get_ncfilenames(tmp_path, 'queued')
+
+    direct_values = write_output(direct_filenames, \
+                                 {'sync_interval': sync_interval, \
+                                  'output_queue_size': '0'})
+    queued_values = write_output(queued_filenames, \
+                                 {'sync_interval': sync_interval, \
+                                  'output_queue_size': '2'})
+
+    for variablename in variablenames:
+        direct_output = read_output(direct_filenames[variablename])
+        queued_output = read_output(queued_filenames[variablename])
+
+        # all variables, including the dimensions, are identical
+        assert sorted(direct_output.keys()) == sorted(queued_output.keys())
+        for name, (values, attributes) in direct_output.items():
+            assert np.array_equal(values, queued_output[name][0])
+            assert attributes == queued_output[name][1]
+
+        # the values are written in the order in which they were added
+        assert np.array_equal(direct_output[variablename][0], \
+                              np.array(direct_values[variablename]))
+        assert np.array_equal(queued_output[variablename][0], \
+                              np.array(queued_values[variablename]))
+
+def test_sync_interval_of_zero_is_rejected():
+
+    pcr.setclone(number_rows, number_cols, 1.0, 0.0, float(number_rows))
+    with pytest.raises(SystemExit):
+        netCDF_output_handler(test_configuration({'sync_interval': '0'}))
+
+def test_metadata_is_written_by_way_of_temporary_file(tmp_path, monkeypatch):
+
+    # the metadata are read back and no temporary files remain in the cache
+    ncfilename = tmp_path / 'input.nc'
+    ncfilename.write_bytes(b'netCDF')
+    cache_path = tmp_path / 'cache'
+    cache_path.mkdir()
+    monkeypatch.setattr(netCDF_recipes, 'metadata_cache_path', str(cache_path))
+
+    write_nc_metadata(str(ncfilename), {'variablenames': variablenames})
+    assert read_nc_metadata(str(ncfilename))['variablenames'] == variablenames
+    assert [filename.suffix for filename in cache_path.iterdir()] == ['.pkl']
@@ -0,0 +1,176 @@
+# tests of the reporting module of the QUAlloc model
+
+# the reported totals and averages of a year of daily time steps are compared
+# with those computed directly; the netCDF output handler is replaced by one
+# that keeps the reported arrays
+
+# modules
+import calendar
+import datetime
+
+import numpy as np
+import pytest
+
+pcr = pytest.importorskip('pcraster')
+
+import qualloc_reporting
+
+from model_configuration import configuration_parser
+from qualloc_reporting import qualloc_reporting as reporting_class
+
+# global variables
+
+# size of the clone, the reported variables, of which total_consumption
+# contains the name of the statistic sum, and the reported intervals
+number_rows = 4
+number_cols = 5
+variablenames = ['total_consumption', 'total_withdrawal']
+report_intervals = ['daily_tot', 'monthly_tot', 'monthly_avg', \
+                    'yearly_tot', 'yearly_avg']
+
+###################
+# class definition #
+###################
+
+class test_configuration(object):
+
+    '''configuration with the entries that are used by the reporting'''
+
+    # the conversion of the entries of the configuration parser
+    convert_string_to_input = configuration_parser.convert_string_to_input
+
+    def __init__(self):
+
+        # init object
+        object.__init__(self)
+
+        # set the entries
+        self.general = {'clone': 'clone.map', 'inputpath': '.'}
+        self.clone_attributes = None
+        self.netcdfpath = '.'
+        self.reporting = dict((report_interval, str.join(',', variablenames)) \
+                              for report_interval in report_intervals)
+
+class output_handler(object):
+
+    '''netCDF output handler that keeps the reported arrays per file'''
+
+    def __init__(self, model_configuration, landmask = None):
+
+        # init object
+        object.__init__(self)
+
+        # set the reported arrays
+        self.default_fill_value = -999.9
+        self.output = {}
+
+    def initialize_nc_variable(self, ncfilename, **kwargs):
+        self.output[ncfilename] = []
+
+    def add_data_to_netCDF(self, ncfilename, variablename, variable_array, \
+                           **additional_info):
+        self.output[ncfilename].append(variable_array)
+
+    def finalize_time_step(self, end_of_year = False, restart_point = False):
+        pass
+
+    def close_cache(self):
+        pass
+
+class model_time(object):
+
+    '''model time of a daily time step with its report flags'''
+
+    def __init__(self, date):
+
+        # init object
+        object.__init__(self)
+
+        # set the date and the report flags
+        last_day_of_month = date.day == calendar.monthrange(date.year, date.month)[1]
+        self.date = date
+        self.report_flags = {'daily'  : True, \
+                             'monthly': last_day_of_month, \
+                             'yearly' : last_day_of_month and date.month == 12}
+
+#############
+# functions #
+#############
+
+def get_reported_output(monkeypatch, fields):
+
+    '''reports the fields of all dates and returns the reporting'''
+
+    monkeypatch.setattr(qualloc_reporting, 'read_file_entry', lambda **kwargs: None)
+    monkeypatch.setattr(qualloc_reporting, 'netCDF_output_handler', output_handler)
+
+    reporting = reporting_class(test_configuration())
+    reporting.initialize()
+
+    for date, date_fields in fields:
+        def update_reportable_variables(model):
+            for variablename in variablenames:
+                setattr(reporting, variablename, date_fields[variablename])
+        reporting.update_reportable_variables = update_reportable_variables
+        reporting.report(model_time(date), None)
+    reporting.close()
+
+    return reporting
+
+def get_fields(year):
+
+    '''returns the random fields of the variables for all days of the year'''
+
+    pcr.setclone(number_rows, number_cols, 1.0, 0.0, float(number_rows))
+    random_generator = np.random.default_rng(25)
+
+    fields = []
+    date = datetime.datetime(year, 1, 1)
+    while date.year == year:
+        fields.append((date, dict((variablename, pcr.numpy2pcr(pcr.Scalar, \
+                        random_generator.random((number_rows, number_cols)), -999.9)) \
+                                  for variablename in variablenames)))
+        date += datetime.timedelta(days = 1)
+
+    return fields
+
+def test_reported_statistics(monkeypatch):
+
+    fields = get_fields(2001)
+    reporting = get_reported_output(monkeypatch, fields)
+    output = reporting.nc_handler.output
+
+    for variablename in variablenames:
+
+        # values per day and month
+        values = np.array([pcr.pcr2numpy(date_fields[variablename], -999.9) \
+                           for date, date_fields in fields])
+        months = np.array([date.month for date, date_fields in fields])
+        monthly_values = [values[months == month] for month in range(1, 13)]
+
+        # daily values
+        assert np.allclose(output['./%s_daily_tot.nc' % variablename], values)
+
+        # monthly and yearly totals and averages
+        assert np.allclose(output['./%s_monthly_tot.nc' % variablename], \
+                           [month_values.sum(axis = 0) for month_values in monthly_values])
+        assert np.allclose(output['./%s_monthly_avg.nc' % variablename], \
+                           [month_values.mean(axis = 0) for month_values in monthly_values])
+        assert np.allclose(output['./%s_yearly_tot.nc' % variablename], \
+                           [values.sum(axis = 0)])
+        assert np.allclose(output['./%s_yearly_avg.nc' % variablename], \
+                           [values.mean(axis = 0)])
+
+def test_count_of_variable_with_statistic_in_name(monkeypatch):
+
+    # the count of total_consumption, which contains sum, is the number of
+    # time steps and not incremented by the field as well
+    fields = get_fields(2001)[:10]
+    reporting = get_reported_output(monkeypatch, fields)
+
+    for variablename in variablenames:
+        for interval in ['monthly', 'yearly']:
+            accumulator = reporting.accumulators['%s_%s_count' % (variablename, interval)]
+            assert accumulator.statistic == 'count'
+    assert reporting.accumulators['total_consumption_monthly_count'].value == 10
+    assert reporting.accumulators['total_withdrawal_monthly_count'].value == 10
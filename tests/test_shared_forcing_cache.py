@@ -0,0 +1,96 @@
+# tests of the shared forcing cache module of the QUAlloc model
+
+# the cache is tested in a temporary directory with a short time-out
+
+# modules
+import os
+import time
+
+import numpy as np
+import pytest
+
+import shared_forcing_cache
+
+from shared_forcing_cache import get_shared_slab, get_slab_filename, \
+                                 prune_shared_cache, set_shared_cache_path
+
+#############
+# functions #
+#############
+
+@pytest.fixture
+def shared_cache(tmp_path, monkeypatch):
+
+    '''sets the shared cache to a temporary directory with a short time-out'''
+
+    monkeypatch.setattr(shared_forcing_cache, 'shared_cache_timeout', 1.0)
+    monkeypatch.setattr(shared_forcing_cache, 'shared_cache_interval', 0.01)
+    set_shared_cache_path(str(tmp_path))
+    yield tmp_path
+    set_shared_cache_path(None)
+
+def set_age(filename, age):
+
+    '''sets the time of modification of the file to the age in seconds'''
+
+    modification_time = time.time() - age
+    os.utime(filename, (modification_time, modification_time))
+
+def test_slab_is_read_once(shared_cache):
+
+    calls = []
+    def reader(value):
+        calls.append(value)
+        return np.full((2, 3), value, dtype = np.float32)
+
+    key = ('file', 'variable', 0)
+    first_slab = get_shared_slab(key, reader, 1.0)
+    second_slab = get_shared_slab(key, reader, 2.0)
+
+    assert calls == [1.0]
+    assert np.array_equal(first_slab, second_slab)
+    assert os.path.isfile(get_slab_filename(key))
+
+def test_expired_lock_is_removed(shared_cache):
+
+    key = ('file', 'variable', 1)
+    lock_filename = '%s.lock' % get_slab_filename(key)
+    open(lock_filename, 'w').close()
+    set_age(lock_filename, 10.0)
+
+    start_time = time.time()
+    slab = get_shared_slab(key, np.arange, 4)
+
+    assert time.time() - start_time < 0.5
+    assert np.array_equal(slab, np.arange(4))
+    assert os.path.isfile(get_slab_filename(key))
+    assert not os.path.isfile(lock_filename)
+
+def test_recent_lock_is_awaited(shared_cache):
+
+    key = ('file', 'variable', 2)
+    lock_filename = '%s.lock' % get_slab_filename(key)
+    open(lock_filename, 'w').close()
+
+    # the lock expires while the slab is awaited, after which it is read
+    start_time = time.time()
+    slab = get_shared_slab(key, np.arange, 3)
+
+    assert time.time() - start_time >= 0.5
+    assert np.array_equal(slab, np.arange(3))
+
+def test_prune_removes_expired_files(shared_cache):
+
+    filenames = {}
+    for name, age in [('slab_old.npy', 7200.0), ('slab_new.npy', 0.0), \
+                      ('slab_old.npy.lock', 10.0), ('slab_new.npy.lock', 0.0), \
+                      ('slab_old.npy.1.tmp', 10.0), ('slab_new.npy.1.tmp', 0.0), \
+                      ('other.lock', 10.0)]:
+        filenames[name] = os.path.join(str(shared_cache), name)
+        open(filenames[name], 'w').close()
+        set_age(filenames[name], age)
+
+    prune_shared_cache()
+
+    assert sorted(os.listdir(str(shared_cache))) == \
+        ['other.lock', 'slab_new.npy', 'slab_new.npy.1.tmp', 'slab_new.npy.lock']
@@ -0,0 +1,184 @@
+# tests of the zonal aggregation module of the QUAlloc model
+
+# the zonal totals, minima, maxima and fractions of the zone index are compared
+# with the straightforward reduction per zone on small synthetic arrays
+
+# modules
+import pytest
+import numpy as np
+
+pcr = pytest.importorskip('pcraster')
+
+import zonal_aggregation
+
+from zonal_aggregation import zone_index, local_index, get_zone_index as get_cached_zone_index, \
+                              register_zone_indices, clear_zone_indices
+
+#############
+# functions #
+#############
+
+def get_zone_index(zone_ids):
+
+    '''returns the zone index of an array of zone ids in which negative ids are outside the zones'''
+
+    cells = np.flatnonzero(zone_ids >= 0)
+    return zone_index(zones      = None, \
+                      shape      = (1, zone_ids.size), \
+                      cells      = cells, \
+                      zone_ids   = zone_ids[cells], \
+                      flat_cells = cells)
+
+def get_reference(zone_ids, values, function):
+
+    '''returns the reduction per zone broadcast to the cells, looping over the zones'''
+
+    reference = np.full(values.shape, np.nan)
+    for zone_id in np.unique(zone_ids[zone_ids >= 0]):
+        mask = zone_ids == zone_id
+        valid_values = values[mask & ~np.isnan(values)]
+        if valid_values.size > 0:
+            reference[mask] = function(valid_values)
+    reference[np.isnan(values)] = np.nan
+    return reference
+
+def get_synthetic_values(seed, number_cells = 200, number_zones = 12):
+
+    '''returns random zone ids, with cells outside the zones, and values with missing values'''
+
+    rng = np.random.default_rng(seed)
+    zone_ids = rng.integers(-1, number_zones, number_cells) * 7 + 3
+    zone_ids[zone_ids < 0] = -1
+    values = rng.lognormal(0.0, 1.0, number_cells)
+    values[rng.random(number_cells) < 0.1] = np.nan
+    values[rng.random(number_cells) < 0.1] = 0.0
+    return zone_ids, values
+
+#########
+# tests #
+#########
+
+@pytest.mark.parametrize('seed', range(5))
+def test_zonal_reductions(seed):
+
+    # the totals, minima and maxima equal the reduction per zone
+    zone_ids, values = get_synthetic_values(seed)
+    zones = get_zone_index(zone_ids)
+
+    np.testing.assert_allclose(zones.get_total(values), \
+                               get_reference(zone_ids, values, np.sum), equal_nan = True)
+    np.testing.assert_allclose(zones.get_minimum(values), \
+                               get_reference(zone_ids, values, np.min), equal_nan = True)
+    np.testing.assert_allclose(zones.get_maximum(values), \
+                               get_reference(zone_ids, values, np.max), equal_nan = True)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_zonal_fraction(seed):
+
+    # the fractions sum to unity over the zones with a positive total and
+    # are zero in the zones without
+    zone_ids, values = get_synthetic_values(seed)
+    zones = get_zone_index(zone_ids)
+    fractions = zones.get_fraction(values)
+
+    totals = get_reference(zone_ids, values, np.sum)
+    for zone_id in np.unique(zone_ids[zone_ids >= 0]):
+        mask = (zone_ids == zone_id) & ~np.isnan(values)
+        if mask.any() and totals[mask][0] > 0:
+            assert np.isclose(fractions[mask].sum(), 1.0)
+        else:
+            assert np.all(fractions[mask] == 0)
+    assert np.all(np.isnan(fractions[zone_ids < 0]))
+
+def test_stacked_values():
+
+    # stacked values are reduced per row in a single pass
+    zone_ids, values = get_synthetic_values(0)
+    stacked_values = np.stack([values, 2 * values, values[::-1]])
+    zones = get_zone_index(zone_ids)
+
+    totals = zones.get_total(stacked_values)
+    for ix in range(stacked_values.shape[0]):
+        np.testing.assert_allclose(totals[ix], zones.get_total(stacked_values[ix]), \
+                                   equal_nan = True)
+
+def test_output_array():
+
+    # the result written to the output array equals the returned result
+    zone_ids, values = get_synthetic_values(1)
+    zones = get_zone_index(zone_ids)
+    out = np.empty(values.shape)
+
+    result = zones.get_total(values, out = out)
+    assert result is out
+    np.testing.assert_allclose(out, get_reference(zone_ids, values, np.sum), \
+                               equal_nan = True)
+
+def test_subset():
+
+    # the subset of the active zones gives the same totals over the active
+    # cells as the full index
+    zone_ids, values = get_synthetic_values(2)
+    values[np.isnan(values)] = 0.0
+    zones = get_zone_index(zone_ids)
+
+    active_zones = np.arange(zones.number_zones) % 2 == 0
+    active_cells = np.sort(zones.flat_cells[active_zones[zones.labels]])
+    subset = zones.get_subset(active_zones, active_cells)
+
+    np.testing.assert_allclose(subset.get_total(values[active_cells]), \
+                               zones.get_total(values)[active_cells])
+
+def test_same_zones():
+
+    # zone indices are compared by their cells and zones
+    zone_ids, values = get_synthetic_values(3)
+    other_zone_ids = zone_ids.copy()
+
+    assert get_zone_index(zone_ids).has_same_zones(get_zone_index(other_zone_ids))
+    other_zone_ids[0] = -1 if zone_ids[0] >= 0 else 3
+    assert not get_zone_index(zone_ids).has_same_zones(get_zone_index(other_zone_ids))
+
+def test_local_index():
+
+    # the local index is elementwise over the local cells and missing
+    # elsewhere
+    number_rows, number_cols = 4, 5
+    pcr.setclone(number_rows, number_cols, 1.0, 0.0, 0.0)
+    rng = np.random.default_rng(4)
+    local_mask = rng.random((number_rows, number_cols)) < 0.5
+    values = rng.random(number_rows * number_cols)
+    values[0] = 0.0
+
+    local_zones = local_index(pcr.numpy2pcr(pcr.Boolean, local_mask.astype(np.uint8), 255))
+    reference = np.where(local_mask.ravel(), values, np.nan)
+
+    np.testing.assert_allclose(local_zones.get_total(values), reference, equal_nan = True)
+    np.testing.assert_allclose(local_zones.get_fraction(values), \
+                               np.where(reference > 0, 1.0, \
+                                        np.where(np.isnan(reference), np.nan, 0.0)), \
+                               equal_nan = True)
+
+def test_zone_index_cache_is_bounded():
+
+    # zone maps that are read again are cached up to the bound, after which
+    # the oldest entries are removed; registered zone maps are kept
+    clear_zone_indices()
+    pcr.setclone(4, 5, 1.0, 0.0, 0.0)
+    zone_ids = np.arange(20).reshape(4, 5) % 3 + 1
+    registered_zones = pcr.numpy2pcr(pcr.Nominal, zone_ids, -1)
+    register_zone_indices(registered_zones)
+
+    zone_maps = [pcr.numpy2pcr(pcr.Nominal, zone_ids, -1) \
+                 for ix in range(2 * zonal_aggregation.max_number_cached_zones)]
+    for zones in zone_maps:
+        assert get_cached_zone_index(zones).zones is zones
+        assert len(zonal_aggregation.cached_zone_indices) <= \
+               zonal_aggregation.max_number_cached_zones
+
+    cached_zone_maps = [index.zones for index in zonal_aggregation.cached_zone_indices.values()]
+    assert len(cached_zone_maps) == zonal_aggregation.max_number_cached_zones
+    assert all(zones is cached_zones for zones, cached_zones in \
+               zip(zone_maps[-zonal_aggregation.max_number_cached_zones:], cached_zone_maps))
+    assert get_cached_zone_index(registered_zones).zones is registered_zones
+    clear_zone_indices()